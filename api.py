@@ -1,10 +1,36 @@
-from record import (AddressBookRecord, AddressBookRecordEncoder, AddressBookRecordDecoder,
-                    EMAIL_REGEX, NAME_REGEX, PHONE_REGEX)
+from record import AddressBookRecord
+from validation import field_error, record_error, validate_records
+from storage import SearchQuery, StorageBackend, StorageEngine, create_storage
+from index import SearchMode, INDEXED_FIELDS, field_key
+from cache import ResultCache, records_size
+from serialization import encode_records
+from metrics import REGISTRY, SERIALIZE_DURATION
+from changes import ChangeBatch
+from phone import PhoneMatch, PHONE_SUFFIX_MIN_DIGITS, normalize_phone, phone_digits
 from enum import Enum, auto
 from typing import Optional
-from dataclasses import dataclass
-import json
-import re
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import AbstractContextManager
+from dataclasses import dataclass, replace
+from itertools import islice
+import asyncio
+import gzip
+import time
+
+# Searches other than EXACT can match a large part of the book, so their results are capped unless a limit is given
+TEXT_SEARCH_LIMIT = 100
+
+# The most queries a single search_records_batch call can hold
+SEARCH_BATCH_MAX_QUERIES = 10_000
+
+# The default bounds of the cache of search and list results
+CACHE_MAX_ENTRIES = 1024
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Encoded bodies smaller than this are not worth compressing, gzip's header alone is 18 bytes.
+# Level 6 (zlib's default) compresses records nearly as well as 9 in a fraction of the time
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
 
 
 class ResponseCode(Enum):
@@ -14,144 +40,429 @@ class ResponseCode(Enum):
     INVALID_FIELD = auto()
 
 
+@dataclass
+class EncodedRecords:
+    """Records already encoded as a JSON array, which may then have been gzip compressed"""
+    body: bytes
+    gzipped: bool = False
+
+
 @dataclass
 class Response:
     response_code: ResponseCode
-    data: Optional[AddressBookRecord | list[AddressBookRecord]]
+    data: Optional[AddressBookRecord | list[AddressBookRecord] | list["Response"]
+                   | Iterator[AddressBookRecord] | AsyncIterator[AddressBookRecord] | EncodedRecords | ChangeBatch
+                   | int | dict]
 
 
 class AddressBookAPI:
     """
     Provides methods to interact with the JSON address book database
+    The records are held in memory and only read from disk again if the file is changed externally
+    The backend decides where the records are kept, see storage.StorageBackend
+    shared must be set if the database is used by other processes at the same time
+    pretty indents the JSON file rather than writing it compactly
+    Search and list results are cached (see cache.ResultCache), cache_max_entries=0 disables the cache
+    With more than one shard the records are partitioned across that many files, each kept by a worker process
+    (see sharding.ShardedStorage), use sharding.reshard to split an existing book
     All methods return a response code, along with any relevant data
     """
-    def __init__(self, database_path: str) -> None:
+    def __init__(self, database_path: str, backend: StorageBackend = StorageBackend.JSON,
+                 shared: bool = False, pretty: bool = False, cache_max_entries: int = CACHE_MAX_ENTRIES,
+                 cache_max_bytes: int = CACHE_MAX_BYTES, shards: int = 1) -> None:
         self.database_path = database_path
 
+        if shards > 1:
+            # Only imported when needed, as it pulls in multiprocessing
+            from sharding import ShardedStorage
+            self.storage: StorageEngine = ShardedStorage(database_path, shards, backend, shared, pretty)
+        else:
+            self.storage = create_storage(database_path, backend, shared, pretty)
+
+        self.cache = ResultCache(cache_max_entries, cache_max_bytes)
+
     def add_record(self, new_record: AddressBookRecord) -> Response:
         """
         Adds the provided record to the database.
-        Returns the added record on success, or an error if the record already exists
+        Returns the added record on success, or an error if a field is invalid or the record already exists
         """
-        records = self.list_records().data
+        if (error := record_error(new_record)) is not None:
+            return Response(ResponseCode.INVALID_FIELD, error)
 
-        if new_record in records:
+        if not self.storage.add(new_record):
             return Response(ResponseCode.ALREADY_EXISTS, None)
 
-        records.append(new_record)
+        return Response(ResponseCode.OK, new_record)
 
-        with open(self.database_path, "w") as database_file:
-            json.dump(records, database_file, indent=4, cls=AddressBookRecordEncoder)
+    def add_records(self, new_records: list[AddressBookRecord]) -> Response:
+        """
+        Adds the provided records to the database in a single commit.
+        Returns a response for each record, in the same form as add_record
+        """
+        # The whole batch is validated at once, only the valid records are added
+        errors = validate_records(new_records)
+        added = iter(self.storage.add_many([record for record, error in zip(new_records, errors) if error is None]))
 
-        return Response(ResponseCode.OK, new_record)
+        return Response(ResponseCode.OK, [Response(ResponseCode.INVALID_FIELD, error) if error is not None
+                                          else Response(ResponseCode.OK, record) if next(added)
+                                          else Response(ResponseCode.ALREADY_EXISTS, None)
+                                          for record, error in zip(new_records, errors)])
 
     def edit_record(self, old_record: AddressBookRecord, new_first_name: str = "", new_last_name: str = "",
                     new_phone: str = "", new_email: str = "") -> Response:
         """
         Edits a record with the provided fields.
-        Returns the edited record on success,
-        or an error if the record is not found or a new field is invalid
-        """
-        records = self.list_records().data
-
-        # Check that any new field is valid, return an error if not
-        if new_first_name and not re.match(NAME_REGEX, new_first_name):
-            return Response(ResponseCode.INVALID_FIELD, new_first_name)
-
-        if new_last_name and not re.match(NAME_REGEX, new_last_name):
-            return Response(ResponseCode.INVALID_FIELD, new_last_name)
-        
-        if new_phone and not re.match(PHONE_REGEX, new_phone):
-            return Response(ResponseCode.INVALID_FIELD, new_phone)
-        
-        if new_email and not re.match(EMAIL_REGEX, new_email):
-            return Response(ResponseCode.INVALID_FIELD, new_email)
-
-        # Find the existing record and edit any specificed fields
-        for record in records:
-            if old_record == record:
-                if new_first_name:
-                    record.first_name = new_first_name
-                if new_last_name:
-                    record.last_name = new_last_name
-                if new_phone:
-                    record.phone = new_phone
-                if new_email:
-                    record.email = new_email
-
-                with open(self.database_path, "w") as database_file:
-                    json.dump(records, database_file, indent=4, cls=AddressBookRecordEncoder)
-
-                return Response(ResponseCode.OK, record)
-
-        return Response(ResponseCode.NOT_FOUND, None)
+        Returns the edited record on success, or an error if the record is not found,
+        a new field is invalid or the edited record would duplicate an existing record
+        """
+        # Check that any new field is valid, by the same rules as a new record, return an error if not
+        new_fields = {"first_name": new_first_name, "last_name": new_last_name,
+                      "phone": new_phone, "email": new_email}
+
+        for field, value in new_fields.items():
+            if value and field_error(field, value) is not None:
+                return Response(ResponseCode.INVALID_FIELD, value)
+
+        # Replace the existing record with a copy that has any specified fields edited
+        new_record = replace(old_record, **{field: value for field, value in new_fields.items() if value})
+
+        # The storage refuses to replace a record that does not exist, or to create a duplicate record
+        if not self.storage.replace(old_record, new_record):
+            if self.storage.contains(old_record):
+                return Response(ResponseCode.ALREADY_EXISTS, None)
+
+            return Response(ResponseCode.NOT_FOUND, None)
+
+        return Response(ResponseCode.OK, new_record)
 
     def delete_specific_record(self, record_to_delete: AddressBookRecord) -> Response:
         """
         Trys to delete the specified records.
         Returns the record is successful, or an error if the record is not found
         """
-        records = self.list_records().data
-
-        try:
-            records.remove(record_to_delete)
-        except ValueError:
+        if not self.storage.remove(record_to_delete):
             return Response(ResponseCode.NOT_FOUND, None)
 
-        with open(self.database_path, "w") as database_file:
-            json.dump(records, database_file, indent=4, cls=AddressBookRecordEncoder)
-
         return Response(ResponseCode.OK, record_to_delete)
 
+    def delete_specific_records(self, records_to_delete: list[AddressBookRecord]) -> Response:
+        """
+        Deletes the provided records from the database in a single commit.
+        Returns a response for each record, in the same form as delete_specific_record
+        """
+        removed = self.storage.remove_many(records_to_delete)
+
+        return Response(ResponseCode.OK, [Response(ResponseCode.OK, record) if was_removed
+                                          else Response(ResponseCode.NOT_FOUND, None)
+                                          for record, was_removed in zip(records_to_delete, removed)])
+
     def delete_matching_records(self, first_name: str = "", last_name: str = "",
                                 phone: str = "", email: str = "") -> Response:
         """
         Deletes records that match the provided fields.
         Returns the deleted records
         """
-        records = self.list_records().data
-        new_records = records.copy()
-        deleted_records = []
+        deleted_records = self.storage.remove_matching(first_name=first_name, last_name=last_name,
+                                                       phone=phone, email=email)
+
+        return Response(ResponseCode.OK, deleted_records)
+
+    def delete_matching_records_json(self, first_name: str = "", last_name: str = "",
+                                     phone: str = "", email: str = "") -> Response:
+        """
+        Deletes the same records as delete_matching_records, returning them already encoded as a JSON array
+        """
+        deleted_records = self.delete_matching_records(first_name, last_name, phone, email).data
+        return Response(ResponseCode.OK, self._encode(lambda: encode_records(deleted_records)))
 
-        for record in records:
-            if ((first_name == "" or first_name == record.first_name)
-            and (last_name == "" or last_name == record.last_name)
-            and (phone == "" or phone == record.phone)
-            and (email == "" or email == record.email)):
+    def list_records(self, offset: int = 0, limit: Optional[int] = None) -> Response:
+        """
+        Returns all records in the database, in the order they were added.
+        offset and limit can be used to return a page of the records
+        """
+        return Response(ResponseCode.OK, self._cached(("list", offset, limit),
+                                                      lambda: self.storage.records(offset, limit)))
 
-                new_records.remove(record)
-                deleted_records.append(record)
+    def list_records_json(self, offset: int = 0, limit: Optional[int] = None, compress: bool = False) -> Response:
+        """
+        Returns the same records as list_records, already encoded as a compact JSON array (see EncodedRecords).
+        If compress is set, a body of at least GZIP_MIN_BYTES is gzip compressed.
+        Encoded and compressed bodies are cached, so repeated listings are not encoded or compressed again
+        """
+        return Response(ResponseCode.OK, self._encoded(("list", offset, limit),
+                                                       lambda: self.storage.records(offset, limit), compress))
 
-        with open(self.database_path, "w") as database_file:
-            json.dump(new_records, database_file, indent=4, cls=AddressBookRecordEncoder)
+    def data_version(self) -> Response:
+        """
+        Returns a number that increases whenever the records change (see StorageEngine.data_version)
+        """
+        return Response(ResponseCode.OK, self.storage.data_version())
 
-        return Response(ResponseCode.OK, deleted_records)
+    def shared_version(self) -> Response:
+        """
+        Returns a number that increases whenever the records change and is the same in every process sharing them,
+        or None if the storage has none (see StorageEngine.shared_version)
+        """
+        return Response(ResponseCode.OK, self.storage.shared_version())
+
+    def build_indexes(self) -> Response:
+        """
+        Loads the records and builds the indexes searches use, so the first requests do not wait for them
+        """
+        self.storage.build_indexes()
+        return Response(ResponseCode.OK, None)
+
+    def changes(self, since: int) -> Response:
+        """
+        Returns the changes made by the add, edit and delete methods after the change numbered since,
+        so a client mirroring the records only has to fetch what changed (see changes.ChangeLog).
+        If they are no longer known the batch is marked reset, and the client must list the records again
+        """
+        return Response(ResponseCode.OK, self.storage.changes(since))
 
-    def list_records(self) -> Response:
+    def subscribe_changes(self) -> AbstractContextManager[asyncio.Event]:
         """
-        Returns all records in the database
+        Returns a context yielding an event, set whenever a change is made while it is open.
+        Must be entered from a coroutine
         """
-        with open(self.database_path, "r") as database_file:
-            return Response(ResponseCode.OK, json.load(database_file, cls=AddressBookRecordDecoder))
+        return self.storage.change_log.subscribe()
 
-    def search_records(self, first_name: str = "", last_name: str = "",
-                       phone: str = "", email: str = "") -> Response:
+    def cache_stats(self) -> Response:
         """
-        Returns all records that match the provided fields
+        Returns the hit and miss counts, size and bounds of the result cache
         """
-        records = self.list_records().data
-        found_records = []
+        return Response(ResponseCode.OK, self.cache.stats())
 
+    def metrics(self) -> Response:
+        """
+        Returns the request timings, storage I/O, search and cache counters of the process (see metrics.py),
+        along with those of any worker processes keeping the storage (e.g. shards), in the Prometheus text format
+        """
+        return Response(ResponseCode.OK, REGISTRY.render(self.storage.worker_metrics()))
+
+    def stream_records(self, offset: int = 0, limit: Optional[int] = None) -> Response:
+        """
+        Returns an iterator over all records in the database, in the order they were added.
+        offset and limit can be used to iterate over a page of the records
+        """
+        all_records = self.storage.iter_search()
+
+        return Response(ResponseCode.OK, islice(all_records, offset, None if limit is None else offset + limit))
+
+    def search_records(self, first_name: str = "", last_name: str = "", phone: str = "", email: str = "",
+                       offset: int = 0, limit: Optional[int] = None, mode: SearchMode = SearchMode.EXACT) -> Response:
+        """
+        Returns all records that match the provided fields, in the order they were added.
+        mode selects exact, case-insensitive, prefix, substring or fuzzy matching,
+        fuzzy matches are returned closest first and any search other than EXACT returns at most
+        TEXT_SEARCH_LIMIT records unless a limit is given.
+        offset and limit can be used to return a page of the matching records
+        """
         # If no search fields are specified, return an empty list
         if first_name == "" and last_name == "" and phone == "" and email == "":
             return Response(ResponseCode.OK, [])
 
-        for record in records:
-            if ((first_name == "" or first_name == record.first_name)
-            and (last_name == "" or last_name == record.last_name)
-            and (phone == "" or phone == record.phone)
-            and (email == "" or email == record.email)):
+        key, query = self._search_query(SearchQuery(first_name, last_name, phone, email, offset, limit, mode))
+        return Response(ResponseCode.OK, self._cached(key, lambda: self._search(query)))
 
-                found_records.append(record)
+    def search_records_json(self, first_name: str = "", last_name: str = "", phone: str = "", email: str = "",
+                            offset: int = 0, limit: Optional[int] = None, mode: SearchMode = SearchMode.EXACT,
+                            compress: bool = False) -> Response:
+        """
+        Returns the same records as search_records, already encoded and compressed like list_records_json
+        """
+        if first_name == "" and last_name == "" and phone == "" and email == "":
+            return Response(ResponseCode.OK, EncodedRecords(encode_records([])))
+
+        key, query = self._search_query(SearchQuery(first_name, last_name, phone, email, offset, limit, mode))
+        return Response(ResponseCode.OK, self._encoded(key, lambda: self._search(query), compress))
+
+    def search_records_batch(self, queries: list[SearchQuery]) -> Response:
+        """
+        Runs many searches at once, returning a response for each query in the same order,
+        each in the same form as search_records. Every query is answered from the same state of the records.
+        Identical queries are only run once, and results already in the cache are reused.
+        Returns an error if there are more than SEARCH_BATCH_MAX_QUERIES queries
+        """
+        if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+            return Response(ResponseCode.INVALID_FIELD, len(queries))
+
+        keys = []
+        unique_queries = {}
+
+        for query in queries:
+            # Queries without any field match nothing, as with search_records
+            if not any(query.fields().values()):
+                keys.append(None)
+                continue
+
+            key, query = self._search_query(query)
+            keys.append(key)
+            unique_queries.setdefault(key, query)
+
+        results = self._search_many(unique_queries)
+
+        return Response(ResponseCode.OK, [Response(ResponseCode.OK, [] if key is None else list(results[key]))
+                                          for key in keys])
+
+    def search_records_batch_json(self, queries: list[SearchQuery]) -> Response:
+        """
+        Returns the same results as search_records_batch, already encoded as a JSON array of arrays of records,
+        or the same error
+        """
+        api_result = self.search_records_batch(queries)
+
+        if api_result.response_code is not ResponseCode.OK:
+            return api_result
+
+        return Response(ResponseCode.OK, self._encode(
+            lambda: b"[" + b",".join(encode_records(query_result.data) for query_result in api_result.data) + b"]"))
+
+    def lookup_phone(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER, offset: int = 0,
+                     limit: Optional[int] = None) -> Response:
+        """
+        Returns the records with the provided phone number, in any format (e.g. +44 191 347 8234 or 01913478234),
+        or whose number ends with its digits or starts with its area code, depending on match.
+        Returns an error if phone has no digits, or fewer than PHONE_SUFFIX_MIN_DIGITS for a SUFFIX match
+        """
+        min_digits = PHONE_SUFFIX_MIN_DIGITS if match is PhoneMatch.SUFFIX else 1
+
+        if len(phone_digits(phone)) < min_digits or not normalize_phone(phone):
+            return Response(ResponseCode.INVALID_FIELD, phone)
+
+        return Response(ResponseCode.OK, self.storage.search_phone(phone, match, offset, limit))
+
+    def lookup_phone_json(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER, offset: int = 0,
+                          limit: Optional[int] = None) -> Response:
+        """
+        Returns the same records as lookup_phone, already encoded as a JSON array, or the same error
+        """
+        api_result = self.lookup_phone(phone, match, offset, limit)
+
+        if api_result.response_code is not ResponseCode.OK:
+            return api_result
+
+        return Response(ResponseCode.OK, self._encode(lambda: encode_records(api_result.data)))
+
+    def stream_search_records(self, first_name: str = "", last_name: str = "", phone: str = "", email: str = "",
+                              offset: int = 0, limit: Optional[int] = None,
+                              mode: SearchMode = SearchMode.EXACT) -> Response:
+        """
+        Returns an iterator over all records that match the provided fields, in the order they were added.
+        offset and limit can be used to iterate over a page of the matching records
+        """
+        if first_name == "" and last_name == "" and phone == "" and email == "":
+            return Response(ResponseCode.OK, iter([]))
+
+        # Matches other than EXACT are ranked and capped, so they are found together rather than a page at a time
+        if mode is not SearchMode.EXACT:
+            api_result = self.search_records(first_name, last_name, phone, email, offset, limit, mode)
+            return Response(api_result.response_code, iter(api_result.data))
+
+        found_records = self.storage.iter_search(first_name=first_name, last_name=last_name,
+                                                 phone=phone, email=email)
+
+        return Response(ResponseCode.OK, islice(found_records, offset, None if limit is None else offset + limit))
+
+    def _cached(self, key: tuple, search: Callable[[], list[AddressBookRecord]]) -> list[AddressBookRecord]:
+        """
+        Returns the cached result of a search, or runs it and caches the result.
+        The version is read before searching, so a result is never cached for a version older than it
+        """
+        version = self.storage.data_version()
+        found_records = self.cache.get(key, version)
+
+        if found_records is None:
+            found_records = search()
+            self.cache.put(key, version, found_records, records_size(found_records))
+
+        # Callers are free to change the returned list, so the cached one is never handed out
+        return list(found_records)
+
+    def _encoded(self, key: tuple, search: Callable[[], list[AddressBookRecord]],
+                 compress: bool) -> EncodedRecords:
+        """
+        Returns the cached encoded (and if compress is set, compressed) result of a search,
+        or runs the search and caches its encoded result. Only the body that is returned is cached
+        """
+        version = self.storage.data_version()
+
+        if compress:
+            gzipped_body = self.cache.get(("gzip",) + key, version)
+
+            if gzipped_body is not None:
+                return EncodedRecords(gzipped_body, gzipped=True)
+
+        body = self.cache.get(("json",) + key, version)
+
+        if body is None:
+            records = search()
+            started = time.perf_counter()
+            body = encode_records(records)
+            SERIALIZE_DURATION.observe(time.perf_counter() - started, target="response")
+
+        if not compress or len(body) < GZIP_MIN_BYTES:
+            self.cache.put(("json",) + key, version, body, len(body))
+            return EncodedRecords(body)
+
+        started = time.perf_counter()
+        gzipped_body = gzip.compress(body, GZIP_LEVEL, mtime=0)
+        SERIALIZE_DURATION.observe(time.perf_counter() - started, target="gzip")
+        self.cache.put(("gzip",) + key, version, gzipped_body, len(gzipped_body))
+        return EncodedRecords(gzipped_body, gzipped=True)
+
+    def _encode(self, encode: Callable[[], bytes]) -> EncodedRecords:
+        """
+        Encodes a result that is not cached, timing it like the encoding of cached results
+        """
+        started = time.perf_counter()
+        body = encode()
+        SERIALIZE_DURATION.observe(time.perf_counter() - started, target="response")
+        return EncodedRecords(body)
+
+    def _search_many(self, queries: dict[tuple, SearchQuery]) -> dict[tuple, list[AddressBookRecord]]:
+        """
+        Returns the results of the queries, keyed by their cache keys, taking those it can from the cache
+        and running the rest as one batch. The cached results are only used if the version is unchanged
+        after the batch has run, which shows they are of the same state of the records as the batch
+        """
+        version = self.storage.data_version()
+        results = {key: self.cache.get(key, version) for key in queries}
+        missing_keys = [key for key, found_records in results.items() if found_records is None]
+
+        if not missing_keys:
+            return results
+
+        results.update(zip(missing_keys, self.storage.search_many([queries[key] for key in missing_keys])))
+
+        if len(missing_keys) < len(queries) and self.storage.data_version() != version:
+            missing_keys = list(queries)
+            results = dict(zip(missing_keys, self.storage.search_many(list(queries.values()))))
+
+        for key in missing_keys:
+            self.cache.put(key, version, results[key], records_size(results[key]))
+
+        return results
+
+    def _search(self, query: SearchQuery) -> list[AddressBookRecord]:
+        return self.storage.search(query.offset, query.limit, query.mode, **query.fields())
+
+    def _search_query(self, query: SearchQuery) -> tuple[tuple, SearchQuery]:
+        """
+        Returns the cache key of a search, along with the query to run, capped at TEXT_SEARCH_LIMIT if need be
+        """
+        if query.mode is not SearchMode.EXACT and query.limit is None:
+            query = replace(query, limit=TEXT_SEARCH_LIMIT)
+
+        return ("search", query.mode, self._query_key(query.mode, query.fields()), query.offset, query.limit), query
+
+    def _query_key(self, mode: SearchMode, fields: dict[str, str]) -> tuple[str | None, ...]:
+        """
+        Normalises the fields of a search, so searches that must match the same records share a cache entry.
+        Exact matches compare phone numbers by their canonical key, the other modes ignore ASCII case.
+        A field that is not searched is None, as a phone with no digits has an empty key (and matches nothing)
+        """
+        if mode is SearchMode.EXACT:
+            return tuple(field_key(field, fields[field]) if fields[field] else None for field in INDEXED_FIELDS)
 
-        return Response(ResponseCode.OK, found_records)
+        return tuple(fields[field].lower() if fields[field].isascii() else fields[field] for field in INDEXED_FIELDS)
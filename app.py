@@ -1,9 +1,28 @@
-from api import AddressBookAPI, ResponseCode
+from api import (AddressBookAPI, EncodedRecords, ResponseCode, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES,
+                 SEARCH_BATCH_MAX_QUERIES)
+from async_api import AsyncAddressBookAPI
 from record import AddressBookRecord
-from typing import Annotated
-from fastapi import FastAPI, Body, status
-from fastapi.responses import JSONResponse
-import uvicorn
+from serialization import encode_record
+from storage import SearchQuery, StorageBackend
+from index import SearchMode
+from phone import PhoneMatch
+from bulk import read_bulk_rows, summarise_results
+from validation import validate_rows
+from metrics import REQUEST_DURATION, SamplingProfiler
+from changes import ChangeBatch
+from typing import Annotated, Optional
+from dataclasses import asdict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, Body, Query, Request, status
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
 
 ENDPOINTS = {
     "add_record": "/add_record",
@@ -11,19 +30,189 @@ ENDPOINTS = {
     "delete_specific_record": "/delete_record",
     "delete_matching_records": "/delete_matching_records",
     "list_records": "/list_records",
-    "search_records": "/search_records"
+    "search_records": "/search_records",
+    "search_records_batch": "/search_records_batch",
+    "lookup_phone": "/lookup_phone",
+    "changes": "/changes",
+    "cache_stats": "/cache_stats",
+    "metrics": "/metrics",
+    "profile": "/profile",
+    "liveness": "/health/live",
+    "readiness": "/health/ready",
+    "bulk_add": "/bulk_add",
+    "bulk_delete": "/bulk_delete"
 }
 
-ADDRESS_BOOK_FILE_PATH = "address_book.json"
+# The database and how it is stored can be configured through environment variables,
+# e.g. ADDRESS_BOOK_BACKEND=sqlite ADDRESS_BOOK_FILE_PATH=address_book.db
+ADDRESS_BOOK_FILE_PATH = os.environ.get("ADDRESS_BOOK_FILE_PATH", "address_book.json")
+ADDRESS_BOOK_BACKEND = StorageBackend(os.environ.get("ADDRESS_BOOK_BACKEND", StorageBackend.JSON.value))
+
+# Set to write the JSON database indented for reading by hand, rather than compactly
+ADDRESS_BOOK_PRETTY_JSON = os.environ.get("ADDRESS_BOOK_PRETTY_JSON", "") not in ("", "0", "false")
+
+# The bounds of the cache of search and list results, ADDRESS_BOOK_CACHE_ENTRIES=0 disables it
+ADDRESS_BOOK_CACHE_ENTRIES = int(os.environ.get("ADDRESS_BOOK_CACHE_ENTRIES", CACHE_MAX_ENTRIES))
+ADDRESS_BOOK_CACHE_BYTES = int(os.environ.get("ADDRESS_BOOK_CACHE_BYTES", CACHE_MAX_BYTES))
+
+# The number of shards the book is split into (see sharding.py), each kept by its own worker process
+ADDRESS_BOOK_SHARDS = int(os.environ.get("ADDRESS_BOOK_SHARDS", "1"))
+
+# The number of uvicorn worker processes, which share the database if there is more than one
+ADDRESS_BOOK_WORKERS = int(os.environ.get("ADDRESS_BOOK_WORKERS", "1"))
+
+# Set to start the sampling profiler when the API starts, rather than through /profile
+ADDRESS_BOOK_PROFILE = os.environ.get("ADDRESS_BOOK_PROFILE", "") not in ("", "0", "false")
+
+# The number of records written to a streamed NDJSON response at a time
+STREAM_CHUNK_SIZE = 1000
+
+# How often (in seconds) a comment is sent on an idle change stream, so proxies do not close the connection
+CHANGE_STREAM_KEEPALIVE = 15.0
+
+# The content type of the Prometheus text exposition format
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4"
+
+# Startup phase timings are logged through uvicorn's own logger, so they appear with its startup messages
+STARTUP_LOGGER = logging.getLogger("uvicorn.error")
+
+
+def ndjson_response(records: AsyncIterator[AddressBookRecord]) -> StreamingResponse:
+    """
+    Streams the records as NDJSON, encoding them a chunk at a time as the response is sent,
+    so the whole response body is never held in memory
+    """
+    async def encode_chunks() -> AsyncIterator[str]:
+        chunk = []
+
+        async for record in records:
+            chunk.append(encode_record(record) + "\n")
+
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+
+        if chunk:
+            yield "".join(chunk)
+
+    return StreamingResponse(encode_chunks(), media_type="application/x-ndjson")
+
+
+def records_response(records: EncodedRecords) -> Response:
+    """
+    Returns records the API has already encoded (off the event loop) as the response body.
+    FastAPI does not validate or serialise a returned Response against the endpoint's response model,
+    which for a long list of records takes much longer than encoding them directly
+    """
+    return Response(records.body, media_type="application/json")
+
+
+def encoded_records_response(records: EncodedRecords, headers: dict[str, str] | None = None) -> Response:
+    """
+    Returns records that the API has already encoded (and possibly compressed) as the response body
+    """
+    headers = {"Vary": "Accept-Encoding", **(headers or {})}
+
+    if records.gzipped:
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(records.body, media_type="application/json", headers=headers)
+
+
+def accepts_gzip(request: Request) -> bool:
+    """
+    Returns whether the request's Accept-Encoding allows a gzip compressed response
+    """
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, parameters = coding.partition(";")
+
+        if name.strip().lower() in ("gzip", "*"):
+            quality = parameters.strip().removeprefix("q=")
+
+            try:
+                return not quality or float(quality) > 0
+            except ValueError:
+                return False
+
+    return False
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Returns whether the request's If-None-Match lists the ETag, compared weakly as RFC 9110 requires
+    """
+    if_none_match = request.headers.get("if-none-match")
+
+    if if_none_match is None:
+        return False
+
+    listed_tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in listed_tags or etag.removeprefix("W/") in listed_tags
+
+
+class RequestTimer:
+    """
+    ASGI middleware recording the time taken by each HTTP request in REQUEST_DURATION, until its whole body was sent.
+    Requests are labelled by the path of the endpoint that handled them, paths other than ENDPOINTS are labelled
+    "other" so unknown URLs can not add labels without limit
+    """
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.routes = set(ENDPOINTS.values())
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        response_status = status.HTTP_500_INTERNAL_SERVER_ERROR
+
+        async def send_timed(message: Message) -> None:
+            nonlocal response_status
+
+            if message["type"] == "http.response.start":
+                response_status = message["status"]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            # The router sets the matched route in the scope
+            route = getattr(scope.get("route"), "path", None)
+            REQUEST_DURATION.observe(time.perf_counter() - started, route=route if route in self.routes else "other",
+                                     method=scope["method"], status=str(response_status))
 
 
 class FastAPIWrapper:
     """
     A wrapper that contains an instance of FastAPI and the API used to interact with the database
+    The endpoints are coroutines, with calls to the API run on its own bounded pool of threads
+    /list_records sends an ETag from the data version, so polling clients get 304 Not Modified until the records change.
+    Versions restart whenever a process loads the database, so each wrapper adds its own random prefix to them.
+    Every request is timed by RequestTimer, and the timings are served by /metrics along with the API's other metrics.
+    /profile controls a sampling profiler, which runs from the start if profile is set.
+    Once the app starts, the records are loaded and their indexes built by a warm-up in the background.
+    /health/live reports the process is serving requests straight away, /health/ready only once the warm-up is done
     """
-    def __init__(self, database_file_path: str) -> None:
-        self.app = FastAPI(title="Address Book API")
-        self.api = AddressBookAPI(database_file_path)
+    def __init__(self, database_file_path: str, backend: StorageBackend = StorageBackend.JSON,
+                 shared: bool = False, pretty: bool = False, cache_max_entries: int = CACHE_MAX_ENTRIES,
+                 cache_max_bytes: int = CACHE_MAX_BYTES, profile: bool = False, shards: int = 1) -> None:
+        self.created = time.perf_counter()
+        self.app = FastAPI(title="Address Book API", lifespan=self.lifespan)
+        self.app.add_middleware(RequestTimer)
+        self.api = AsyncAddressBookAPI(AddressBookAPI(database_file_path, backend, shared, pretty,
+                                                      cache_max_entries, cache_max_bytes, shards))
+        self.etag_prefix = uuid.uuid4().hex[:12]
+        self.profiler = SamplingProfiler()
+        # The time taken by each startup phase, and the error the warm-up failed with, if it did
+        self.startup_timings: dict[str, float] = {}
+        self.warm_up_error: str | None = None
+        self.ready = False
+
+        if profile:
+            self.profiler.start()
 
         self.app.add_api_route(ENDPOINTS["add_record"], endpoint=self.add_record_endpoint, methods=["POST"])
         self.app.add_api_route(ENDPOINTS["edit_record"], endpoint=self.edit_record_endpoint, methods=["POST"])
@@ -39,35 +228,107 @@ class FastAPIWrapper:
         # but the HTTP spec does not specify that GET requests accept a body
         # and some web browsers do not allow GET with a (JSON) body
         self.app.add_api_route(ENDPOINTS["search_records"], endpoint=self.search_records_endpoint, methods=["POST"])
+        self.app.add_api_route(ENDPOINTS["search_records_batch"], endpoint=self.search_records_batch_endpoint,
+                               methods=["POST"])
+        self.app.add_api_route(ENDPOINTS["lookup_phone"], endpoint=self.lookup_phone_endpoint, methods=["GET"])
+        self.app.add_api_route(ENDPOINTS["changes"], endpoint=self.changes_endpoint, methods=["GET"])
+        self.app.add_api_route(ENDPOINTS["cache_stats"], endpoint=self.cache_stats_endpoint, methods=["GET"])
+        self.app.add_api_route(ENDPOINTS["metrics"], endpoint=self.metrics_endpoint, methods=["GET"])
+        self.app.add_api_route(ENDPOINTS["profile"], endpoint=self.profile_endpoint, methods=["GET"])
+        self.app.add_api_route(ENDPOINTS["profile"], endpoint=self.toggle_profile_endpoint, methods=["POST"])
+        self.app.add_api_route(ENDPOINTS["liveness"], endpoint=self.liveness_endpoint, methods=["GET"])
+        self.app.add_api_route(ENDPOINTS["readiness"], endpoint=self.readiness_endpoint, methods=["GET"])
+
+        # The bulk endpoints read the request body themselves so NDJSON bodies can be parsed as they stream in,
+        # bulk_delete uses POST rather than DELETE as its body is expected to be large
+        self.app.add_api_route(ENDPOINTS["bulk_add"], endpoint=self.bulk_add_endpoint, methods=["POST"])
+        self.app.add_api_route(ENDPOINTS["bulk_delete"], endpoint=self.bulk_delete_endpoint, methods=["POST"])
+
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI) -> AsyncIterator[None]:
+        # The warm-up runs alongside requests, so the app starts serving (and answering liveness probes) at once
+        warm_up = asyncio.create_task(self.warm_up())
+        yield
+        warm_up.cancel()
 
-    def add_record_endpoint(self, record_to_add: AddressBookRecord) -> JSONResponse:
-        api_result = self.api.add_record(record_to_add)
+        # The warm-up must have stopped before the threads and storage it runs on are closed
+        with suppress(asyncio.CancelledError):
+            await warm_up
+
+        # Closing the storage persists any changes still waiting to be committed, e.g. the unsynced log of a WAL book
+        self.api.close()
+        self.api.api.storage.close()
+
+    async def warm_up(self) -> None:
+        """
+        Loads the records, then builds their indexes, logging the time taken by each phase.
+        The API is reported as ready once both are done
+        """
+        phases = (("load", self.api.data_version), ("build_indexes", self.api.build_indexes))
+
+        try:
+            for phase, method in phases:
+                started = time.perf_counter()
+                await method()
+                self.startup_timings[phase] = time.perf_counter() - started
+                STARTUP_LOGGER.info("Startup phase %s took %.3fs", phase, self.startup_timings[phase])
+        except Exception as error:
+            self.warm_up_error = repr(error)
+            STARTUP_LOGGER.exception("Startup warm-up failed")
+            return
+
+        self.ready = True
+        STARTUP_LOGGER.info("Ready to serve %.3fs after the app was created", time.perf_counter() - self.created)
+
+    async def add_record_endpoint(self, record_to_add: AddressBookRecord) -> JSONResponse:
+        api_result = await self.api.add_record(record_to_add)
 
         match api_result.response_code:
             case ResponseCode.ALREADY_EXISTS:
                 return JSONResponse(status_code=status.HTTP_409_CONFLICT,
                                     content={"msg": "Record already in database"})
+            case ResponseCode.INVALID_FIELD:
+                return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                    content={"msg": f"Invalid value: {api_result.data}"})
             case ResponseCode.OK:
                 return api_result.data
 
-    def edit_record_endpoint(self, record_to_edit: AddressBookRecord, new_first_name: Annotated[str, Body()] = "",
+    async def bulk_add_endpoint(self, request: Request) -> JSONResponse:
+        try:
+            rows = await read_bulk_rows(request)
+        except ValueError as error:
+            return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                content={"msg": f"Invalid body: {error}"})
+
+        records, row_errors = validate_rows(rows)
+        api_result = await self.api.add_records(records)
+
+        return JSONResponse(summarise_results(row_errors, api_result.data,
+                                              {ResponseCode.OK: "added",
+                                               ResponseCode.ALREADY_EXISTS: "already_exists",
+                                               ResponseCode.INVALID_FIELD: "invalid"}))
+
+    async def edit_record_endpoint(self, record_to_edit: AddressBookRecord, new_first_name: Annotated[str, Body()] = "",
                              new_last_name: Annotated[str, Body()] = "", new_phone: Annotated[str, Body()] = "",
                              new_email: Annotated[str, Body()] = "") -> JSONResponse:
-        api_result = self.api.edit_record(record_to_edit, new_first_name, new_last_name,
+        api_result = await self.api.edit_record(record_to_edit, new_first_name, new_last_name,
                                           new_phone, new_email)
         
         match api_result.response_code:
             case ResponseCode.NOT_FOUND:
                 return JSONResponse(status_code=status.HTTP_404_NOT_FOUND,
                                     content={"msg": "Record not found"})
+            case ResponseCode.ALREADY_EXISTS:
+                return JSONResponse(status_code=status.HTTP_409_CONFLICT,
+                                    content={"msg": "Edited record already in database"})
             case ResponseCode.INVALID_FIELD:
                 return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                                     content={"msg": f"Invalid value: {api_result.data}"})
             case ResponseCode.OK:
                 return api_result.data
 
-    def delete_specific_record_endpoint(self, record_to_delete: AddressBookRecord) -> JSONResponse:
-        api_result = self.api.delete_specific_record(record_to_delete)
+    async def delete_specific_record_endpoint(self, record_to_delete: AddressBookRecord) -> JSONResponse:
+        api_result = await self.api.delete_specific_record(record_to_delete)
 
         match api_result.response_code:
             case ResponseCode.NOT_FOUND:
@@ -76,34 +337,194 @@ class FastAPIWrapper:
             case ResponseCode.OK:
                 return api_result.data
 
-    def delete_matching_records_endpoint(self, first_name: Annotated[str, Body()] = "",
+    async def bulk_delete_endpoint(self, request: Request) -> JSONResponse:
+        try:
+            rows = await read_bulk_rows(request)
+        except ValueError as error:
+            return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                content={"msg": f"Invalid body: {error}"})
+
+        records, row_errors = validate_rows(rows)
+        api_result = await self.api.delete_specific_records(records)
+
+        return JSONResponse(summarise_results(row_errors, api_result.data,
+                                              {ResponseCode.OK: "deleted",
+                                               ResponseCode.NOT_FOUND: "not_found"}))
+
+    async def delete_matching_records_endpoint(self, first_name: Annotated[str, Body()] = "",
                                          last_name: Annotated[str, Body()] = "",
                                          phone: Annotated[str, Body()] = "", email: Annotated[str, Body()] = ""
                                         ) -> list[AddressBookRecord]:
-        api_result = self.api.delete_matching_records(first_name, last_name, phone, email)
+        api_result = await self.api.delete_matching_records_json(first_name, last_name, phone, email)
 
         match api_result.response_code:
             case ResponseCode.OK:
-                return api_result.data
+                return records_response(api_result.data)
+
+    async def search_records_endpoint(self, request: Request, first_name: Annotated[str, Body()] = "",
+                                last_name: Annotated[str, Body()] = "", phone: Annotated[str, Body()] = "",
+                                email: Annotated[str, Body()] = "",
+                                offset: Annotated[int, Query(ge=0)] = 0,
+                                limit: Annotated[Optional[int], Query(ge=1)] = None,
+                                mode: SearchMode = SearchMode.EXACT,
+                                stream: bool = False) -> list[AddressBookRecord]:
+        if stream:
+            api_result = await self.api.stream_search_records(first_name, last_name, phone, email,
+                                                              offset, limit, mode)
+            return ndjson_response(api_result.data)
+
+        # A 304 response is only defined for GET and HEAD, so searches are compressed but not conditional
+        api_result = await self.api.search_records_json(first_name, last_name, phone, email, offset, limit, mode,
+                                                        compress=accepts_gzip(request))
+
+        match api_result.response_code:
+            case ResponseCode.OK:
+                return encoded_records_response(api_result.data)
 
-    def search_records_endpoint(self, first_name: Annotated[str, Body()] = "", last_name: Annotated[str, Body()] = "",
-                                phone: Annotated[str, Body()] = "", email: Annotated[str, Body()] = ""
-                                ) -> list[AddressBookRecord]:
-        api_result = self.api.search_records(first_name, last_name, phone, email)
+    async def search_records_batch_endpoint(self, queries: list[SearchQuery]) -> list[list[AddressBookRecord]]:
+        api_result = await self.api.search_records_batch_json(queries)
+
+        match api_result.response_code:
+            case ResponseCode.INVALID_FIELD:
+                return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                    content={"msg": f"Too many queries: {api_result.data}, "
+                                                    f"at most {SEARCH_BATCH_MAX_QUERIES} are allowed"})
+            case ResponseCode.OK:
+                return records_response(api_result.data)
+
+    async def lookup_phone_endpoint(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER,
+                                    offset: Annotated[int, Query(ge=0)] = 0,
+                                    limit: Annotated[Optional[int], Query(ge=1)] = None) -> list[AddressBookRecord]:
+        api_result = await self.api.lookup_phone_json(phone, match, offset, limit)
+
+        match api_result.response_code:
+            case ResponseCode.INVALID_FIELD:
+                return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                    content={"msg": f"Invalid phone number: {api_result.data}"})
+            case ResponseCode.OK:
+                return records_response(api_result.data)
+
+    async def list_records_endpoint(self, request: Request, offset: Annotated[int, Query(ge=0)] = 0,
+                              limit: Annotated[Optional[int], Query(ge=1)] = None,
+                              stream: bool = False) -> list[AddressBookRecord]:
+        if stream:
+            api_result = await self.api.stream_records(offset, limit)
+            return ndjson_response(api_result.data)
+
+        # The version is read before the records, so the records are never older than the ETag sent with them.
+        # Workers sharing a book tag it by its shared version, so a client polling any of them gets 304s
+        shared_version = (await self.api.shared_version()).data
+
+        if shared_version is not None:
+            etag = f'W/"shared-{shared_version}"'
+        else:
+            etag = f'W/"{self.etag_prefix}-{(await self.api.data_version()).data}"'
+
+        # The listing varies by Accept-Encoding, so its 304 has to say so too
+        if etag_matches(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                            headers={"ETag": etag, "Vary": "Accept-Encoding"})
+
+        api_result = await self.api.list_records_json(offset, limit, compress=accepts_gzip(request))
+
+        match api_result.response_code:
+            case ResponseCode.OK:
+                return encoded_records_response(api_result.data, {"ETag": etag})
+
+    async def changes_endpoint(self, request: Request, since: int, stream: bool = False) -> ChangeBatch:
+        if stream:
+            # A reconnecting EventSource sends the id of the last event it received
+            last_event_id = request.headers.get("last-event-id", "")
+            since = int(last_event_id) if last_event_id.isdigit() else since
+
+            return StreamingResponse(self.change_events(since), media_type="text/event-stream",
+                                     headers={"Cache-Control": "no-cache"})
+
+        api_result = await self.api.changes(since)
 
         match api_result.response_code:
             case ResponseCode.OK:
                 return api_result.data
 
-    def list_records_endpoint(self) -> list[AddressBookRecord]:
-        api_result = self.api.list_records()
-        
+    async def change_events(self, since: int) -> AsyncIterator[str]:
+        """
+        Sends each change after since as a server-sent event as soon as it is made, with its sequence number as the
+        event's id. If the changes are no longer known a reset event holding the latest sequence number is sent,
+        and the stream ends so the client can list the records again
+        """
+        while True:
+            api_result = await self.api.wait_for_changes(since, CHANGE_STREAM_KEEPALIVE)
+            batch = api_result.data
+
+            if batch.reset:
+                yield f"event: reset\ndata: {json.dumps({'sequence': batch.sequence})}\n\n"
+                return
+
+            if not batch.changes:
+                yield ": keep-alive\n\n"
+
+            for change in batch.changes:
+                yield f"id: {change.sequence}\nevent: change\ndata: {json.dumps(asdict(change))}\n\n"
+                since = change.sequence
+
+    async def cache_stats_endpoint(self) -> dict[str, int]:
+        api_result = await self.api.cache_stats()
+
         match api_result.response_code:
             case ResponseCode.OK:
                 return api_result.data
 
+    async def metrics_endpoint(self) -> str:
+        api_result = await self.api.metrics()
+
+        match api_result.response_code:
+            case ResponseCode.OK:
+                return PlainTextResponse(api_result.data, media_type=METRICS_MEDIA_TYPE)
+
+    async def profile_endpoint(self) -> str:
+        return PlainTextResponse(self.profiler.collapsed())
+
+    async def toggle_profile_endpoint(self, enabled: bool) -> dict[str, bool]:
+        if enabled:
+            self.profiler.start()
+        else:
+            self.profiler.stop()
+
+        return {"running": self.profiler.running}
+
+    async def liveness_endpoint(self) -> dict[str, bool]:
+        return {"alive": True}
+
+    async def readiness_endpoint(self) -> dict:
+        content = {"ready": self.ready, "timings": self.startup_timings}
+
+        if self.ready:
+            return content
+
+        if self.warm_up_error is not None:
+            content["error"] = self.warm_up_error
+
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=content)
+
+
+def create_app() -> FastAPI:
+    """
+    Builds the API configured by the environment variables above, e.g. for `uvicorn --factory app:create_app`.
+    Nothing is built when this module is imported, and the records are loaded by the warm-up once the app starts
+    """
+    started = time.perf_counter()
+    fast_api = FastAPIWrapper(ADDRESS_BOOK_FILE_PATH, ADDRESS_BOOK_BACKEND, shared=ADDRESS_BOOK_WORKERS > 1,
+                              pretty=ADDRESS_BOOK_PRETTY_JSON, cache_max_entries=ADDRESS_BOOK_CACHE_ENTRIES,
+                              cache_max_bytes=ADDRESS_BOOK_CACHE_BYTES, profile=ADDRESS_BOOK_PROFILE,
+                              shards=ADDRESS_BOOK_SHARDS)
+    fast_api.startup_timings["create_app"] = time.perf_counter() - started
+    STARTUP_LOGGER.info("Startup phase create_app took %.3fs", fast_api.startup_timings["create_app"])
+    return fast_api.app
 
-fast_api = FastAPIWrapper(ADDRESS_BOOK_FILE_PATH)
 
 if __name__ == "__main__":
-    uvicorn.run(fast_api.app)
+    # uvicorn is only needed to run the app, not to build it (e.g. in tests)
+    import uvicorn
+
+    # Each worker process imports this module and creates its own app
+    uvicorn.run("app:create_app", factory=True, workers=ADDRESS_BOOK_WORKERS)
@@ -0,0 +1,150 @@
+from api import AddressBookAPI, Response
+from record import AddressBookRecord
+from storage import SearchQuery
+from index import SearchMode
+from phone import PhoneMatch
+from typing import Any, Optional
+from collections.abc import AsyncIterator, Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import asyncio
+
+# The number of records an async stream fetches from the storage at a time
+STREAM_CHUNK_SIZE = 1000
+
+
+class AsyncAddressBookAPI:
+    """
+    Provides the methods of AddressBookAPI as coroutines, for use from an event loop.
+    Each call is run on a bounded pool of threads, so storage reads, writes and fsyncs never block the event loop,
+    and no more than max_workers threads are ever used however many calls are waiting
+    """
+    def __init__(self, api: AddressBookAPI, max_workers: int = 8) -> None:
+        self.api = api
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="AddressBookAPI")
+
+    async def add_record(self, new_record: AddressBookRecord) -> Response:
+        return await self._run(self.api.add_record, new_record)
+
+    async def add_records(self, new_records: list[AddressBookRecord]) -> Response:
+        return await self._run(self.api.add_records, new_records)
+
+    async def edit_record(self, old_record: AddressBookRecord, new_first_name: str = "", new_last_name: str = "",
+                          new_phone: str = "", new_email: str = "") -> Response:
+        return await self._run(self.api.edit_record, old_record, new_first_name, new_last_name,
+                               new_phone, new_email)
+
+    async def delete_specific_record(self, record_to_delete: AddressBookRecord) -> Response:
+        return await self._run(self.api.delete_specific_record, record_to_delete)
+
+    async def delete_specific_records(self, records_to_delete: list[AddressBookRecord]) -> Response:
+        return await self._run(self.api.delete_specific_records, records_to_delete)
+
+    async def delete_matching_records(self, first_name: str = "", last_name: str = "",
+                                      phone: str = "", email: str = "") -> Response:
+        return await self._run(self.api.delete_matching_records, first_name, last_name, phone, email)
+
+    async def delete_matching_records_json(self, first_name: str = "", last_name: str = "",
+                                           phone: str = "", email: str = "") -> Response:
+        return await self._run(self.api.delete_matching_records_json, first_name, last_name, phone, email)
+
+    async def list_records(self, offset: int = 0, limit: Optional[int] = None) -> Response:
+        return await self._run(self.api.list_records, offset, limit)
+
+    async def list_records_json(self, offset: int = 0, limit: Optional[int] = None,
+                                compress: bool = False) -> Response:
+        return await self._run(self.api.list_records_json, offset, limit, compress)
+
+    async def data_version(self) -> Response:
+        return await self._run(self.api.data_version)
+
+    async def shared_version(self) -> Response:
+        return await self._run(self.api.shared_version)
+
+    async def build_indexes(self) -> Response:
+        return await self._run(self.api.build_indexes)
+
+    async def changes(self, since: int) -> Response:
+        return await self._run(self.api.changes, since)
+
+    async def wait_for_changes(self, since: int, timeout: float) -> Response:
+        """
+        Returns the changes made after the change numbered since like changes,
+        first waiting up to timeout seconds for a change to be made if there are none yet
+        """
+        # Subscribing before fetching the changes means a change made in between still sets the event
+        with self.api.subscribe_changes() as changed:
+            api_result = await self.changes(since)
+
+            if api_result.data.reset or api_result.data.changes:
+                return api_result
+
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except TimeoutError:
+                return api_result
+
+        return await self.changes(since)
+
+    async def cache_stats(self) -> Response:
+        return await self._run(self.api.cache_stats)
+
+    async def metrics(self) -> Response:
+        return await self._run(self.api.metrics)
+
+    async def stream_records(self, offset: int = 0, limit: Optional[int] = None) -> Response:
+        """
+        Returns an async iterator over all records in the database, in the order they were added
+        """
+        api_result = await self._run(self.api.stream_records, offset, limit)
+        return Response(api_result.response_code, self._iterate(api_result.data))
+
+    async def search_records(self, first_name: str = "", last_name: str = "", phone: str = "", email: str = "",
+                             offset: int = 0, limit: Optional[int] = None,
+                             mode: SearchMode = SearchMode.EXACT) -> Response:
+        return await self._run(self.api.search_records, first_name, last_name, phone, email, offset, limit, mode)
+
+    async def search_records_json(self, first_name: str = "", last_name: str = "", phone: str = "",
+                                  email: str = "", offset: int = 0, limit: Optional[int] = None,
+                                  mode: SearchMode = SearchMode.EXACT, compress: bool = False) -> Response:
+        return await self._run(self.api.search_records_json, first_name, last_name, phone, email, offset, limit,
+                               mode, compress)
+
+    async def search_records_batch(self, queries: list[SearchQuery]) -> Response:
+        return await self._run(self.api.search_records_batch, queries)
+
+    async def search_records_batch_json(self, queries: list[SearchQuery]) -> Response:
+        return await self._run(self.api.search_records_batch_json, queries)
+
+    async def lookup_phone(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER, offset: int = 0,
+                           limit: Optional[int] = None) -> Response:
+        return await self._run(self.api.lookup_phone, phone, match, offset, limit)
+
+    async def lookup_phone_json(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER, offset: int = 0,
+                                limit: Optional[int] = None) -> Response:
+        return await self._run(self.api.lookup_phone_json, phone, match, offset, limit)
+
+    async def stream_search_records(self, first_name: str = "", last_name: str = "", phone: str = "",
+                                    email: str = "", offset: int = 0, limit: Optional[int] = None,
+                                    mode: SearchMode = SearchMode.EXACT) -> Response:
+        """
+        Returns an async iterator over all records that match the provided fields, in the order they were added
+        """
+        api_result = await self._run(self.api.stream_search_records, first_name, last_name, phone, email,
+                                     offset, limit, mode)
+        return Response(api_result.response_code, self._iterate(api_result.data))
+
+    def close(self) -> None:
+        """
+        Waits for any running calls to finish and stops the threads
+        """
+        self._executor.shutdown()
+
+    async def _run(self, method: Callable, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    async def _iterate(self, records: Iterator[AddressBookRecord]) -> AsyncIterator[AddressBookRecord]:
+        # Fetching a chunk of records can mean reading from the storage, so it is done on the pool as well
+        while chunk := await self._run(lambda: list(islice(records, STREAM_CHUNK_SIZE))):
+            for record in chunk:
+                yield record
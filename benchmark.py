@@ -0,0 +1,441 @@
+from api import AddressBookAPI, ResponseCode, CACHE_MAX_ENTRIES
+from app import FastAPIWrapper, ENDPOINTS
+from record import AddressBookRecord
+from serialization import encode_records
+from snapshot import encode_snapshot
+from storage import SearchQuery, StorageBackend, SQLiteStorage
+from index import SearchMode
+from phone import PhoneMatch
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from fastapi.testclient import TestClient
+from itertools import islice
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import httpx
+import uvicorn
+
+# ru_maxrss is only available on Unix-like systems, peak memory is not recorded elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+FIRST_NAMES = ("David", "Jason", "Ken", "Rita", "Billy", "Sarah", "Gail", "Audrey", "Steve", "Tracy", "Roy", "Hayley",
+               "Kevin", "Sally", "Emily", "Norris", "Fiz", "Tyrone", "Maria", "Carla", "Peter", "Leanne", "Nick",
+               "Toyah", "Dev", "Sunita", "Eileen", "Sean", "Mary", "Chesney")
+LAST_NAME_STARTS = ("Plat", "Grim", "Bar", "Sulli", "May", "Mitch", "Web", "Mc", "Duck", "Wind", "Con", "Night",
+                    "Al", "Bat", "Tils", "Cropp", "Flem", "Brow", "Har", "Clay")
+LAST_NAME_ENDS = ("t", "shaw", "low", "van", "hew", "ell", "ster", "donald", "worth", "ass", "nor", "ingale",
+                  "ahan", "ersby", "ley", "er", "ing", "n", "ris", "ton")
+DOMAINS = ("corrie.co.uk", "example.com", "weatherfield.org", "mail.co.uk")
+
+# The operations timed for each book, in the order they are run. The writes run last, and leave the book as it was
+OPERATIONS = ("search_records", "search_records_last_name", "search_records_prefix", "search_records_fuzzy",
+              "search_records_batch", "lookup_phone", "list_records", "stream_records", "add_record", "edit_record",
+              "delete_matching_records", "add_records", "delete_specific_record", "delete_specific_records")
+
+# The number of queries in each call timed by the search_records_batch operation
+BATCH_QUERIES = 100
+
+# The number of records in each call timed by the add_records operation, and each page read by stream_records
+BATCH_RECORDS = 100
+
+
+def generate_record(number: int, seed: int = 0) -> AddressBookRecord:
+    """
+    Generates the numbered synthetic record, which is always the same for the same number and seed.
+    Names are drawn from a small set so many records share them (as in a real book),
+    while each record's phone number and email are unique
+    """
+    # The fields are picked by the high bits of a multiplicative hash of the number, so any record
+    # can be generated on its own (e.g. to search for it) without generating the records before it
+    mixed = ((number + 1) * 0x9E3779B97F4A7C15 + seed * 0xBF58476D1CE4E5B9) % 2 ** 64 >> 32
+    first_name = FIRST_NAMES[mixed % len(FIRST_NAMES)]
+    mixed //= len(FIRST_NAMES)
+    last_name = LAST_NAME_STARTS[mixed % len(LAST_NAME_STARTS)]
+    mixed //= len(LAST_NAME_STARTS)
+    last_name += LAST_NAME_ENDS[mixed % len(LAST_NAME_ENDS)]
+    mixed //= len(LAST_NAME_ENDS)
+
+    return AddressBookRecord(first_name, last_name, f"01{number:09d}",
+                             f"{first_name}.{last_name}.{number}@{DOMAINS[mixed % len(DOMAINS)]}".lower())
+
+
+def generate_records(count: int, seed: int = 0, start: int = 0) -> Iterator[AddressBookRecord]:
+    return (generate_record(number, seed) for number in range(start, start + count))
+
+
+def write_book(path: str, backend: StorageBackend, count: int, seed: int) -> None:
+    """
+    Writes a book of count generated records in the backend's format
+    """
+    match backend:
+        case StorageBackend.JSON | StorageBackend.WAL:
+            with open(path, "wb") as book_file:
+                book_file.write(encode_records(generate_records(count, seed)))
+        case StorageBackend.SNAPSHOT:
+            with open(path, "wb") as book_file:
+                book_file.write(encode_snapshot(generate_records(count, seed)))
+        case StorageBackend.SQLITE:
+            storage = SQLiteStorage(path)
+            records = generate_records(count, seed)
+
+            while chunk := list(islice(records, 100_000)):
+                storage.add_many(chunk)
+
+            storage.close()
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """
+    Returns the nearest-rank percentile of already sorted values
+    """
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+def peak_memory() -> int | None:
+    """
+    Returns the peak resident memory of this process since it started in bytes, or None if it is not available.
+    run benchmarks each book in a process of its own, so this is the peak of that book alone
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class DirectTarget:
+    """
+    Runs the benchmarked operations by calling AddressBookAPI
+    """
+    def __init__(self, path: str, backend: StorageBackend, cache_max_entries: int) -> None:
+        self.api = AddressBookAPI(path, backend, cache_max_entries=cache_max_entries)
+
+    def search_records(self, query: SearchQuery) -> None:
+        self._check(self.api.search_records(query.first_name, query.last_name, query.phone, query.email,
+                                            query.offset, query.limit, query.mode))
+
+    def search_records_batch(self, queries: list[SearchQuery]) -> None:
+        self._check(self.api.search_records_batch(queries))
+
+    def lookup_phone(self, phone: str, match: PhoneMatch) -> None:
+        self._check(self.api.lookup_phone(phone, match))
+
+    def list_records(self, offset: int, limit: int) -> None:
+        self._check(self.api.list_records(offset, limit))
+
+    def stream_records(self, offset: int, limit: int) -> None:
+        api_result = self.api.stream_records(offset, limit)
+        self._check(api_result)
+        list(api_result.data)
+
+    def add_record(self, record: AddressBookRecord) -> None:
+        self._check(self.api.add_record(record))
+
+    def add_records(self, records: list[AddressBookRecord]) -> None:
+        self._check(self.api.add_records(records))
+
+    def edit_record(self, record: AddressBookRecord, new_phone: str) -> None:
+        self._check(self.api.edit_record(record, new_phone=new_phone))
+
+    def delete_matching_records(self, email: str) -> None:
+        self._check(self.api.delete_matching_records(email=email))
+
+    def delete_specific_record(self, record: AddressBookRecord) -> None:
+        self._check(self.api.delete_specific_record(record))
+
+    def delete_specific_records(self, records: list[AddressBookRecord]) -> None:
+        self._check(self.api.delete_specific_records(records))
+
+    def close(self) -> None:
+        self.api.storage.close()
+
+    def _check(self, api_result) -> None:
+        if api_result.response_code is not ResponseCode.OK:
+            raise RuntimeError(f"Benchmarked call failed: {api_result}")
+
+
+class HTTPTarget:
+    """
+    Runs the benchmarked operations through the endpoints of a FastAPIWrapper, either in process with TestClient
+    or over a socket to a uvicorn server running on a thread of this process
+    """
+    def __init__(self, path: str, backend: StorageBackend, cache_max_entries: int, use_uvicorn: bool) -> None:
+        self.wrapper = FastAPIWrapper(path, backend, cache_max_entries=cache_max_entries)
+        self._server = None
+
+        if not use_uvicorn:
+            self.client = TestClient(self.wrapper.app)
+            return
+
+        with socket.socket() as free_socket:
+            free_socket.bind(("127.0.0.1", 0))
+            port = free_socket.getsockname()[1]
+
+        self._server = uvicorn.Server(uvicorn.Config(self.wrapper.app, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+
+        while not self._server.started:
+            time.sleep(0.01)
+
+        self.client = httpx.Client(base_url=f"http://127.0.0.1:{port}")
+
+    def search_records(self, query: SearchQuery) -> None:
+        params = {"offset": query.offset, "mode": query.mode.value}
+
+        if query.limit is not None:
+            params["limit"] = query.limit
+
+        self._check(self.client.post(ENDPOINTS["search_records"], params=params, json=query.fields()))
+
+    def search_records_batch(self, queries: list[SearchQuery]) -> None:
+        self._check(self.client.post(ENDPOINTS["search_records_batch"],
+                                     json=[{**asdict(query), "mode": query.mode.value} for query in queries]))
+
+    def lookup_phone(self, phone: str, match: PhoneMatch) -> None:
+        self._check(self.client.get(ENDPOINTS["lookup_phone"], params={"phone": phone, "match": match.value}))
+
+    def list_records(self, offset: int, limit: int) -> None:
+        self._check(self.client.get(ENDPOINTS["list_records"], params={"offset": offset, "limit": limit}))
+
+    def stream_records(self, offset: int, limit: int) -> None:
+        self._check(self.client.get(ENDPOINTS["list_records"],
+                                    params={"offset": offset, "limit": limit, "stream": True}))
+
+    def add_record(self, record: AddressBookRecord) -> None:
+        self._check(self.client.post(ENDPOINTS["add_record"], json=asdict(record)))
+
+    def add_records(self, records: list[AddressBookRecord]) -> None:
+        self._check(self.client.post(ENDPOINTS["bulk_add"], json=[asdict(record) for record in records]))
+
+    def edit_record(self, record: AddressBookRecord, new_phone: str) -> None:
+        self._check(self.client.post(ENDPOINTS["edit_record"],
+                                     json={"record_to_edit": asdict(record), "new_phone": new_phone}))
+
+    def delete_matching_records(self, email: str) -> None:
+        self._check(self.client.request("DELETE", ENDPOINTS["delete_matching_records"], json={"email": email}))
+
+    def delete_specific_record(self, record: AddressBookRecord) -> None:
+        self._check(self.client.request("DELETE", ENDPOINTS["delete_specific_record"], json=asdict(record)))
+
+    def delete_specific_records(self, records: list[AddressBookRecord]) -> None:
+        self._check(self.client.post(ENDPOINTS["bulk_delete"], json=[asdict(record) for record in records]))
+
+    def close(self) -> None:
+        self.client.close()
+
+        # Stopping the server runs the app's lifespan teardown, which closes the API and its storage
+        if self._server is not None:
+            self._server.should_exit = True
+            self._thread.join()
+            return
+
+        self.wrapper.api.close()
+        self.wrapper.api.api.storage.close()
+
+    def _check(self, response: httpx.Response) -> None:
+        if response.status_code != 200:
+            raise RuntimeError(f"Benchmarked request failed: {response.status_code} {response.text}")
+
+
+@dataclass
+class BookResult:
+    """The results of benchmarking one book"""
+    target: str
+    backend: str
+    records: int
+    load_seconds: float
+    peak_memory_bytes: int | None
+    operations: dict[str, dict] = field(default_factory=dict)
+
+
+def time_operation(call: Callable[[int], None], iterations: int, concurrency: int) -> dict:
+    """
+    Calls call(i) for each i in range(iterations) from concurrency threads, timing each call
+    """
+    def timed_call(iteration: int) -> int:
+        started = time.perf_counter_ns()
+        call(iteration)
+        return time.perf_counter_ns() - started
+
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(nanoseconds / 1_000_000 for nanoseconds in executor.map(timed_call, range(iterations)))
+
+    seconds = time.perf_counter() - started
+
+    return {"calls": iterations, "seconds": seconds, "throughput": iterations / seconds,
+            "latency_ms": {"mean": sum(latencies) / iterations, "p50": percentile(latencies, 0.5),
+                           "p90": percentile(latencies, 0.9), "p99": percentile(latencies, 0.99),
+                           "max": latencies[-1]}}
+
+
+def benchmark_book(target_name: str, backend: StorageBackend, count: int, iterations: int, concurrency: int,
+                   cache_max_entries: int, seed: int, path: str) -> BookResult:
+    """
+    Times each operation against the book of count generated records written to path by write_book
+    """
+    # Loading is timed by the first search, as the in-memory storages load the book when it is first used
+    started = time.perf_counter()
+    target = DirectTarget(path, backend, cache_max_entries) if target_name == "direct" else \
+        HTTPTarget(path, backend, cache_max_entries, use_uvicorn=target_name == "uvicorn")
+    target.list_records(0, 1)
+    load_seconds = time.perf_counter() - started
+
+    # Queries are for records picked at random, so most of them miss the result cache
+    rng = random.Random(seed)
+    sample = [generate_record(rng.randrange(count), seed) for _ in range(iterations)]
+    new_records = list(generate_records(iterations, seed, count))
+    new_batches = [list(generate_records(BATCH_RECORDS, seed, count + iterations + i * BATCH_RECORDS))
+                   for i in range(iterations)]
+    operations = {
+        "search_records": lambda i: target.search_records(SearchQuery(email=sample[i].email)),
+        "search_records_last_name": lambda i: target.search_records(SearchQuery(last_name=sample[i].last_name,
+                                                                                limit=50)),
+        "search_records_prefix": lambda i: target.search_records(SearchQuery(last_name=sample[i].last_name[:3],
+                                                                             mode=SearchMode.PREFIX)),
+        "search_records_fuzzy": lambda i: target.search_records(SearchQuery(last_name=sample[i].last_name[1:],
+                                                                            mode=SearchMode.FUZZY)),
+        "search_records_batch": lambda i: target.search_records_batch(
+            [SearchQuery(email=sample[(i + query) % iterations].email) for query in range(BATCH_QUERIES)]),
+        "lookup_phone": lambda i: target.lookup_phone(sample[i].phone[-6:], PhoneMatch.SUFFIX),
+        "list_records": lambda i: target.list_records(rng.randrange(count), 100),
+        "stream_records": lambda i: target.stream_records(rng.randrange(count), BATCH_RECORDS),
+        "add_record": lambda i: target.add_record(new_records[i]),
+        "edit_record": lambda i: target.edit_record(new_records[i], new_records[i].phone + "9"),
+        "delete_matching_records": lambda i: target.delete_matching_records(new_records[i].email),
+        # Each batch added is deleted again, its first record on its own and the rest together
+        "add_records": lambda i: target.add_records(new_batches[i]),
+        "delete_specific_record": lambda i: target.delete_specific_record(new_batches[i][0]),
+        "delete_specific_records": lambda i: target.delete_specific_records(new_batches[i][1:])
+    }
+
+    result = BookResult(target_name, backend.value, count, load_seconds, None)
+
+    try:
+        for name in OPERATIONS:
+            result.operations[name] = time_operation(operations[name], iterations, concurrency)
+    finally:
+        target.close()
+
+    result.peak_memory_bytes = peak_memory()
+    return result
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes: list[int], targets: list[str], backends: list[StorageBackend], iterations: int = 200,
+        concurrency: int = 1, cache_max_entries: int = CACHE_MAX_ENTRIES, seed: int = 0,
+        progress: bool = False) -> dict:
+    """
+    Benchmarks every combination of book size, target and backend, smallest books first.
+    Each book is written and then benchmarked in new processes of their own, so its peak memory
+    is neither that of an earlier, larger book nor that of generating the book.
+    Returns the results along with the commit and machine they were measured on.
+    If progress is set, each finished book is reported on stderr
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory, \
+            ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1) as executor:
+        for count in sorted(sizes):
+            for target_name in targets:
+                for backend in backends:
+                    path = os.path.join(directory, f"benchmark_{count}_{target_name}_{backend.value}")
+                    executor.submit(write_book, path, backend, count, seed).result()
+                    results.append(executor.submit(benchmark_book, target_name, backend, count, iterations,
+                                                   concurrency, cache_max_entries, seed, path).result())
+
+                    if progress:
+                        print(f"{target_name} {backend.value} {count} records: done", file=sys.stderr)
+
+    return {"metadata": {"commit": git_commit(), "python": platform.python_version(), "machine": platform.platform(),
+                         "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                         "iterations": iterations, "concurrency": concurrency,
+                         "cache_max_entries": cache_max_entries, "seed": seed},
+            "results": [asdict(result) for result in results]}
+
+
+def compare(baseline: dict, current: dict) -> list[str]:
+    """
+    Returns a line for each operation benchmarked in both runs, giving the change in its median latency and throughput
+    """
+    def operations(run_results: dict) -> dict[tuple, dict]:
+        return {(result["target"], result["backend"], result["records"], name): timing
+                for result in run_results["results"] for name, timing in result["operations"].items()}
+
+    baseline_operations = operations(baseline)
+    lines = []
+
+    for key, timing in operations(current).items():
+        if key not in baseline_operations:
+            continue
+
+        old_timing = baseline_operations[key]
+        latency_change = timing["latency_ms"]["p50"] / old_timing["latency_ms"]["p50"] - 1
+        throughput_change = timing["throughput"] / old_timing["throughput"] - 1
+        lines.append(f"{' '.join(map(str, key))}: p50 {timing['latency_ms']['p50']:.3f}ms ({latency_change:+.1%}), "
+                     f"throughput {timing['throughput']:.0f}/s ({throughput_change:+.1%})")
+
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the address book API and storage backends")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Benchmarks generated books and writes the results as JSON")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                            help="The number of records in each book, e.g. 1000 10000000")
+    run_parser.add_argument("--targets", nargs="+", choices=("direct", "testclient", "uvicorn"), default=["direct"],
+                            help="Call AddressBookAPI directly, or its endpoints through TestClient or uvicorn")
+    run_parser.add_argument("--backends", type=StorageBackend, nargs="+", default=[StorageBackend.JSON],
+                            help="The storage backends to benchmark (json, wal, sqlite or snapshot)")
+    run_parser.add_argument("--iterations", type=int, default=200, help="The number of calls of each operation")
+    run_parser.add_argument("--concurrency", type=int, default=1, help="The number of threads making calls")
+    run_parser.add_argument("--cache-entries", type=int, default=CACHE_MAX_ENTRIES,
+                            help="The size of the result cache, 0 disables it")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seeds the generated records and queries")
+    run_parser.add_argument("--output", help="Where to write the results, printed if not given")
+
+    compare_parser = subparsers.add_parser("compare", help="Compares the results of two runs")
+    compare_parser.add_argument("baseline", help="The results of the earlier run, e.g. from the previous commit")
+    compare_parser.add_argument("current", help="The results of the later run")
+
+    arguments = parser.parse_args()
+
+    if arguments.command == "compare":
+        with open(arguments.baseline) as baseline_file, open(arguments.current) as current_file:
+            print("\n".join(compare(json.load(baseline_file), json.load(current_file))))
+    else:
+        benchmark_results = run(arguments.sizes, arguments.targets, arguments.backends, arguments.iterations,
+                                arguments.concurrency, arguments.cache_entries, arguments.seed, progress=True)
+
+        if arguments.output is None:
+            print(json.dumps(benchmark_results, indent=4))
+        else:
+            with open(arguments.output, "w") as output_file:
+                json.dump(benchmark_results, output_file, indent=4)
@@ -0,0 +1,63 @@
+from api import Response, ResponseCode
+from typing import Any
+from collections import Counter
+from fastapi import Request
+import json
+
+# Bulk request bodies sent with one of these content types are read as NDJSON, anything else as a JSON array
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+async def read_bulk_rows(request: Request) -> list[Any]:
+    """
+    Reads the rows of a bulk request body, either NDJSON (one JSON record per line) or a JSON array.
+    NDJSON is decoded a line at a time as the body is streamed in, a line that is not valid JSON
+    is returned as the JSONDecodeError raised for it.
+    Raises a ValueError if a JSON array body is not valid
+    """
+    media_type = request.headers.get("content-type", "").split(";")[0].strip()
+
+    if media_type not in NDJSON_MEDIA_TYPES:
+        rows = json.loads(await request.body())
+
+        if not isinstance(rows, list):
+            raise ValueError("Expected a JSON array of records")
+
+        return rows
+
+    rows = []
+    unfinished_line = b""
+
+    async for chunk in request.stream():
+        *lines, unfinished_line = (unfinished_line + chunk).split(b"\n")
+        rows.extend(decode_line(line) for line in lines if line.strip())
+
+    if unfinished_line.strip():
+        rows.append(decode_line(unfinished_line))
+
+    return rows
+
+
+def decode_line(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as error:
+        return error
+
+
+def summarise_results(row_errors: list[str | None], record_responses: list[Response],
+                      statuses: dict[ResponseCode, str]) -> dict:
+    """
+    Builds the response body of a bulk endpoint, with a count of each status and the status of each row.
+    statuses names the status reported for each response code returned by the API
+    """
+    responses = iter(record_responses)
+    results = []
+
+    for row, error in enumerate(row_errors):
+        if error is None:
+            results.append({"row": row, "status": statuses[next(responses).response_code]})
+        else:
+            results.append({"row": row, "status": "invalid", "msg": error})
+
+    return {"summary": Counter(result["status"] for result in results), "results": results}
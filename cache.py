@@ -0,0 +1,91 @@
+from record import AddressBookRecord
+from metrics import CACHE_LOOKUPS
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any
+import threading
+
+# A rough count of the bytes each cached record takes beyond the characters of its fields
+# (the record object, its four strings and its reference in the list)
+RECORD_OVERHEAD_BYTES = 250
+
+
+def records_size(records: list[AddressBookRecord]) -> int:
+    """
+    Estimates the memory taken by a list of records, for bounding the size of a ResultCache
+    """
+    return sum(len(record.first_name) + len(record.last_name) + len(record.phone) + len(record.email)
+               for record in records) + RECORD_OVERHEAD_BYTES * len(records)
+
+
+class ResultCache:
+    """
+    LRU cache of query results, bounded by both its number of entries and their total size in bytes.
+    Results are cached for a data version (see StorageEngine.data_version) and only returned for that version.
+    Once a newer version is seen every entry is dropped, so a change to the records is never hidden by the cache.
+    Lookups and insertions are thread-safe, the hit and miss counters can be used to tune the bounds
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._bytes = 0
+        self._version = 0
+
+    def get(self, key: Hashable, version: int) -> Any | None:
+        """
+        Returns the result cached for the key at the version, or None if there is none
+        """
+        with self._lock:
+            self._see_version(version)
+            entry = self._entries.get(key) if version == self._version else None
+
+            if entry is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result="hit")
+            return entry[0]
+
+    def put(self, key: Hashable, version: int, value: Any, size: int) -> None:
+        """
+        Caches a result computed at the version, evicting the least recently used results to make room.
+        Results of an older version than the cache has seen, or larger than max_bytes, are not cached
+        """
+        with self._lock:
+            self._see_version(version)
+
+            if version != self._version or size > self.max_bytes or self.max_entries <= 0:
+                return
+
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes,
+                    "max_entries": self.max_entries, "max_bytes": self.max_bytes}
+
+    def _see_version(self, version: int) -> None:
+        if version > self._version:
+            self._version = version
+            self._entries.clear()
+            self._bytes = 0
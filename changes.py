@@ -0,0 +1,133 @@
+from record import AddressBookRecord
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Optional
+import asyncio
+import threading
+import time
+
+# The number of changes a ChangeLog retains, clients further behind than this have to list the records again
+CHANGE_LOG_MAX_ENTRIES = 10_000
+
+
+@dataclass(slots=True)
+class Change:
+    """
+    A change to the records. record is the added or deleted record, or the record that was replaced by new_record
+    """
+    sequence: int
+    operation: str
+    record: AddressBookRecord
+    new_record: Optional[AddressBookRecord] = None
+
+
+@dataclass
+class ChangeBatch:
+    """
+    The changes made after a sequence number, and the sequence number of the latest change.
+    If reset is set the changes after the sequence number are no longer known, so changes is empty and the client
+    must list the records again, then continue from the returned sequence number
+    """
+    sequence: int
+    reset: bool = False
+    changes: list[Change] = field(default_factory=list)
+
+
+class ChangeLog:
+    """
+    Assigns each change to the records a sequence number, retaining the latest max_entries changes in memory
+    so clients mirroring the records can fetch only what changed since the last change they saw.
+
+    Sequence numbers start from the clock (in microseconds) rather than 0, so they keep increasing when the
+    process restarts and a sequence number from an earlier process is seen as too old rather than mistaken
+    for a newer change. Changes the log can not account for (e.g. the file was edited, or another process
+    committed) reset it, making every earlier sequence number too old.
+
+    Coroutines can subscribe to be woken as soon as the log changes, changes are recorded from any thread
+    """
+    def __init__(self, max_entries: int = CHANGE_LOG_MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries: deque[Change] = deque(maxlen=max_entries)
+        self._sequence = time.time_ns() // 1000
+        # The sequence number of the oldest change that is retained, or of the next change if none are
+        self._first = self._sequence + 1
+        self._subscribers: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    @property
+    def sequence(self) -> int:
+        return self._sequence
+
+    def record(self, changes: list[tuple]) -> None:
+        """
+        Records changes made to the records, as the (operation, record(s)) tuples passed to the storage's commit.
+        Must be called in the order the changes were made
+        """
+        if not changes:
+            return
+
+        with self._lock:
+            for operation, *records in changes:
+                self._sequence += 1
+                self._entries.append(Change(self._sequence, operation, *records))
+
+            self._first = max(self._first, self._sequence - self.max_entries + 1)
+
+        self._notify()
+
+    def reset(self) -> None:
+        """
+        Forgets every retained change, so clients have to list the records again.
+        The reset takes a sequence number of its own, so clients that had seen the latest change are reset too
+        """
+        with self._lock:
+            self._entries.clear()
+            self._sequence += 1
+            self._first = self._sequence + 1
+
+        self._notify()
+
+    def since(self, sequence: int) -> ChangeBatch:
+        """
+        Returns the changes made after the change numbered sequence, oldest first
+        """
+        with self._lock:
+            if not self._first - 1 <= sequence <= self._sequence:
+                return ChangeBatch(self._sequence, reset=True)
+
+            # Clients are usually close to the latest change, so the changes are taken from the newest end
+            changes = list(islice(reversed(self._entries), self._sequence - sequence))
+            changes.reverse()
+            return ChangeBatch(self._sequence, changes=changes)
+
+    @contextmanager
+    def subscribe(self) -> Iterator[asyncio.Event]:
+        """
+        Yields an event, set whenever a change is recorded or the log is reset while the context is open.
+        Must be called from a coroutine, the event belongs to its event loop
+        """
+        subscriber = (asyncio.get_running_loop(), asyncio.Event())
+
+        with self._lock:
+            self._subscribers.add(subscriber)
+
+        try:
+            yield subscriber[1]
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def _notify(self) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for loop, event in subscribers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The subscriber's loop has closed
+                pass
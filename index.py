@@ -0,0 +1,343 @@
+from record import AddressBookRecord
+from phone import PhoneMatch, PHONE_SUFFIX_MIN_DIGITS, normalize_phone, phone_digits
+from enum import Enum
+from bisect import bisect_left, insort
+from collections import Counter
+from collections.abc import Iterable, Iterator
+import heapq
+
+INDEXED_FIELDS = ("first_name", "last_name", "phone", "email")
+
+
+def field_key(field: str, value: str) -> str:
+    """
+    Returns the value an exact match on the field compares, phone numbers are compared by their canonical key
+    """
+    return normalize_phone(value) if field == "phone" else value
+
+
+class FieldIndex:
+    """
+    Secondary index mapping the value of each record field (see field_key) to the ids of the records holding it.
+    Most phone numbers and emails belong to a single record, so a value held by one record maps to its id
+    rather than to a set, which would take several times the memory.
+    It is up to the owner of the records to keep the index in step as records are added and removed
+    """
+    def __init__(self) -> None:
+        self._postings: dict[str, dict[str, int | set[int]]] = {field: {} for field in INDEXED_FIELDS}
+
+    def add(self, record_id: int, record: AddressBookRecord) -> None:
+        for field, postings in self._postings.items():
+            value = field_key(field, getattr(record, field))
+            record_ids = postings.get(value)
+
+            if record_ids is None:
+                postings[value] = record_id
+            elif isinstance(record_ids, set):
+                record_ids.add(record_id)
+            else:
+                postings[value] = {record_ids, record_id}
+
+    def remove(self, record_id: int, record: AddressBookRecord) -> None:
+        for field, postings in self._postings.items():
+            value = field_key(field, getattr(record, field))
+            record_ids = postings[value]
+
+            if not isinstance(record_ids, set):
+                del postings[value]
+                continue
+
+            record_ids.discard(record_id)
+
+            if len(record_ids) == 1:
+                postings[value] = next(iter(record_ids))
+
+    def clear(self) -> None:
+        for postings in self._postings.values():
+            postings.clear()
+
+    def lookup(self, **fields: str) -> set[int]:
+        """
+        Returns the ids of the records matching every provided (non-empty) field.
+        The posting sets are intersected starting with the smallest,
+        so the cost depends on the rarest value rather than the number of records
+        """
+        postings = sorted((self._ids(field, field_key(field, value)) for field, value in fields.items() if value),
+                          key=len)
+
+        if not postings:
+            raise ValueError("At least one field must be provided")
+
+        matching_ids = set(postings[0])
+
+        for record_ids in postings[1:]:
+            if not matching_ids:
+                break
+            matching_ids &= record_ids
+
+        return matching_ids
+
+    def _ids(self, field: str, value: str) -> set[int]:
+        # A phone with no digits has an empty key, and matches no number
+        if field == "phone" and not value:
+            return set()
+
+        record_ids = self._postings[field].get(value, set())
+        return record_ids if isinstance(record_ids, set) else {record_ids}
+
+
+class SearchMode(Enum):
+    """How the fields of a search are matched against the fields of a record"""
+    EXACT = "exact"
+    IGNORE_CASE = "ignore_case"
+    PREFIX = "prefix"
+    SUBSTRING = "substring"
+    FUZZY = "fuzzy"
+
+
+# The largest number of single character edits for a FUZZY search to still match
+FUZZY_MAX_DISTANCE = 2
+
+# Values are padded before being split into trigrams, so short values and their first and last characters
+# still have trigrams of their own. Record fields can not contain the padding character
+TRIGRAM_PADDING = "\0"
+
+
+def trigrams(value: str, padded: bool = True) -> set[str]:
+    if padded:
+        value = TRIGRAM_PADDING * 2 + value + TRIGRAM_PADDING
+    return {value[start:start + 3] for start in range(len(value) - 2)}
+
+
+def bounded_edit_distance(first: str, second: str, max_distance: int) -> int | None:
+    """
+    Returns the Levenshtein distance between the two strings, or None if it is more than max_distance.
+    Stops as soon as every alignment is known to need more than max_distance edits
+    """
+    if abs(len(first) - len(second)) > max_distance:
+        return None
+
+    previous_row = list(range(len(second) + 1))
+
+    for row, first_character in enumerate(first, 1):
+        current_row = [row]
+
+        for column, second_character in enumerate(second, 1):
+            current_row.append(min(previous_row[column] + 1, current_row[column - 1] + 1,
+                                   previous_row[column - 1] + (first_character != second_character)))
+
+        if min(current_row) > max_distance:
+            return None
+
+        previous_row = current_row
+
+    return previous_row[-1] if previous_row[-1] <= max_distance else None
+
+
+class TextIndex:
+    """
+    Case-insensitive index of one record field, used for every SearchMode except EXACT.
+    The distinct casefolded values of the field are kept in a sorted list for prefix matching,
+    and in a posting set for each of their trigrams for substring and fuzzy matching,
+    so the cost of a search depends on the number of values it could match rather than the number of records.
+    The ids of the records holding each value are kept sorted, so matches can be walked in id order
+    """
+    def __init__(self, field: str, records: Iterable[tuple[int, AddressBookRecord]] = ()) -> None:
+        self.field = field
+        self._ids_by_value: dict[str, list[int]] = {}
+        self._values_by_trigram: dict[str, set[str]] = {}
+
+        # Sorting the values once is much faster than inserting them into the sorted list one by one
+        for record_id, record in records:
+            self._add_value(record_id, getattr(record, field).casefold())
+
+        self._sorted_values = sorted(self._ids_by_value)
+
+    def add(self, record_id: int, record: AddressBookRecord) -> None:
+        value = getattr(record, self.field).casefold()
+
+        if value not in self._ids_by_value:
+            insort(self._sorted_values, value)
+
+        self._add_value(record_id, value)
+
+    def remove(self, record_id: int, record: AddressBookRecord) -> None:
+        value = getattr(record, self.field).casefold()
+        record_ids = self._ids_by_value[value]
+        position = bisect_left(record_ids, record_id)
+
+        if position < len(record_ids) and record_ids[position] == record_id:
+            del record_ids[position]
+
+        if record_ids:
+            return
+
+        del self._ids_by_value[value]
+        del self._sorted_values[bisect_left(self._sorted_values, value)]
+
+        for trigram in trigrams(value):
+            values = self._values_by_trigram[trigram]
+            values.discard(value)
+
+            if not values:
+                del self._values_by_trigram[trigram]
+
+    def lookup(self, query: str, mode: SearchMode) -> dict[int, int]:
+        """
+        Returns the ids of the records whose field matches the query, mapped to the edit distance between them
+        (which is always 0 unless mode is FUZZY)
+        """
+        query = query.casefold()
+        ids_by_value = self._ids_by_value
+
+        match mode:
+            case SearchMode.IGNORE_CASE | SearchMode.PREFIX | SearchMode.SUBSTRING:
+                distances = dict.fromkeys(self._matching_values(query, mode), 0)
+            case SearchMode.FUZZY:
+                distances = {}
+
+                for value in self._fuzzy_candidates(query):
+                    distance = bounded_edit_distance(query, value, FUZZY_MAX_DISTANCE)
+
+                    if distance is not None:
+                        distances[value] = distance
+            case _:
+                raise ValueError(f"{mode} searches are not answered by the text index")
+
+        return {record_id: distance for value, distance in distances.items() for record_id in ids_by_value[value]}
+
+    def ordered_lookup(self, query: str, mode: SearchMode) -> Iterator[int]:
+        """
+        Returns an iterator over the ids of the records whose field matches the query, in increasing order.
+        The ids of the matching values are merged as they are read, so stopping early does not find every match.
+        Only for the modes that match at distance 0, so the order of the ids is the order of the results
+        """
+        if mode is SearchMode.FUZZY:
+            raise ValueError(f"{mode} matches are ranked by distance, not id")
+
+        query = query.casefold()
+        return heapq.merge(*(self._ids_by_value[value] for value in self._matching_values(query, mode)))
+
+    def _matching_values(self, query: str, mode: SearchMode) -> Iterable[str]:
+        match mode:
+            case SearchMode.IGNORE_CASE:
+                return (query,) if query in self._ids_by_value else ()
+            case SearchMode.PREFIX:
+                return self._prefixed_values(query)
+            case SearchMode.SUBSTRING:
+                return (value for value in self._substring_candidates(query) if query in value)
+            case _:
+                raise ValueError(f"{mode} searches are not answered by the text index")
+
+    def _prefixed_values(self, prefix: str) -> Iterator[str]:
+        sorted_values = self._sorted_values
+
+        for position in range(bisect_left(sorted_values, prefix), len(sorted_values)):
+            if not sorted_values[position].startswith(prefix):
+                return
+            yield sorted_values[position]
+
+    def _substring_candidates(self, query: str) -> Iterable[str]:
+        query_trigrams = trigrams(query, padded=False)
+
+        # Queries shorter than a trigram have to be checked against every value
+        if not query_trigrams:
+            return self._ids_by_value.keys()
+
+        postings = sorted((self._values_by_trigram.get(trigram, set()) for trigram in query_trigrams), key=len)
+        return set(postings[0]).intersection(*postings[1:])
+
+    def _fuzzy_candidates(self, query: str) -> Iterable[str]:
+        # Each edit changes at most three trigrams, so a value within the maximum distance
+        # must share at least this many trigrams with the query
+        query_trigrams = trigrams(query)
+        min_shared_trigrams = len(query_trigrams) - 3 * FUZZY_MAX_DISTANCE
+
+        if min_shared_trigrams <= 0:
+            return self._ids_by_value.keys()
+
+        shared_trigrams = Counter(value for trigram in query_trigrams
+                                  for value in self._values_by_trigram.get(trigram, ()))
+
+        return [value for value, count in shared_trigrams.items() if count >= min_shared_trigrams]
+
+    def _add_value(self, record_id: int, value: str) -> None:
+        if value not in self._ids_by_value:
+            self._ids_by_value[value] = []
+
+            for trigram in trigrams(value):
+                self._values_by_trigram.setdefault(trigram, set()).add(value)
+
+        # Rows are almost always added with the highest id yet, so this is usually an append
+        insort(self._ids_by_value[value], record_id)
+
+
+class PhoneIndex:
+    """
+    Index of the canonical phone numbers of the records (see phone.normalize_phone) for caller-ID lookups.
+    Every trailing run of at least PHONE_SUFFIX_MIN_DIGITS digits of each number is a dictionary key,
+    and area codes are found by bisecting a sorted list of the numbers.
+    Full numbers are already keyed by FieldIndex, so are not indexed again
+    """
+    def __init__(self, records: Iterable[tuple[int, AddressBookRecord]] = ()) -> None:
+        self._ids_by_number: dict[str, set[int]] = {}
+        self._ids_by_suffix: dict[str, set[int]] = {}
+
+        for record_id, record in records:
+            self._add_number(record_id, normalize_phone(record.phone))
+
+        self._sorted_numbers = sorted(self._ids_by_number)
+
+    def add(self, record_id: int, record: AddressBookRecord) -> None:
+        number = normalize_phone(record.phone)
+
+        if number not in self._ids_by_number:
+            insort(self._sorted_numbers, number)
+
+        self._add_number(record_id, number)
+
+    def remove(self, record_id: int, record: AddressBookRecord) -> None:
+        number = normalize_phone(record.phone)
+        self._ids_by_number[number].discard(record_id)
+
+        for suffix in self._suffixes(number):
+            record_ids = self._ids_by_suffix[suffix]
+            record_ids.discard(record_id)
+
+            if not record_ids:
+                del self._ids_by_suffix[suffix]
+
+        if not self._ids_by_number[number]:
+            del self._ids_by_number[number]
+            del self._sorted_numbers[bisect_left(self._sorted_numbers, number)]
+
+    def lookup(self, phone: str, match: PhoneMatch) -> set[int]:
+        """
+        Returns the ids of the records whose number ends with the digits of phone (SUFFIX),
+        or starts with the canonical key of phone (AREA_CODE)
+        """
+        match match:
+            case PhoneMatch.SUFFIX:
+                return set(self._ids_by_suffix.get(phone_digits(phone), ()))
+            case PhoneMatch.AREA_CODE:
+                area_code = normalize_phone(phone)
+                matching_ids = set()
+
+                for position in range(bisect_left(self._sorted_numbers, area_code), len(self._sorted_numbers)):
+                    if not self._sorted_numbers[position].startswith(area_code):
+                        break
+                    matching_ids |= self._ids_by_number[self._sorted_numbers[position]]
+
+                return matching_ids
+            case _:
+                raise ValueError(f"{match} lookups are answered by FieldIndex")
+
+    def _add_number(self, record_id: int, number: str) -> None:
+        self._ids_by_number.setdefault(number, set()).add(record_id)
+
+        for suffix in self._suffixes(number):
+            self._ids_by_suffix.setdefault(suffix, set()).add(record_id)
+
+    def _suffixes(self, number: str) -> list[str]:
+        digits = phone_digits(number)
+        return [digits[-length:] for length in range(PHONE_SUFFIX_MIN_DIGITS, len(digits) + 1)]
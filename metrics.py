@@ -0,0 +1,279 @@
+from bisect import bisect_left
+from collections import Counter as SampleCounter
+from collections.abc import Iterator
+from typing import Any
+import os
+import sys
+import threading
+import time
+
+# Upper bounds (in seconds) of the buckets of the duration histograms, from well under a millisecond to 10 seconds
+DURATION_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The interval (in seconds) at which SamplingProfiler samples the stacks of the running threads
+PROFILE_INTERVAL = 0.005
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    A Prometheus counter, holding a total for each combination of its labels' values
+    """
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._totals: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.label_names)
+
+        with self._lock:
+            self._totals[key] = self._totals.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._totals.get(tuple(labels[name] for name in self.label_names), 0)
+
+    def state(self) -> dict[tuple[str, ...], float]:
+        """
+        Returns a copy of the total of each combination of labels, which can be sent to another process
+        """
+        with self._lock:
+            return dict(self._totals)
+
+    def render(self, other_states: list[dict] = ()) -> Iterator[str]:
+        """
+        Renders the totals, added to those of the other states (of the same counter in other processes)
+        """
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+
+        totals = self.state()
+
+        for other_state in other_states:
+            for key, total in other_state.items():
+                totals[key] = totals.get(key, 0) + total
+
+        for key, total in totals.items():
+            yield f"{self.name}{_labels(self.label_names, key)} {total}"
+
+
+class Histogram:
+    """
+    A Prometheus histogram, counting observations into cumulative buckets for each combination of its labels' values
+    """
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DURATION_BUCKETS) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # The count of each bucket (observations above the last bound are only in the total count), sum and count
+        self._series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.label_names)
+
+        with self._lock:
+            series = self._series.get(key)
+
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            position = bisect_left(self.buckets, value)
+
+            if position < len(self.buckets):
+                series[0][position] += 1
+
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(tuple(labels[name] for name in self.label_names))
+        return 0 if series is None else series[2]
+
+    def state(self) -> dict[tuple[str, ...], list]:
+        """
+        Returns a copy of the bucket counts, sum and count of each combination of labels,
+        which can be sent to another process
+        """
+        with self._lock:
+            return {key: [list(bucket_counts), total, count]
+                    for key, (bucket_counts, total, count) in self._series.items()}
+
+    def render(self, other_states: list[dict] = ()) -> Iterator[str]:
+        """
+        Renders the series, added to those of the other states (of the same histogram in other processes)
+        """
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+
+        series = self.state()
+
+        for other_state in other_states:
+            for key, (bucket_counts, total, count) in other_state.items():
+                merged = series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+                merged[0] = [merged_count + other_count for merged_count, other_count in zip(merged[0], bucket_counts)]
+                merged[1] += total
+                merged[2] += count
+
+        for key, (bucket_counts, total, count) in series.items():
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                bound_label = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, key, bound_label)} {cumulative}"
+
+            inf_label = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.label_names, key, inf_label)} {count}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {total}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {count}"
+
+
+class Registry:
+    """
+    The metrics of the process, rendered together in the Prometheus text format
+    """
+    def __init__(self) -> None:
+        self.metrics: list[Counter | Histogram] = []
+
+    def counter(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> Counter:
+        self.metrics.append(Counter(name, help_text, label_names))
+        return self.metrics[-1]
+
+    def histogram(self, name: str, help_text: str, label_names: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DURATION_BUCKETS) -> Histogram:
+        self.metrics.append(Histogram(name, help_text, label_names, buckets))
+        return self.metrics[-1]
+
+    def state(self) -> dict[str, dict]:
+        """
+        Returns a copy of the state of every metric by name, e.g. to be rendered by a parent process
+        """
+        return {metric.name: metric.state() for metric in self.metrics}
+
+    def render(self, other_states: list[dict[str, dict]] = ()) -> str:
+        """
+        Renders every metric, merged with the states of the same registry in other processes (see state)
+        """
+        return "".join(line + "\n" for metric in self.metrics
+                       for line in metric.render([other_state.get(metric.name, {}) for other_state in other_states]))
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram("address_book_request_duration_seconds",
+                                      "Time taken to handle each request, until its whole body was sent",
+                                      ("route", "method", "status"))
+BYTES_READ = REGISTRY.counter("address_book_storage_read_bytes_total",
+                              "Bytes read from the database and its log by the storage", ("file",))
+BYTES_WRITTEN = REGISTRY.counter("address_book_storage_written_bytes_total",
+                                 "Bytes written to the database and its log by the storage", ("file",))
+PARSE_DURATION = REGISTRY.histogram("address_book_parse_duration_seconds",
+                                    "Time taken to decode the database or log into the resident records", ("file",))
+SERIALIZE_DURATION = REGISTRY.histogram("address_book_serialize_duration_seconds",
+                                        "Time taken to encode records for the database or a response", ("target",))
+RECORDS_SCANNED = REGISTRY.counter("address_book_search_records_scanned_total",
+                                   "Records a search matched and had to put in order before paging (in-memory backends)",
+                                   ("mode",))
+RECORDS_RETURNED = REGISTRY.counter("address_book_search_records_returned_total",
+                                    "Records returned by searches", ("mode",))
+LOCK_WAIT = REGISTRY.histogram("address_book_lock_wait_seconds",
+                               "Time spent waiting to acquire the storage lock", ("lock",))
+CACHE_LOOKUPS = REGISTRY.counter("address_book_cache_lookups_total",
+                                 "Result cache lookups, by whether they hit", ("result",))
+
+
+class TimedLock:
+    """
+    Wraps a threading lock, recording how long each acquisition of it waited in LOCK_WAIT.
+    Used as a context manager like the lock itself
+    """
+    def __init__(self, lock: Any, name: str) -> None:
+        self._lock = lock
+        self._name = name
+
+    def __enter__(self) -> bool:
+        started = time.perf_counter()
+        acquired = self._lock.acquire()
+        LOCK_WAIT.observe(time.perf_counter() - started, lock=self._name)
+        return acquired
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._lock.release()
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every other thread at an interval while running, for finding hot paths.
+    Samples are counted by stack and reported in the collapsed format read by flame graph tools,
+    one "outermost;...;innermost count" line per stack. Nothing is sampled while it is stopped
+    """
+    def __init__(self, interval: float = PROFILE_INTERVAL) -> None:
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._samples: SampleCounter[str] = SampleCounter()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        """
+        Starts sampling, discarding the samples of any earlier run
+        """
+        if self._thread is not None:
+            return
+
+        self._samples = SampleCounter()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def collapsed(self) -> str:
+        with self._lock:
+            samples = self._samples.most_common()
+
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+
+                with self._lock:
+                    self._samples[";".join(reversed(stack))] += 1
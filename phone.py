@@ -0,0 +1,62 @@
+from enum import Enum
+import re
+
+# Numbers in this country are stored without their country code, e.g. 01913478234 rather than +441913478234
+DEFAULT_COUNTRY_CODE = "44"
+INTERNATIONAL_PREFIX = "00"
+TRUNK_PREFIX = "0"
+
+# A number in the default country with more digits than this must have started with its country code
+NATIONAL_NUMBER_MAX_DIGITS = 10
+
+# Trailing digit lookups need at least this many digits, shorter suffixes would match most of the book
+PHONE_SUFFIX_MIN_DIGITS = 4
+
+NON_DIGITS = re.compile(r"\D")
+
+
+class PhoneMatch(Enum):
+    """How a phone number is matched against the phone numbers of the records"""
+    NUMBER = "number"
+    SUFFIX = "suffix"
+    AREA_CODE = "area_code"
+
+
+def phone_digits(phone: str) -> str:
+    return NON_DIGITS.sub("", phone)
+
+
+def normalize_phone(phone: str) -> str:
+    """
+    Returns the canonical key of a phone number, so the same number written in different formats has the same key.
+    Formatting characters are removed, numbers in DEFAULT_COUNTRY_CODE become their national number
+    without the trunk prefix (e.g. +44 191 347 8234, 0044191347823 and 01913478234 all become 1913478234),
+    and numbers in other countries become + followed by their country code and number.
+    A number that is nothing but a prefix (e.g. 0 or 00) keeps its digits, so it does not share the empty key
+    of a phone with no digits, which matches no number
+    """
+    key = _phone_key(phone)
+    return key if key.lstrip("+") else phone_digits(phone)
+
+
+def _phone_key(phone: str) -> str:
+    international = phone.lstrip().startswith("+")
+    digits = phone_digits(phone)
+
+    if not international:
+        if digits.startswith(INTERNATIONAL_PREFIX):
+            international = True
+            digits = digits[len(INTERNATIONAL_PREFIX):]
+        elif digits.startswith(TRUNK_PREFIX):
+            return digits[len(TRUNK_PREFIX):]
+        elif digits.startswith(DEFAULT_COUNTRY_CODE) and len(digits) > NATIONAL_NUMBER_MAX_DIGITS:
+            international = True
+
+    if not international:
+        return digits
+
+    if digits.startswith(DEFAULT_COUNTRY_CODE):
+        # Numbers are sometimes written with the trunk prefix after the country code, e.g. +44 (0)191 347 8234
+        return digits[len(DEFAULT_COUNTRY_CODE):].removeprefix(TRUNK_PREFIX)
+
+    return "+" + digits
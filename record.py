@@ -1,4 +1,4 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, fields
 from typing import Any, Annotated
 from pydantic import StringConstraints, Field
 import json
@@ -10,7 +10,8 @@ NAME_REGEX = r"^[a-zA-Z]+$"
 PHONE_REGEX = r"^\d+$"
 
 
-@dataclass
+# Slots rather than a __dict__ per record, as many records can be built at once (e.g. when listing them)
+@dataclass(slots=True)
 class AddressBookRecord:
     """Holds information about an entry in the address book"""
 
@@ -20,12 +21,19 @@ class AddressBookRecord:
     phone: Annotated[str, Field(examples=["01913478234"]), StringConstraints(pattern=PHONE_REGEX)]
     email: Annotated[str, Field(examples=["david.platt@corrie.co.uk"]), StringConstraints(pattern=EMAIL_REGEX)]
 
+    def key(self) -> tuple[str, str, str, str]:
+        """Returns a hashable key identifying the record, two records are equal if their keys are equal"""
+        return (self.first_name, self.last_name, self.phone, self.email)
+
+
+RECORD_FIELDS = tuple(field.name for field in fields(AddressBookRecord))
+
 
 class AddressBookRecordEncoder(json.JSONEncoder):
-    """Encodes an AddressBookRecord into JSON by converting it to a dictionary"""
+    """Encodes an AddressBookRecord into JSON by converting it to a dictionary, see serialization for many records"""
     def default(self, obj) -> dict | Any:
         if isinstance(obj, AddressBookRecord):
-            return asdict(obj)
+            return dict(zip(RECORD_FIELDS, obj.key()))
         return super().default(obj)
 
 
@@ -0,0 +1,39 @@
+from record import AddressBookRecord, RECORD_FIELDS
+from collections.abc import Iterable, Iterator
+from json.encoder import encode_basestring_ascii
+from operator import attrgetter
+import json
+
+# Converters built once from the record's fields, rather than inspecting each record like dataclasses.asdict
+record_to_tuple = attrgetter(*RECORD_FIELDS)
+
+# Every field is a string, so a record is encoded by filling in this template with the escaped (and quoted)
+# field values. It gives the same output as json.dumps with compact separators, without building a dict per record
+RECORD_TEMPLATE = "{" + ",".join(f"{json.dumps(field)}:%s" for field in RECORD_FIELDS) + "}"
+
+
+def record_to_dict(record: AddressBookRecord) -> dict[str, str]:
+    return dict(zip(RECORD_FIELDS, record_to_tuple(record)))
+
+
+def encode_record(record: AddressBookRecord) -> str:
+    return RECORD_TEMPLATE % tuple(map(encode_basestring_ascii, record_to_tuple(record)))
+
+
+def encode_records(records: Iterable[AddressBookRecord], pretty: bool = False) -> bytes:
+    """
+    Encodes the records as a JSON array.
+    The array is compact unless pretty is set, which indents it for reading by hand (and is several times slower)
+    """
+    if pretty:
+        return json.dumps([record_to_dict(record) for record in records], indent=4).encode()
+
+    return ("[" + ",".join([encode_record(record) for record in records]) + "]").encode()
+
+
+def decode_records(data: bytes) -> Iterator[AddressBookRecord]:
+    """
+    Decodes a JSON array of records, compact or pretty.
+    The records are built one at a time as the iterator is consumed
+    """
+    return (AddressBookRecord(**fields) for fields in json.loads(data))
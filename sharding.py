@@ -0,0 +1,434 @@
+from record import AddressBookRecord
+from storage import (SearchQuery, SQLiteStorage, StorageBackend, StorageEngine, ADD, REPLACE, DELETE, ITER_PAGE_SIZE,
+                     create_storage)
+from changes import ChangeBatch, ChangeLog
+from serialization import encode_records
+from snapshot import encode_snapshot
+from index import SearchMode, FUZZY_MAX_DISTANCE, bounded_edit_distance
+from phone import PhoneMatch
+from metrics import REGISTRY
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from dataclasses import replace
+from itertools import chain, islice
+from typing import Any
+import argparse
+import heapq
+import multiprocessing
+import os
+import threading
+import zlib
+
+
+def shard_of(record: AddressBookRecord, shards: int) -> int:
+    """
+    Returns the shard holding the record, from a hash of its identity (see AddressBookRecord.key).
+    crc32 is used rather than hash(), which is salted differently in every process
+    """
+    return zlib.crc32("\x1f".join(record.key()).encode()) % shards
+
+
+def shard_paths(database_path: str, shards: int) -> list[str]:
+    """
+    Returns the path of each shard's database, e.g. address_book.shard0.json.
+    A book with a single shard is not sharded, and is kept at database_path
+    """
+    if shards == 1:
+        return [database_path]
+
+    root, extension = os.path.splitext(database_path)
+    return [f"{root}.shard{shard}{extension}" for shard in range(shards)]
+
+
+# Worker processes are started fresh rather than forked, as forking a process that runs threads (the writer,
+# the API's executor, the profiler) can leave a lock held in the child by a thread that does not exist there
+WORKER_CONTEXT = multiprocessing.get_context("spawn")
+
+# The storage of the shard owned by a shard's worker process
+_shard_storage: StorageEngine | None = None
+
+
+def _open_shard(database_path: str, backend: StorageBackend, shared: bool, pretty: bool) -> None:
+    global _shard_storage
+    _shard_storage = create_storage(database_path, backend, shared, pretty)
+
+
+def _call_shard(storage: StorageEngine | None, method: str, args: tuple, kwargs: dict) -> tuple[Any, int]:
+    """
+    Calls a method of a shard's storage (that of the worker process if storage is None),
+    returning its result along with the latest sequence number of the storage's change log
+    """
+    storage = _shard_storage if storage is None else storage
+    return getattr(storage, method)(*args, **kwargs), storage.change_log.sequence
+
+
+def _shard_metrics() -> dict[str, dict]:
+    return REGISTRY.state()
+
+
+class Shard:
+    """
+    One shard of a ShardedStorage, whose storage is either owned by a worker process or held in this process.
+    Calls to the shard are run one at a time, in the order they were submitted
+    """
+    def __init__(self, database_path: str, backend: StorageBackend, shared: bool, pretty: bool,
+                 processes: bool) -> None:
+        self.database_path = database_path
+        # Held while changing the shard, until its changes are recorded
+        self.lock = threading.Lock()
+        # The sequence number of the shard's change log once the changes made through this shard were recorded,
+        # None if it is not known
+        self.sequence: int | None = None
+
+        if processes:
+            self._storage = None
+            self._executor = ProcessPoolExecutor(1, mp_context=WORKER_CONTEXT, initializer=_open_shard,
+                                                 initargs=(database_path, backend, shared, pretty))
+        else:
+            self._storage = create_storage(database_path, backend, shared, pretty)
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="Shard")
+
+    def submit(self, method: str, *args: Any, **kwargs: Any) -> Future:
+        """
+        Calls a method of the shard's storage, returning a future of its result and the storage's sequence number
+        """
+        return self._executor.submit(_call_shard, self._storage, method, args, kwargs)
+
+    def call(self, method: str, *args: Any, **kwargs: Any) -> tuple[Any, int]:
+        return self.submit(method, *args, **kwargs).result()
+
+    def metrics(self) -> dict[str, dict] | None:
+        """
+        Returns the metrics of the shard's worker process (see metrics.Registry.state),
+        None if its storage is held in this process and so counted by this process's metrics
+        """
+        if self._storage is not None:
+            return None
+
+        return self._executor.submit(_shard_metrics).result()
+
+    def close(self) -> None:
+        try:
+            self.call("close")
+        finally:
+            self._executor.shutdown()
+
+
+def _fuzzy_distance(record: AddressBookRecord, fields: dict[str, str]) -> int:
+    return sum(bounded_edit_distance(value.casefold(), getattr(record, field).casefold(), FUZZY_MAX_DISTANCE)
+               for field, value in fields.items() if value)
+
+
+class ShardedStorage(StorageEngine):
+    """
+    Partitions the records across shards by a hash of their identity (see shard_of), each kept by its own storage
+    of the backend in its own file (see shard_paths), so no change has to rewrite or lock the whole book.
+
+    With processes set each shard's storage is owned by a worker process, otherwise they are held in this process
+    with a thread per shard. Searches fan out to every shard at once and their results are merged,
+    changes are sent only to the shards holding the records, and changes to different shards are made in parallel.
+    Worker processes count their own metrics, which worker_metrics returns for /metrics to merge with this process's.
+
+    Records are returned in shard order, and in the order they were added within each shard,
+    FUZZY matches are merged closest first. An edited record whose hash moves it to another shard is added to the end
+    of its new shard and then removed from its old one, rather than keeping its position.
+    The shards are read independently, so a batch of searches is not answered from a single state of every shard.
+    Use reshard to change the number of shards of a book
+    """
+    def __init__(self, database_path: str, shards: int, backend: StorageBackend = StorageBackend.JSON,
+                 shared: bool = False, pretty: bool = False, processes: bool = True) -> None:
+        self.database_path = database_path
+        self.shards = [Shard(path, backend, shared, pretty, processes) for path in shard_paths(database_path, shards)]
+        self.change_log = ChangeLog()
+
+        # Opening every shard now reports a missing or unreadable shard here, rather than on the first request
+        for shard, (_, sequence) in zip(self.shards, self._gather("data_version")):
+            shard.sequence = sequence
+
+    def data_version(self) -> int:
+        # Each shard's version only increases, so their total increases whenever any shard changes
+        return sum(version for version, _ in self._gather("data_version"))
+
+    def shared_version(self) -> int | None:
+        versions = [version for version, _ in self._gather("shared_version")]
+        return None if None in versions else sum(versions)
+
+    def build_indexes(self) -> None:
+        self._gather("build_indexes")
+
+    def worker_metrics(self) -> list[dict[str, dict]]:
+        return [metrics for shard in self.shards if (metrics := shard.metrics()) is not None]
+
+    def changes(self, since: int) -> ChangeBatch:
+        # Once no change is in flight, a shard whose log has moved on from the changes made through this storage
+        # has been changed by something else, whose changes are not in this storage's log
+        with self._locked(range(len(self.shards))):
+            for shard, (_, sequence) in zip(self.shards, self._gather("data_version")):
+                self._track(shard, sequence, 0)
+
+            return self.change_log.since(since)
+
+    def search(self, offset: int = 0, limit: int | None = None, mode: SearchMode = SearchMode.EXACT,
+               **fields: str) -> list[AddressBookRecord]:
+        # Any shard could hold every record of the page, so each returns its matches up to the end of the page
+        stop = None if limit is None else offset + limit
+        return self._merge([matches for matches, _ in self._gather("search", 0, stop, mode, **fields)],
+                           offset, stop, mode, fields)
+
+    def search_many(self, queries: list[SearchQuery]) -> list[list[AddressBookRecord]]:
+        shard_queries = [replace(query, offset=0, limit=None if query.limit is None else query.offset + query.limit)
+                         for query in queries]
+        shard_results = [results for results, _ in self._gather("search_many", shard_queries)]
+
+        return [self._merge([results[position] for results in shard_results], query.offset, shard_query.limit,
+                            query.mode, query.fields())
+                for position, (query, shard_query) in enumerate(zip(queries, shard_queries))]
+
+    def search_phone(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER, offset: int = 0,
+                     limit: int | None = None) -> list[AddressBookRecord]:
+        stop = None if limit is None else offset + limit
+        return self._merge([matches for matches, _ in self._gather("search_phone", phone, match, 0, stop)],
+                           offset, stop)
+
+    def iter_search(self, **fields: str) -> Iterator[AddressBookRecord]:
+        # Each shard's matches are fetched a page at a time, so only a page is ever held or sent between processes
+        for shard in self.shards:
+            offset = 0
+
+            while True:
+                page = shard.call("search", offset, ITER_PAGE_SIZE, **fields)[0]
+                yield from page
+
+                if len(page) < ITER_PAGE_SIZE:
+                    break
+
+                offset += ITER_PAGE_SIZE
+
+    def contains(self, record: AddressBookRecord) -> bool:
+        return self._shard_of(record).call("contains", record)[0]
+
+    def add_many(self, records: list[AddressBookRecord]) -> list[bool]:
+        return self._change_many("add_many", records, ADD)
+
+    def replace(self, old_record: AddressBookRecord, new_record: AddressBookRecord) -> bool:
+        old_shard, new_shard = self._shard_of(old_record), self._shard_of(new_record)
+
+        if old_shard is new_shard:
+            replaced = self._write({old_shard: ("replace", (old_record, new_record), {})},
+                                   lambda shard, replaced: [(REPLACE, old_record, new_record)] if replaced else [])
+            return replaced[old_shard]
+
+        # No other change made through this storage can come between adding the replacement and removing the record.
+        # The replacement is committed first, so if the process dies or a call fails in between the book is left
+        # holding both records rather than neither
+        with self._locked([self.shards.index(old_shard), self.shards.index(new_shard)]):
+            if not old_shard.call("contains", old_record)[0]:
+                return False
+
+            if not self._call_tracked(new_shard, "add", new_record):
+                return False
+
+            if not self._call_tracked(old_shard, "remove", old_record):
+                # The record was removed by something else in the meantime, so the replacement is taken back
+                self._call_tracked(new_shard, "remove", new_record)
+                self.change_log.reset()
+                return False
+
+            self.change_log.record([(REPLACE, old_record, new_record)])
+            return True
+
+    def remove_many(self, records_to_remove: list[AddressBookRecord]) -> list[bool]:
+        return self._change_many("remove_many", records_to_remove, DELETE)
+
+    def remove_matching(self, **fields: str) -> list[AddressBookRecord]:
+        removed = self._write({shard: ("remove_matching", (), fields) for shard in self.shards},
+                              lambda shard, removed_records: [(DELETE, record) for record in removed_records])
+        return list(chain.from_iterable(removed[shard] for shard in self.shards))
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+
+    def _shard_of(self, record: AddressBookRecord) -> Shard:
+        return self.shards[shard_of(record, len(self.shards))]
+
+    def _gather(self, method: str, *args: Any, **kwargs: Any) -> list[tuple[Any, int]]:
+        """
+        Calls a method of every shard at once, returning each shard's result and sequence number in shard order
+        """
+        futures = [shard.submit(method, *args, **kwargs) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def _merge(self, shard_matches: list[list[AddressBookRecord]], offset: int, stop: int | None,
+               mode: SearchMode = SearchMode.EXACT, fields: dict[str, str] | None = None) -> list[AddressBookRecord]:
+        """
+        Merges the matches of each shard and selects the page from offset to stop
+        """
+        if mode is SearchMode.FUZZY and fields and any(fields.values()):
+            # Each shard's matches are already closest first, ties are left in shard order
+            matches = heapq.merge(*shard_matches, key=lambda record: _fuzzy_distance(record, fields))
+        else:
+            matches = chain.from_iterable(shard_matches)
+
+        return list(islice(matches, offset, stop))
+
+    def _change_many(self, method: str, records: list[AddressBookRecord], operation: str) -> list[bool]:
+        """
+        Sends each record to its shard's add_many or remove_many, returning whether each record was changed
+        """
+        positions: dict[Shard, list[int]] = {}
+
+        for position, record in enumerate(records):
+            positions.setdefault(self._shard_of(record), []).append(position)
+
+        changed = self._write(
+            {shard: (method, ([records[position] for position in shard_positions],), {})
+             for shard, shard_positions in positions.items()},
+            lambda shard, shard_changed: [(operation, records[position])
+                                          for position, was_changed in zip(positions[shard], shard_changed)
+                                          if was_changed]
+        )
+
+        result = [False] * len(records)
+
+        for shard, shard_positions in positions.items():
+            for position, was_changed in zip(shard_positions, changed[shard]):
+                result[position] = was_changed
+
+        return result
+
+    def _write(self, calls: dict[Shard, tuple[str, tuple, dict]],
+               changes_of: Callable[[Shard, Any], list[tuple]]) -> dict[Shard, Any]:
+        """
+        Makes a call to each shard in parallel, holding the shards' locks until the changes made by each call
+        (given by changes_of from its result) are recorded, so they are recorded in the order they were made
+        """
+        with self._locked([self.shards.index(shard) for shard in calls]):
+            futures = {shard: shard.submit(method, *args, **kwargs) for shard, (method, args, kwargs) in calls.items()}
+            wait(futures.values())
+            results = {}
+
+            for shard, future in futures.items():
+                if future.exception() is not None:
+                    # What the shard changed is not known, so the change log is reset by the next call to changes
+                    shard.sequence = None
+                    continue
+
+                results[shard], sequence = future.result()
+                changes = changes_of(shard, results[shard])
+                self.change_log.record(changes)
+                self._track(shard, sequence, len(changes))
+
+            for future in futures.values():
+                future.result()
+
+            return results
+
+    def _call_tracked(self, shard: Shard, method: str, record: AddressBookRecord) -> bool:
+        """
+        Calls a shard's add or remove, which must be done while holding its lock, and tracks its sequence number.
+        The change made is recorded by the caller, if it fails what the shard changed is not known
+        """
+        try:
+            changed, sequence = shard.call(method, record)
+        except Exception:
+            shard.sequence = None
+            raise
+
+        self._track(shard, sequence, int(changed))
+        return changed
+
+    @contextmanager
+    def _locked(self, shard_numbers: Iterable[int]) -> Iterator[None]:
+        # Locks are always taken in shard order, so two calls can not each wait for a lock the other holds
+        with ExitStack() as stack:
+            for shard_number in sorted(set(shard_numbers)):
+                stack.enter_context(self.shards[shard_number].lock)
+
+            yield
+
+    def _track(self, shard: Shard, sequence: int, change_count: int) -> None:
+        """
+        Remembers the sequence number of a shard's change log after change_count changes made through this storage,
+        which must be done while holding its lock. If the shard's log has moved on by any other amount,
+        its records were changed by something else and this storage's change log is reset
+        """
+        if shard.sequence is None or sequence != shard.sequence + change_count:
+            self.change_log.reset()
+
+        shard.sequence = sequence
+
+
+def _write_shard(database_path: str, backend: StorageBackend, records: list[AddressBookRecord]) -> None:
+    _remove_logs(database_path)
+
+    if backend is StorageBackend.SQLITE:
+        if os.path.exists(database_path):
+            os.remove(database_path)
+
+        storage = SQLiteStorage(database_path)
+        storage.add_many(records)
+        storage.close()
+        return
+
+    data = encode_snapshot(records) if backend is StorageBackend.SNAPSHOT else encode_records(records)
+    temp_path = database_path + ".tmp"
+
+    with open(temp_path, "wb") as database_file:
+        database_file.write(data)
+
+    os.replace(temp_path, database_path)
+
+
+def _remove_logs(database_path: str) -> None:
+    # The write-ahead logs of the WAL and SNAPSHOT backends, and of SQLite
+    for log_path in (database_path + ".wal", database_path + "-wal", database_path + "-shm"):
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+
+def reshard(database_path: str, shards: int, backend: StorageBackend = StorageBackend.JSON,
+            from_shards: int = 1) -> None:
+    """
+    Moves the records of a book with from_shards shards (1 for a book that is not sharded) into shards shards.
+    Every record is read before any shard is written, so a book can be resharded in place, e.g. from 2 to 4 shards.
+    Shards that are no longer used are deleted, but an unsharded book's own file is left in place.
+    The API must not be running on the book while it is resharded
+    """
+    if from_shards == 1:
+        source = create_storage(database_path, backend)
+    else:
+        source = ShardedStorage(database_path, from_shards, backend, processes=False)
+
+    try:
+        records = source.records()
+    finally:
+        source.close()
+
+    shard_records = [[] for _ in range(shards)]
+
+    for record in records:
+        shard_records[shard_of(record, shards)].append(record)
+
+    new_paths = shard_paths(database_path, shards)
+
+    for path, records_of_shard in zip(new_paths, shard_records):
+        _write_shard(path, backend, records_of_shard)
+
+    for path in set(shard_paths(database_path, from_shards)) - set(new_paths) - {database_path}:
+        os.remove(path)
+        _remove_logs(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Splits an address book into shards, or changes its number of shards")
+    parser.add_argument("database_path", help="The path of the book, shards are kept next to it (see shard_paths)")
+    parser.add_argument("--shards", type=int, required=True, help="The number of shards to split the book into")
+    parser.add_argument("--from-shards", type=int, default=1,
+                        help="The number of shards the book has now (default 1, a book that is not sharded)")
+    parser.add_argument("--backend", default=StorageBackend.JSON.value,
+                        choices=[backend.value for backend in StorageBackend], help="The storage backend of the book (default json)")
+    arguments = parser.parse_args()
+
+    reshard(arguments.database_path, arguments.shards, StorageBackend(arguments.backend), arguments.from_shards)
@@ -0,0 +1,73 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+import mmap
+import os
+import struct
+
+# fcntl is only available on Unix-like systems, sharing a database between processes is not supported elsewhere
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+GENERATION_FORMAT = "<Q"
+GENERATION_SIZE = struct.calcsize(GENERATION_FORMAT)
+
+
+class ProcessCoordinator:
+    """
+    Coordinates the storages of several processes (e.g. uvicorn workers) sharing one database.
+    A lock file next to the database is used for an advisory fcntl lock, which writers hold while changing
+    the database, and it holds a generation counter which writers increment after each commit.
+    The counter is memory mapped, so checking whether another process has committed is a memory read.
+
+    Must only be used while holding the owning storage's thread lock, as the fcntl lock belongs to
+    the whole process rather than a single thread
+    """
+    def __init__(self, database_path: str) -> None:
+        if fcntl is None:
+            raise RuntimeError("Sharing a database between processes requires fcntl, which is not available")
+
+        self.lock_path = database_path + ".lock"
+        self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock_depth = 0
+
+        with self.exclusive():
+            if os.fstat(self._lock_fd).st_size < GENERATION_SIZE:
+                os.ftruncate(self._lock_fd, GENERATION_SIZE)
+
+        self._generation_map = mmap.mmap(self._lock_fd, GENERATION_SIZE)
+
+    def generation(self) -> int:
+        return struct.unpack_from(GENERATION_FORMAT, self._generation_map)[0]
+
+    def next_generation(self) -> int:
+        """
+        Increments the generation counter, must be called while holding the exclusive lock.
+        Returns the new generation
+        """
+        generation = self.generation() + 1
+        struct.pack_into(GENERATION_FORMAT, self._generation_map, 0, generation)
+        return generation
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """
+        Holds the exclusive lock for the duration of the context, it can be entered again while held
+        """
+        if self._lock_depth == 0:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+
+        self._lock_depth += 1
+
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        self._generation_map.close()
+        os.close(self._lock_fd)
@@ -0,0 +1,389 @@
+from record import AddressBookRecord, RECORD_FIELDS
+from index import FieldIndex, INDEXED_FIELDS, field_key
+from table import RecordTable
+from serialization import encode_records, decode_records
+from collections.abc import Iterable, Iterator
+from array import array
+from bisect import bisect_left
+import argparse
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+# A snapshot is laid out as (all integers little-endian, every section starting on an 8 byte boundary):
+# - The header: magic, version, record count, string count, checksum of everything after the header,
+#   then the offsets of the string offsets, string data and records sections and of each field's index section
+# - String offsets: string count + 1 u64 offsets into the string data, string i is the bytes between i and i + 1
+# - String data: every distinct UTF-8 string, so a value shared by many records is stored once
+# - Records: record count rows of one u32 string id per field, so record i is at a fixed offset
+# - One index section per field: a u32 entry count, then (value string id, postings start, postings count)
+#   u32 triples sorted by the UTF-8 bytes of the value (see index.field_key), then the u32 row ids of each value
+SNAPSHOT_MAGIC = b"ADDRBOOK"
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct("<8sIIII" + "Q" * (3 + len(INDEXED_FIELDS)))
+ROW = struct.Struct("<" + "I" * len(RECORD_FIELDS))
+STRING_SPAN = struct.Struct("<QQ")
+INDEX_ENTRY = struct.Struct("<III")
+COUNT = struct.Struct("<I")
+
+
+def _aligned(data: bytearray) -> int:
+    data.extend(bytes(-len(data) % 8))
+    return len(data)
+
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_snapshot(records: Iterable[AddressBookRecord]) -> bytes:
+    """
+    Encodes the records as a binary snapshot, with an index section for each field
+    """
+    string_ids: dict[str, int] = {}
+    row_ids = array("I")
+    postings: dict[str, dict[str, list[int]]] = {field: {} for field in INDEXED_FIELDS}
+
+    for row, record in enumerate(records):
+        for field, value in zip(RECORD_FIELDS, record.key()):
+            row_ids.append(string_ids.setdefault(value, len(string_ids)))
+            postings[field].setdefault(field_key(field, value), []).append(row)
+
+    # The index keys (e.g. canonical phone numbers) are strings of their own
+    for field_postings in postings.values():
+        for key in field_postings:
+            string_ids.setdefault(key, len(string_ids))
+
+    encoded_strings = [string.encode() for string in string_ids]
+    string_offsets = array("Q", [0])
+
+    for encoded_string in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded_string))
+
+    data = bytearray(HEADER.size)
+    string_offsets_start = _aligned(data)
+    data += _little_endian(string_offsets)
+    string_data_start = _aligned(data)
+    data += b"".join(encoded_strings)
+    records_start = _aligned(data)
+    data += _little_endian(row_ids)
+    index_starts = []
+
+    for field in INDEXED_FIELDS:
+        index_starts.append(_aligned(data))
+        keys = sorted(postings[field], key=str.encode)
+        entries = array("I")
+        rows = array("I")
+
+        for key in keys:
+            entries.extend((string_ids[key], len(rows), len(postings[field][key])))
+            rows.extend(postings[field][key])
+
+        data += COUNT.pack(len(keys))
+        _aligned(data)
+        data += _little_endian(entries) + _little_endian(rows)
+
+    record_count = len(row_ids) // len(RECORD_FIELDS)
+    checksum = zlib.crc32(memoryview(data)[HEADER.size:])
+    HEADER.pack_into(data, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, record_count, len(encoded_strings), checksum,
+                     string_offsets_start, string_data_start, records_start, *index_starts)
+
+    return bytes(data)
+
+
+def snapshot_checksum(data: bytes) -> int:
+    """
+    Returns the checksum held in the header of an encoded snapshot
+    """
+    return HEADER.unpack_from(data)[4]
+
+
+def is_snapshot(path: str) -> bool:
+    with open(path, "rb") as snapshot_file:
+        return snapshot_file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+class MappedSnapshot:
+    """
+    Read-only view of a binary snapshot file through mmap.
+    Opening it only reads the header, records and strings are decoded when they are accessed
+    and lookups binary search the index sections, so nothing is decoded up front however large the file is.
+    The file is unmapped once the view is no longer referenced
+    """
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as snapshot_file:
+            self.stat = os.fstat(snapshot_file.fileno())
+            # An empty file can not be mapped, and is not a valid snapshot anyway
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) if self.stat.st_size else b""
+
+        if len(self._map) < HEADER.size or self._map[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not an address book snapshot")
+
+        (_, version, self.record_count, self.string_count, self.checksum, self._string_offsets_start,
+         self._string_data_start, self._records_start, *index_starts) = HEADER.unpack_from(self._map)
+
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is a version {version} snapshot, only version {SNAPSHOT_VERSION} is supported")
+
+        self._index_starts = dict(zip(INDEXED_FIELDS, index_starts))
+
+    def __len__(self) -> int:
+        return self.record_count
+
+    def record(self, row: int) -> AddressBookRecord:
+        return AddressBookRecord(*map(self._string, ROW.unpack_from(self._map, self._records_start + ROW.size * row)))
+
+    def lookup(self, field: str, value: str) -> tuple[int, ...]:
+        """
+        Returns the rows of the records whose field matches value exactly (see index.field_key)
+        """
+        index_start = self._index_starts[field]
+        entry_count = COUNT.unpack_from(self._map, index_start)[0]
+        entries_start = index_start + 8
+        encoded_key = field_key(field, value).encode()
+
+        # A phone with no digits has an empty key, and matches no number
+        if field == "phone" and not encoded_key:
+            return ()
+
+        # The entries are sorted by the encoded value, so can be bisected without decoding them
+        entry_keys = _EntryKeys(self, entries_start, entry_count)
+        position = bisect_left(entry_keys, encoded_key)
+
+        if position == entry_count or entry_keys[position] != encoded_key:
+            return ()
+
+        _, postings_start, postings_count = INDEX_ENTRY.unpack_from(self._map,
+                                                                    entries_start + INDEX_ENTRY.size * position)
+        rows_start = entries_start + INDEX_ENTRY.size * entry_count + 4 * postings_start
+
+        return struct.unpack_from(f"<{postings_count}I", self._map, rows_start)
+
+    def find(self, key: tuple[str, str, str, str]) -> int | None:
+        """
+        Returns the row of the record with the key, or None if there is none
+        """
+        for row in self.lookup("email", key[RECORD_FIELDS.index("email")]):
+            if self.record(row).key() == key:
+                return row
+
+        return None
+
+    def _encoded_string(self, string_id: int) -> bytes:
+        start, end = STRING_SPAN.unpack_from(self._map, self._string_offsets_start + 8 * string_id)
+        return self._map[self._string_data_start + start:self._string_data_start + end]
+
+    def _string(self, string_id: int) -> str:
+        return self._encoded_string(string_id).decode()
+
+
+class _EntryKeys:
+    """
+    Sequence of the encoded values of an index section's entries, for bisect
+    """
+    def __init__(self, snapshot: MappedSnapshot, entries_start: int, entry_count: int) -> None:
+        self._snapshot = snapshot
+        self._entries_start = entries_start
+        self._entry_count = entry_count
+
+    def __len__(self) -> int:
+        return self._entry_count
+
+    def __getitem__(self, position: int) -> bytes:
+        string_id = COUNT.unpack_from(self._snapshot._map, self._entries_start + INDEX_ENTRY.size * position)[0]
+        return self._snapshot._encoded_string(string_id)
+
+
+class SnapshotTable:
+    """
+    RecordTable whose first rows are the records of a MappedSnapshot, decoded as they are read.
+    Changes are kept in memory: a snapshot row that is replaced or removed is noted,
+    and records added after the snapshot are kept in a RecordTable whose rows follow the snapshot's
+    """
+    def __init__(self, snapshot: MappedSnapshot | None = None) -> None:
+        self._snapshot = snapshot
+        self._base_rows = 0 if snapshot is None else len(snapshot)
+
+        # The record now in each changed snapshot row, or None if it was removed
+        self._changed: dict[int, AddressBookRecord | None] = {}
+        self._changed_rows_by_key: dict[tuple[str, str, str, str], int] = {}
+        self._removed_rows = 0
+        self._added = RecordTable()
+
+    def __len__(self) -> int:
+        return self._base_rows - self._removed_rows + len(self._added)
+
+    @property
+    def empty_rows(self) -> int:
+        return self._removed_rows + self._added.empty_rows
+
+    def append(self, record: AddressBookRecord) -> int:
+        return self._base_rows + self._added.append(record)
+
+    def set(self, row: int, record: AddressBookRecord) -> None:
+        if row >= self._base_rows:
+            self._added.set(row - self._base_rows, record)
+            return
+
+        if self._changed.get(row) is not None:
+            del self._changed_rows_by_key[self._changed[row].key()]
+
+        self._changed[row] = record
+        self._changed_rows_by_key[record.key()] = row
+
+    def get(self, row: int) -> AddressBookRecord:
+        if row >= self._base_rows:
+            return self._added.get(row - self._base_rows)
+
+        if row in self._changed:
+            return self._changed[row]
+
+        return self._snapshot.record(row)
+
+    def remove(self, row: int) -> AddressBookRecord:
+        if row >= self._base_rows:
+            return self._added.remove(row - self._base_rows)
+
+        record = self.get(row)
+        self._changed_rows_by_key.pop(record.key(), None)
+        self._changed[row] = None
+        self._removed_rows += 1
+
+        return record
+
+    def find(self, key: tuple[str, str, str, str]) -> int | None:
+        row = self._added.find(key)
+
+        if row is not None:
+            return self._base_rows + row
+
+        if key in self._changed_rows_by_key:
+            return self._changed_rows_by_key[key]
+
+        row = None if self._snapshot is None else self._snapshot.find(key)
+        return None if row is None or row in self._changed else row
+
+    def rows(self) -> Iterator[int]:
+        for row in range(self._base_rows):
+            if self._changed.get(row, True) is not None:
+                yield row
+
+        for row in self._added.rows():
+            yield self._base_rows + row
+
+    def items(self) -> Iterator[tuple[int, AddressBookRecord]]:
+        return ((row, self.get(row)) for row in self.rows())
+
+    def records(self) -> Iterator[AddressBookRecord]:
+        return (self.get(row) for row in self.rows())
+
+    def copy(self) -> "SnapshotTable":
+        """
+        Returns a copy that can be read by row without holding a lock, the snapshot itself is never changed.
+        As with RecordTable.copy, find can not be used on the copy
+        """
+        table = SnapshotTable(self._snapshot)
+        table._changed = self._changed.copy()
+        table._removed_rows = self._removed_rows
+        table._added = self._added.copy()
+
+        return table
+
+    def clear(self) -> None:
+        self._snapshot = None
+        self._base_rows = 0
+        self._changed.clear()
+        self._changed_rows_by_key.clear()
+        self._removed_rows = 0
+        self._added.clear()
+
+
+class SnapshotFieldIndex:
+    """
+    FieldIndex answering lookups from the index sections of a MappedSnapshot, along with a FieldIndex
+    of the records changed since. Snapshot rows removed from the index are left out of its lookups
+    """
+    def __init__(self, snapshot: MappedSnapshot | None = None) -> None:
+        self._snapshot = snapshot
+        self._base_rows = 0 if snapshot is None else len(snapshot)
+        self._removed_base_rows: set[int] = set()
+        self._changes = FieldIndex()
+
+    def add(self, record_id: int, record: AddressBookRecord) -> None:
+        self._changes.add(record_id, record)
+
+    def remove(self, record_id: int, record: AddressBookRecord) -> None:
+        # A snapshot row only holds its snapshot record until it is first removed, after that it is in _changes
+        if record_id >= self._base_rows or record_id in self._removed_base_rows:
+            self._changes.remove(record_id, record)
+        else:
+            self._removed_base_rows.add(record_id)
+
+    def clear(self) -> None:
+        self._snapshot = None
+        self._base_rows = 0
+        self._removed_base_rows.clear()
+        self._changes.clear()
+
+    def lookup(self, **fields: str) -> set[int]:
+        postings = []
+
+        for field, value in fields.items():
+            if not value:
+                continue
+
+            record_ids = self._changes.lookup(**{field: value})
+
+            if self._snapshot is not None:
+                record_ids.update(row for row in self._snapshot.lookup(field, value)
+                                  if row not in self._removed_base_rows)
+
+            postings.append(record_ids)
+
+        if not postings:
+            raise ValueError("At least one field must be provided")
+
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+
+def json_to_snapshot(json_path: str, snapshot_path: str) -> None:
+    """
+    Converts a JSON address book into a binary snapshot, dropping any repeated record like the JSON storage does
+    """
+    records: dict[tuple[str, str, str, str], AddressBookRecord] = {}
+
+    with open(json_path, "rb") as json_file:
+        for record in decode_records(json_file.read()):
+            records.setdefault(record.key(), record)
+
+    with open(snapshot_path, "wb") as snapshot_file:
+        snapshot_file.write(encode_snapshot(records.values()))
+
+
+def snapshot_to_json(snapshot_path: str, json_path: str, pretty: bool = False) -> None:
+    """
+    Converts a binary snapshot back into a JSON address book
+    """
+    snapshot = MappedSnapshot(snapshot_path)
+
+    with open(json_path, "wb") as json_file:
+        json_file.write(encode_records((snapshot.record(row) for row in range(len(snapshot))), pretty))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts an address book between the JSON and snapshot formats")
+    parser.add_argument("source", help="A JSON address book or snapshot, the format is detected from its contents")
+    parser.add_argument("destination", help="Where to write the address book in the other format")
+    parser.add_argument("--pretty", action="store_true", help="Indent the JSON when converting a snapshot to JSON")
+    arguments = parser.parse_args()
+
+    if is_snapshot(arguments.source):
+        snapshot_to_json(arguments.source, arguments.destination, arguments.pretty)
+    else:
+        json_to_snapshot(arguments.source, arguments.destination)
@@ -0,0 +1,1275 @@
+from record import AddressBookRecord
+from serialization import encode_records, decode_records
+from snapshot import MappedSnapshot, SnapshotFieldIndex, SnapshotTable, encode_snapshot, snapshot_checksum
+from index import (FieldIndex, PhoneIndex, TextIndex, SearchMode, INDEXED_FIELDS, FUZZY_MAX_DISTANCE,
+                   bounded_edit_distance, field_key)
+from phone import PhoneMatch, normalize_phone, phone_digits
+from table import RecordTable
+from writer import GroupCommitWriter
+from shared import ProcessCoordinator
+from changes import ChangeBatch, ChangeLog
+from metrics import (BYTES_READ, BYTES_WRITTEN, PARSE_DURATION, SERIALIZE_DURATION, RECORDS_SCANNED,
+                     RECORDS_RETURNED, TimedLock)
+from abc import ABC, abstractmethod
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from dataclasses import dataclass
+from enum import Enum
+from itertools import islice
+from typing import Annotated, Optional
+from pydantic import Field
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# The coarsest modification time resolution expected from the filesystem.
+# A file read within this window of its last modification could be modified again
+# without its mtime changing, so it is read again on the next access
+MTIME_RESOLUTION_NS = 10_000_000
+
+# Rows left empty by removed records are reclaimed (renumbering the rest) once there are more of them
+# than records, and more than this many
+RECLAIM_MIN_EMPTY_ROWS = 10_000
+
+# Changes are passed to _commit as (operation, record(s)) tuples, these are the operations
+ADD = "add"
+REPLACE = "replace"
+DELETE = "delete"
+
+
+class StorageBackend(Enum):
+    JSON = "json"
+    WAL = "wal"
+    SQLITE = "sqlite"
+    SNAPSHOT = "snapshot"
+
+
+@dataclass(frozen=True)
+class SearchQuery:
+    """One search of a batch, holding the same arguments as StorageEngine.search"""
+    first_name: str = ""
+    last_name: str = ""
+    phone: str = ""
+    email: str = ""
+    offset: Annotated[int, Field(ge=0)] = 0
+    limit: Annotated[Optional[int], Field(ge=1)] = None
+    mode: SearchMode = SearchMode.EXACT
+
+    def fields(self) -> dict[str, str]:
+        return {field: getattr(self, field) for field in INDEXED_FIELDS}
+
+
+class StorageEngine(ABC):
+    """
+    Interface between AddressBookAPI and wherever the records are kept.
+    Records are identified by AddressBookRecord.key(), an engine never holds two equal records.
+    Every change an engine makes is recorded in its change_log, in the order the changes were made
+    """
+    change_log: ChangeLog
+
+    def records(self, offset: int = 0, limit: int | None = None) -> list[AddressBookRecord]:
+        """
+        Returns all records, in the order they were added.
+        offset and limit select a page of the records, all records after offset are returned if limit is None
+        """
+        return self.search(offset, limit)
+
+    @abstractmethod
+    def data_version(self) -> int:
+        """
+        Returns a number that increases whenever the stored records change, including changes made by other
+        processes. Results read after getting a version are at least as new as that version
+        """
+
+    def shared_version(self) -> int | None:
+        """
+        Returns a number that increases whenever the stored records change and is the same in every process sharing
+        them, or None if there is none. data_version counts the changes this process has seen, so differs
+        between processes. Results read after getting a version are at least as new as that version
+        """
+        return None
+
+    def changes(self, since: int) -> ChangeBatch:
+        """
+        Returns the changes made after the change numbered since (see changes.ChangeLog)
+        """
+        # Getting the data version notices any change made by other processes or to the file, which resets the log
+        self.data_version()
+        return self.change_log.since(since)
+
+    @abstractmethod
+    def search(self, offset: int = 0, limit: int | None = None, mode: SearchMode = SearchMode.EXACT,
+               **fields: str) -> list[AddressBookRecord]:
+        """
+        Returns the records matching every provided (non-empty) field, in the order they were added.
+        mode decides how fields are matched, FUZZY matches are ranked by their total edit distance
+        before the order they were added.
+        All records match if no field is provided, offset and limit select a page of the matching records
+        """
+
+    @abstractmethod
+    def search_many(self, queries: list[SearchQuery]) -> list[list[AddressBookRecord]]:
+        """
+        Returns the records matching each query, in the same order as the queries, in the same form as search.
+        Every query is answered from the same state of the records, so no change is seen by only some of them
+        """
+
+    @abstractmethod
+    def search_phone(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER, offset: int = 0,
+                     limit: int | None = None) -> list[AddressBookRecord]:
+        """
+        Returns the records whose phone number is the same number as phone, ends with its digits
+        or starts with its area code, depending on match, in the order they were added.
+        Numbers are compared by their canonical key (see phone.normalize_phone),
+        offset and limit select a page of the matching records
+        """
+
+    @abstractmethod
+    def iter_search(self, **fields: str) -> Iterator[AddressBookRecord]:
+        """
+        Returns an iterator over the records matching every provided (non-empty) field, in the order they were added.
+        Unlike search, the matching records do not all have to be loaded before the first is returned
+        """
+
+    @abstractmethod
+    def contains(self, record: AddressBookRecord) -> bool:
+        """
+        Returns whether a record equal to the provided record is stored
+        """
+
+    def add(self, record: AddressBookRecord) -> bool:
+        """
+        Adds the record.
+        Returns False if an equal record is already stored
+        """
+        return self.add_many([record])[0]
+
+    @abstractmethod
+    def add_many(self, records: list[AddressBookRecord]) -> list[bool]:
+        """
+        Adds the records, persisting them all in a single commit.
+        Returns whether each record was added, a record is not added if an equal record
+        is already stored or appears earlier in records
+        """
+
+    @abstractmethod
+    def replace(self, old_record: AddressBookRecord, new_record: AddressBookRecord) -> bool:
+        """
+        Replaces the record equal to old_record with new_record, keeping its position.
+        Returns False if there is no such record, or if new_record is equal to a different stored record
+        """
+
+    def remove(self, record_to_remove: AddressBookRecord) -> bool:
+        """
+        Removes the record equal to record_to_remove.
+        Returns False if there is no such record
+        """
+        return self.remove_many([record_to_remove])[0]
+
+    @abstractmethod
+    def remove_many(self, records_to_remove: list[AddressBookRecord]) -> list[bool]:
+        """
+        Removes the records equal to each of records_to_remove, persisting them all in a single commit.
+        Returns whether each record was removed
+        """
+
+    @abstractmethod
+    def remove_matching(self, **fields: str) -> list[AddressBookRecord]:
+        """
+        Removes every record matching the provided fields, or all records if no field is provided.
+        Returns the removed records
+        """
+
+    def build_indexes(self) -> None:
+        """
+        Loads the records and builds any index a search may need now, rather than on the first search that needs it
+        """
+        self.data_version()
+
+    def worker_metrics(self) -> list[dict[str, dict]]:
+        """
+        Returns the metrics (see metrics.Registry.state) of any worker processes the storage is kept by,
+        which are not in this process's registry
+        """
+        return []
+
+    def close(self) -> None:
+        """
+        Releases any resources held by the storage
+        """
+
+
+class JSONFileStorage(StorageEngine):
+    """
+    Keeps the records of a JSON address book resident in memory, along with an index of their fields.
+    The file is only read again when it is changed by something other than this storage,
+    which is detected by comparing the file's inode, size and modification time.
+
+    Reads and changes to the resident records are serialised by a lock, so reads always see a consistent state.
+    Reads do not run in parallel with each other or with changes. Searches are pure Python, so the GIL would
+    interleave rather than parallelise them anyway. Publishing an immutable copy of the table and indexes
+    for readers after each change would make every change cost time in proportion to the size of the book.
+    Without sharing, the lock is held while a change is applied in memory and while the table is copied to be
+    written, but not while the copy is encoded or written.
+    Changes are persisted by a GroupCommitWriter, so changes made at the same time by different threads
+    are written together. Each change waits for its commit before returning.
+
+    If the database is shared with other processes, changes are instead made and committed while holding
+    a ProcessCoordinator's lock, and the resident records are only reloaded when its generation counter shows
+    that another process has committed. Reads then also wait while a change is written, which for this backend
+    rewrites the whole file (WALStorage only appends to its log).
+
+    The file is written as compact JSON, unless pretty is set to indent it for reading by hand
+    """
+    def __init__(self, database_path: str, commit_window: float = 0.0, shared: bool = False,
+                 pretty: bool = False) -> None:
+        self.database_path = database_path
+        self.pretty = pretty
+        self._lock = TimedLock(threading.RLock(), "records")
+        self._coordinator = ProcessCoordinator(database_path) if shared else None
+        self._generation: int | None = None
+        self.change_log = ChangeLog()
+
+        # Records are stored in the rows of a table, and identified by row id. Row ids increase
+        # in the order records were added, so iterating over the rows (or sorting ids) gives the order of the file
+        self._table = RecordTable()
+        self._index = FieldIndex()
+        # A field's text index is only built once a search needs it, as most searches are EXACT
+        # and it is slow to build for a large book
+        self._text_indexes: dict[str, TextIndex] = {}
+        self._phone_index: PhoneIndex | None = None
+
+        self._signature: tuple[int, int, int] | None = None
+        self._racy = True
+        self._version = 0
+
+        # The number of changes applied to the resident records that the writer has not committed yet
+        self._uncommitted_changes = 0
+        self._writer = GroupCommitWriter(self._commit_batch, commit_window, self._writer_idle)
+
+    def data_version(self) -> int:
+        with self._lock:
+            self._refresh()
+            return self._version
+
+    def shared_version(self) -> int | None:
+        # Every commit of a shared book increments the coordinator's generation, which all the processes read
+        if self._coordinator is None:
+            return None
+
+        with self._lock:
+            self._refresh()
+            return self._generation
+
+    def search(self, offset: int = 0, limit: int | None = None, mode: SearchMode = SearchMode.EXACT,
+               **fields: str) -> list[AddressBookRecord]:
+        with self._lock:
+            self._refresh()
+            return self._search(offset, limit, mode, fields, {})
+
+    def build_indexes(self) -> None:
+        with self._lock:
+            self._refresh()
+
+            for field in INDEXED_FIELDS:
+                if field not in self._text_indexes:
+                    self._text_indexes[field] = TextIndex(field, self._table.items())
+
+            if self._phone_index is None:
+                self._phone_index = PhoneIndex(self._table.items())
+
+    def search_many(self, queries: list[SearchQuery]) -> list[list[AddressBookRecord]]:
+        # The lock is held for the whole batch, and queries in a batch often share field values,
+        # so the matches of each field value are only looked up once
+        with self._lock:
+            self._refresh()
+            lookups = {}
+            return [self._search(query.offset, query.limit, query.mode, query.fields(), lookups) for query in queries]
+
+    def search_phone(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER, offset: int = 0,
+                     limit: int | None = None) -> list[AddressBookRecord]:
+        stop = None if limit is None else offset + limit
+
+        with self._lock:
+            self._refresh()
+
+            if match is PhoneMatch.NUMBER:
+                matching_ids = self._index.lookup(phone=phone)
+            else:
+                # Built on first use like the text indexes
+                if self._phone_index is None:
+                    self._phone_index = PhoneIndex(self._table.items())
+
+                matching_ids = self._phone_index.lookup(phone, match)
+
+            return [self._table.get(record_id) for record_id in sorted(matching_ids)[offset:stop]]
+
+    def iter_search(self, **fields: str) -> Iterator[AddressBookRecord]:
+        # Only the ids of the matches and a copy of the table's columns (not the strings in them) are taken
+        # under the lock, each record is built as it is reached, so nothing is built for records never read
+        with self._lock:
+            self._refresh()
+            table = self._table.copy()
+            matching_ids = self._matching_ids(fields) if any(fields.values()) else None
+
+        return (table.get(record_id) for record_id in (table.rows() if matching_ids is None else matching_ids))
+
+    def contains(self, record: AddressBookRecord) -> bool:
+        with self._lock:
+            self._refresh()
+            return self._table.find(record.key()) is not None
+
+    def add_many(self, records: list[AddressBookRecord]) -> list[bool]:
+        added = []
+
+        with self._changing() as changes:
+            for record in records:
+                added.append(self._table.find(record.key()) is None)
+
+                if added[-1]:
+                    self._insert(record)
+                    changes.append((ADD, record))
+
+        return added
+
+    def replace(self, old_record: AddressBookRecord, new_record: AddressBookRecord) -> bool:
+        with self._changing() as changes:
+            record_id = self._table.find(old_record.key())
+
+            if record_id is None or self._table.find(new_record.key()) not in (None, record_id):
+                return False
+
+            self._update(record_id, new_record)
+            changes.append((REPLACE, old_record, new_record))
+
+        return True
+
+    def remove_many(self, records_to_remove: list[AddressBookRecord]) -> list[bool]:
+        removed_records = []
+
+        with self._changing() as changes:
+            for record in records_to_remove:
+                record_id = self._table.find(record.key())
+
+                if record_id is not None:
+                    removed_records.append(self._delete(record_id))
+                    changes.append((DELETE, removed_records[-1]))
+
+        # Records are only removed once, so the first of any equal records is the one reported as removed
+        removed_keys = {record.key() for record in removed_records}
+        removed = []
+
+        for record in records_to_remove:
+            removed.append(record.key() in removed_keys)
+            removed_keys.discard(record.key())
+
+        return removed
+
+    def remove_matching(self, **fields: str) -> list[AddressBookRecord]:
+        with self._changing() as changes:
+            removed_records = [self._delete(record_id) for record_id in self._matching_ids(fields)]
+            changes.extend((DELETE, record) for record in removed_records)
+
+        return removed_records
+
+    def save(self) -> None:
+        """
+        Writes the resident records to the file.
+        The records are written to a temporary file which then replaces the database,
+        so a crash part way through writing can not truncate the existing file
+        """
+        # Copying the table only copies its columns, the records are built from the copy outside the lock
+        with self._lock:
+            table = self._table.copy()
+
+        self._write_snapshot(self._serialize(table))
+
+    def close(self) -> None:
+        self._writer.close()
+
+        if self._coordinator is not None:
+            self._coordinator.close()
+
+    @contextmanager
+    def _changing(self) -> Iterator[list[tuple]]:
+        """
+        Holds the lock(s) needed to change the resident records, refreshing them first.
+        The changes applied within the context are added to the yielded list, and are committed when it exits.
+        The context only exits once the changes have been committed
+        """
+        committed = None
+
+        with self._lock, self._exclusive():
+            self._refresh()
+            changes = []
+            yield changes
+
+            if not changes:
+                return
+
+            self.change_log.record(changes)
+            self._reclaim_empty_rows()
+
+            if self._coordinator is None:
+                committed = self._submit(changes)
+            else:
+                # Other processes must not see the lock released until the changes are in the file
+                self._uncommitted_changes += len(changes)
+                self._commit_batch(changes)
+                self._generation = self._coordinator.next_generation()
+
+        if committed is not None:
+            committed.result()
+
+    def _exclusive(self) -> AbstractContextManager:
+        return nullcontext() if self._coordinator is None else self._coordinator.exclusive()
+
+    def _submit(self, changes: list[tuple]) -> Future:
+        """
+        Queues changes that have just been applied to the resident records to be committed.
+        Must be called while holding the lock, so changes are committed in the order they were applied
+        """
+        self._uncommitted_changes += len(changes)
+        return self._writer.submit(changes)
+
+    def _commit_batch(self, changes: list[tuple]) -> None:
+        """
+        Called by the writer thread to commit the changes queued since its last commit
+        """
+        try:
+            self._commit(changes)
+        except Exception:
+            # The resident records no longer match the file, so they are reloaded on the next access
+            # and the changes that were recorded may be lost
+            with self._lock:
+                self._racy = True
+                self.change_log.reset()
+            raise
+        finally:
+            with self._lock:
+                self._uncommitted_changes -= len(changes)
+
+    def _commit(self, changes: list[tuple]) -> None:
+        """
+        Persists changes that have been applied to the resident records
+        """
+        self.save()
+
+    def _writer_idle(self) -> float | None:
+        """
+        Called by the writer thread when it has no changes to commit.
+        Returns how many seconds it can wait for changes before calling this again, or None to wait until there are some
+        """
+        return None
+
+    def _serialize(self, table: RecordTable) -> bytes:
+        started = time.perf_counter()
+        data = self._encode_snapshot(table.records())
+        SERIALIZE_DURATION.observe(time.perf_counter() - started, target="snapshot")
+        return data
+
+    def _encode_snapshot(self, records: Iterable[AddressBookRecord]) -> bytes:
+        return encode_records(records, self.pretty)
+
+    def _write_snapshot(self, data: bytes) -> None:
+        temp_path = self.database_path + ".tmp"
+
+        with open(temp_path, "wb") as database_file:
+            database_file.write(data)
+
+        BYTES_WRITTEN.inc(len(data), file="snapshot")
+
+        # Backdating the modification time means any later write by something else
+        # is guaranteed to give the file a different mtime from the one remembered here
+        modified_time = time.time_ns() - MTIME_RESOLUTION_NS
+        os.utime(temp_path, ns=(modified_time, modified_time))
+        os.replace(temp_path, self.database_path)
+
+        with self._lock:
+            self._remember(os.stat(self.database_path), time.time_ns())
+
+    def _matching_ids(self, fields: dict[str, str]) -> list[int]:
+        if not any(fields.values()):
+            return list(self._table.rows())
+
+        return sorted(self._index.lookup(**fields))
+
+    def _search(self, offset: int, limit: int | None, mode: SearchMode, fields: dict[str, str],
+                lookups: dict[tuple, set[int] | dict[int, int]]) -> list[AddressBookRecord]:
+        """
+        Searches the resident records, which must be done while holding the lock.
+        The matches of each field value are kept in lookups, so searches sharing it can reuse them
+        """
+        stop = None if limit is None else offset + limit
+
+        if not any(fields.values()):
+            return [self._table.get(record_id) for record_id in islice(self._table.rows(), offset, stop)]
+
+        if mode is SearchMode.EXACT:
+            matching_ids = sorted(self._exact_lookup(fields, lookups))
+            page_ids = matching_ids[offset:stop]
+        elif mode is not SearchMode.FUZZY and stop is not None:
+            # Every match is at distance 0 so they rank by id alone, and the search stops at the end of the page
+            matching_ids = list(islice(self._ordered_text_lookup(mode, fields), stop))
+            page_ids = matching_ids[offset:]
+        else:
+            matching_ids = self._text_lookup(mode, fields, lookups)
+            rank = lambda record_id: (matching_ids[record_id], record_id)
+
+            # Only the matches up to the end of the page have to be put in order
+            ranked_ids = (sorted(matching_ids, key=rank) if stop is None
+                          else heapq.nsmallest(stop, matching_ids, key=rank))
+            page_ids = ranked_ids[offset:]
+
+        RECORDS_SCANNED.inc(len(matching_ids), mode=mode.value)
+        RECORDS_RETURNED.inc(len(page_ids), mode=mode.value)
+        return [self._table.get(record_id) for record_id in page_ids]
+
+    def _exact_lookup(self, fields: dict[str, str], lookups: dict[tuple, set[int] | dict[int, int]]) -> set[int]:
+        """
+        Returns the ids of the records matching every provided field exactly
+        """
+        postings = []
+
+        for field, value in fields.items():
+            if value:
+                lookup_key = (SearchMode.EXACT, field, field_key(field, value))
+
+                if lookup_key not in lookups:
+                    lookups[lookup_key] = self._index.lookup(**{field: value})
+
+                postings.append(lookups[lookup_key])
+
+        # Starting from the smallest set keeps the cost down to the rarest value, as FieldIndex.lookup does
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def _text_lookup(self, mode: SearchMode, fields: dict[str, str],
+                     lookups: dict[tuple, set[int] | dict[int, int]]) -> dict[int, int]:
+        """
+        Returns the ids of the records matching every provided field, mapped to their total edit distance
+        """
+        distances = None
+
+        for field, value in fields.items():
+            if not value:
+                continue
+
+            if field not in self._text_indexes:
+                self._text_indexes[field] = TextIndex(field, self._table.items())
+
+            lookup_key = (mode, field, value)
+
+            if lookup_key not in lookups:
+                lookups[lookup_key] = self._text_indexes[field].lookup(value, mode)
+
+            field_distances = lookups[lookup_key]
+
+            if distances is None:
+                distances = field_distances
+            else:
+                distances = {record_id: distance + field_distances[record_id]
+                             for record_id, distance in distances.items() if record_id in field_distances}
+
+        return distances
+
+    def _ordered_text_lookup(self, mode: SearchMode, fields: dict[str, str]) -> Iterator[int]:
+        """
+        Returns an iterator over the ids of the records matching every provided field, in increasing order.
+        The ids matching each field are walked together, each skipping ahead to the highest id any has reached
+        """
+        matches = []
+
+        for field, value in fields.items():
+            if value:
+                if field not in self._text_indexes:
+                    self._text_indexes[field] = TextIndex(field, self._table.items())
+
+                matches.append(self._text_indexes[field].ordered_lookup(value, mode))
+
+        current_ids = [next(field_ids, None) for field_ids in matches]
+
+        while None not in current_ids:
+            highest_id = max(current_ids)
+
+            if current_ids.count(highest_id) == len(current_ids):
+                yield highest_id
+                current_ids = [next(field_ids, None) for field_ids in matches]
+                continue
+
+            for position, field_ids in enumerate(matches):
+                record_id = current_ids[position]
+
+                while record_id is not None and record_id < highest_id:
+                    record_id = next(field_ids, None)
+
+                current_ids[position] = record_id
+
+    def _insert(self, record: AddressBookRecord) -> None:
+        self._version += 1
+        record_id = self._table.append(record)
+        self._index.add(record_id, record)
+
+        for text_index in self._text_indexes.values():
+            text_index.add(record_id, record)
+
+        if self._phone_index is not None:
+            self._phone_index.add(record_id, record)
+
+    def _update(self, record_id: int, new_record: AddressBookRecord) -> None:
+        self._version += 1
+        old_record = self._table.get(record_id)
+        self._index.remove(record_id, old_record)
+
+        for text_index in self._text_indexes.values():
+            text_index.remove(record_id, old_record)
+            text_index.add(record_id, new_record)
+
+        if self._phone_index is not None:
+            self._phone_index.remove(record_id, old_record)
+            self._phone_index.add(record_id, new_record)
+
+        # Storing the record in its existing row keeps its position
+        self._table.set(record_id, new_record)
+        self._index.add(record_id, new_record)
+
+    def _delete(self, record_id: int) -> AddressBookRecord:
+        self._version += 1
+        record = self._table.remove(record_id)
+        self._index.remove(record_id, record)
+
+        for text_index in self._text_indexes.values():
+            text_index.remove(record_id, record)
+
+        if self._phone_index is not None:
+            self._phone_index.remove(record_id, record)
+
+        return record
+
+    def _reclaim_empty_rows(self) -> None:
+        if self._table.empty_rows > max(len(self._table), RECLAIM_MIN_EMPTY_ROWS):
+            self._replace_all(self._table.copy().records())
+
+    def _refresh(self) -> None:
+        """
+        Reloads the records if the file has changed since it was last read or written.
+        While the writer has changes to commit the resident records are newer than the file, so are kept
+        """
+        if self._uncommitted_changes:
+            return
+
+        # Changes made by another process or to the file are not in the change log, so it is reset
+        if self._coordinator is not None and self._coordinator.generation() != self._generation:
+            with self._coordinator.exclusive():
+                self._generation = self._coordinator.generation()
+                self._catch_up()
+
+            self.change_log.reset()
+            return
+
+        stat = os.stat(self.database_path)
+        changed = self._signature != (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        # A racy file with an unchanged signature is almost always the file this storage just wrote
+        if self._racy or changed:
+            with self._exclusive():
+                self._load()
+
+            if changed:
+                self.change_log.reset()
+
+    def _catch_up(self) -> None:
+        """
+        Brings the resident records up to date after another process has committed changes
+        """
+        self._load()
+
+    def _load(self) -> None:
+        checked_at, stat, data = self._read_snapshot()
+        self._parse_snapshot(data)
+        self._remember(stat, checked_at)
+
+    def _parse_snapshot(self, data: bytes) -> None:
+        started = time.perf_counter()
+        self._replace_all(self._decode_snapshot(data))
+        PARSE_DURATION.observe(time.perf_counter() - started, file="snapshot")
+
+    def _read_snapshot(self) -> tuple[int, os.stat_result, bytes]:
+        checked_at = time.time_ns()
+
+        with open(self.database_path, "rb") as database_file:
+            stat = os.fstat(database_file.fileno())
+            data = database_file.read()
+
+        BYTES_READ.inc(len(data), file="snapshot")
+        return checked_at, stat, data
+
+    def _decode_snapshot(self, data: bytes) -> Iterator[AddressBookRecord]:
+        # Each record is only needed until it has been stored in the table, so they are built one at a time
+        return decode_records(data)
+
+    def _replace_all(self, records: Iterable[AddressBookRecord]) -> None:
+        self._version += 1
+        self._table.clear()
+        self._index.clear()
+        self._text_indexes.clear()
+        self._phone_index = None
+
+        # A file edited by hand could hold the same record twice, only the first copy is kept
+        for record in records:
+            if self._table.find(record.key()) is None:
+                self._insert(record)
+
+    def _remember(self, stat: os.stat_result, checked_at: int) -> None:
+        self._signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self._racy = checked_at < stat.st_mtime_ns + MTIME_RESOLUTION_NS
+
+
+class WALStorage(JSONFileStorage):
+    """
+    Keeps the records resident in memory like JSONFileStorage, but rather than rewriting the whole file
+    on every change, each change is appended to a write-ahead log next to the database file.
+    The log is fsynced in batches, and once it holds enough entries it is compacted into the database file.
+    On load the database file is read as a snapshot and the log is replayed on top of it.
+
+    The log starts with a header holding the checksum of the snapshot it applies to,
+    if the snapshot does not match (it was compacted or changed externally) the log is discarded.
+    When shared with other processes, only the entries they have appended since the last refresh are replayed
+    """
+    def __init__(self, database_path: str, commit_window: float = 0.0, shared: bool = False, pretty: bool = False,
+                 sync_every: int = 100, sync_interval: float = 1.0, compact_after: int = 10_000) -> None:
+        super().__init__(database_path, commit_window, shared, pretty)
+        self.log_path = database_path + ".wal"
+
+        # The log is fsynced once sync_every entries or sync_interval seconds have built up since the last sync
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+
+        self._log_file = None
+        self._log_header = b""
+        # The length of the log that has been applied to the resident records
+        self._log_offset = 0
+        self._log_entries = 0
+        self._unsynced_entries = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self) -> None:
+        """
+        Forces any log entries that have not been fsynced yet onto the disk
+        """
+        if self._log_file is not None and self._unsynced_entries:
+            os.fsync(self._log_file.fileno())
+
+        self._unsynced_entries = 0
+        self._last_sync = time.monotonic()
+
+    def close(self) -> None:
+        super().close()
+        self._close_log()
+
+    def _close_log(self) -> None:
+        if self._log_file is not None:
+            self.sync()
+            self._log_file.close()
+            self._log_file = None
+
+    def _commit(self, changes: list[tuple]) -> None:
+        started = time.perf_counter()
+        lines = b"".join(self._encode_change(change) for change in changes)
+        SERIALIZE_DURATION.observe(time.perf_counter() - started, target="log")
+
+        self._log_file.write(lines)
+        self._log_file.flush()
+        BYTES_WRITTEN.inc(len(lines), file="log")
+
+        self._log_offset += len(lines)
+        self._log_entries += len(changes)
+        self._unsynced_entries += len(changes)
+
+        if self._log_entries >= self.compact_after and self._compact(len(changes)):
+            return
+
+        if (self._unsynced_entries >= self.sync_every
+                or time.monotonic() - self._last_sync >= self.sync_interval):
+            self.sync()
+        elif self._coordinator is not None:
+            # Shared changes are committed by the thread that made them, so the writer is woken
+            # to sync the entries left unsynced once sync_interval has passed
+            self._writer.wake()
+
+    def _writer_idle(self) -> float | None:
+        # Entries left unsynced by the last commit are synced sync_interval after the last sync,
+        # even if no further commit comes along to do it
+        with self._lock:
+            if not self._unsynced_entries:
+                return None
+
+            remaining = self.sync_interval - (time.monotonic() - self._last_sync)
+
+            if remaining > 0:
+                return remaining
+
+            try:
+                self.sync()
+            except OSError:
+                # The entries are left for the next commit to sync, which raises the error to its caller
+                pass
+
+            return None
+
+    def _compact(self, committed_changes: int) -> bool:
+        """
+        Writes all records to the database file and starts a new, empty log.
+        The snapshot must only hold changes that are already in the log, so compaction is put off
+        (returning False) if changes beyond those just committed have been applied to the resident records
+        """
+        with self._lock:
+            if self._uncommitted_changes != committed_changes:
+                return False
+
+            table = self._table.copy()
+
+        data = self._serialize(table)
+        self._write_snapshot(data)
+        self._reset_log(self._snapshot_checksum(data))
+        return True
+
+    def _snapshot_checksum(self, data: bytes) -> int:
+        return zlib.crc32(data)
+
+    def _load(self) -> None:
+        checked_at, stat, data = self._read_snapshot()
+        self._parse_snapshot(data)
+        self._replay_log(self._snapshot_checksum(data))
+        self._remember(stat, checked_at)
+
+    def _catch_up(self) -> None:
+        """
+        Replays the entries other processes have appended to the log, or reloads everything if the
+        snapshot has changed (e.g. the log was compacted) since it was loaded
+        """
+        stat = os.stat(self.database_path)
+
+        if self._log_file is None or self._racy or self._signature != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            self._load()
+            return
+
+        with open(self.log_path, "rb") as log_file:
+            if log_file.readline() != self._log_header:
+                self._load()
+                return
+
+            log_file.seek(self._log_offset)
+            entries = log_file.readlines()
+
+        BYTES_READ.inc(sum(map(len, entries)), file="log")
+        self._apply_entries(entries)
+
+    def _replay_log(self, snapshot_checksum: int) -> None:
+        """
+        Applies the entries of the log to the records loaded from the snapshot
+        """
+        self._close_log()
+
+        try:
+            with open(self.log_path, "rb") as log_file:
+                header = log_file.readline()
+                entries = log_file.readlines()
+        except FileNotFoundError:
+            header, entries = b"", []
+
+        BYTES_READ.inc(len(header) + sum(map(len, entries)), file="log")
+
+        try:
+            log_checksum = json.loads(header)["snapshot"]
+        except (ValueError, KeyError, TypeError):
+            log_checksum = None
+
+        if log_checksum != snapshot_checksum:
+            self._reset_log(snapshot_checksum)
+            return
+
+        self._log_header = header
+        self._log_offset = len(header)
+        self._log_entries = 0
+        self._apply_entries(entries)
+
+        # A crash part way through appending can leave an incomplete last entry, which is dropped
+        self._log_file = open(self.log_path, "ab")
+        self._log_file.truncate(self._log_offset)
+
+    def _apply_entries(self, entries: list[bytes]) -> None:
+        started = time.perf_counter()
+
+        for entry in entries:
+            if not entry.endswith(b"\n"):
+                break
+
+            self._apply_change(json.loads(entry))
+            self._log_offset += len(entry)
+            self._log_entries += 1
+
+        PARSE_DURATION.observe(time.perf_counter() - started, file="log")
+
+    def _apply_change(self, entry: list) -> None:
+        operation, *records = entry
+        record_ids = [self._table.find(tuple(fields)) for fields in records]
+
+        match operation:
+            case "add" if record_ids[0] is None:
+                self._insert(AddressBookRecord(*records[0]))
+            case "replace" if record_ids[0] is not None and record_ids[1] is None:
+                self._update(record_ids[0], AddressBookRecord(*records[1]))
+            case "delete" if record_ids[0] is not None:
+                self._delete(record_ids[0])
+
+    def _encode_change(self, change: tuple) -> bytes:
+        operation, *records = change
+        return json.dumps([operation, *(record.key() for record in records)], separators=(",", ":")).encode() + b"\n"
+
+    def _reset_log(self, snapshot_checksum: int) -> None:
+        if self._log_file is not None:
+            self._log_file.close()
+
+        self._log_header = json.dumps({"snapshot": snapshot_checksum}).encode() + b"\n"
+
+        with open(self.log_path, "wb") as log_file:
+            log_file.write(self._log_header)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+        self._log_file = open(self.log_path, "ab")
+        self._log_offset = len(self._log_header)
+        self._log_entries = 0
+        self._unsynced_entries = 0
+        self._last_sync = time.monotonic()
+
+
+class SnapshotStorage(WALStorage):
+    """
+    Keeps the records in a binary snapshot file (see snapshot.py) rather than a JSON file,
+    with changes appended to a write-ahead log and compacted into a new snapshot like WALStorage.
+    The snapshot is memory mapped rather than read, so opening even a large address book takes milliseconds:
+    records are only decoded as they are read, and exact searches are answered from the snapshot's index sections.
+    Changes made since the snapshot are held in memory on top of it
+    """
+    def build_indexes(self) -> None:
+        # Exact searches are answered from the snapshot's own index, building the other indexes would decode
+        # every record and give up the snapshot's fast opening, so they are still only built when first needed
+        self.data_version()
+
+    def _encode_snapshot(self, records: Iterable[AddressBookRecord]) -> bytes:
+        return encode_snapshot(records)
+
+    def _snapshot_checksum(self, data: bytes) -> int:
+        return snapshot_checksum(data)
+
+    def _compact(self, committed_changes: int) -> bool:
+        if not super()._compact(committed_changes):
+            return False
+
+        # The resident changes can be dropped in favour of the new snapshot,
+        # unless changes that are not in it have been applied since it was written
+        with self._lock:
+            if self._uncommitted_changes == committed_changes:
+                self._map_snapshot(MappedSnapshot(self.database_path))
+
+        return True
+
+    def _load(self) -> None:
+        checked_at = time.time_ns()
+        started = time.perf_counter()
+        snapshot = MappedSnapshot(self.database_path)
+        self._map_snapshot(snapshot)
+        PARSE_DURATION.observe(time.perf_counter() - started, file="snapshot")
+        self._replay_log(snapshot.checksum)
+        self._remember(snapshot.stat, checked_at)
+
+    def _map_snapshot(self, snapshot: MappedSnapshot) -> None:
+        self._version += 1
+        self._table = SnapshotTable(snapshot)
+        self._index = SnapshotFieldIndex(snapshot)
+        self._text_indexes.clear()
+        self._phone_index = None
+
+
+# The number of records SQLiteStorage.iter_search fetches at a time
+ITER_PAGE_SIZE = 1000
+
+
+class SQLiteStorage(StorageEngine):
+    """
+    Keeps the records in an SQLite database rather than in memory,
+    with an index on each field so searches are answered by the database.
+    The canonical key of each phone number is kept in its own indexed column, which exact phone searches match.
+    The connection uses WAL journaling and is shared between threads behind a lock.
+    SQL statements are built from fixed strings with bound parameters,
+    so sqlite3 reuses its prepared statement for each of them
+    """
+    def __init__(self, database_path: str) -> None:
+        self.database_path = database_path
+        self._lock = TimedLock(threading.Lock(), "sqlite")
+        # Changes made through this connection, and the last PRAGMA data_version seen, which only changes
+        # when another connection commits
+        self._version = 0
+        self._external_version = None
+        self.change_log = ChangeLog()
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.create_function("edit_distance", 3, bounded_edit_distance, deterministic=True)
+        self._connection.create_function("normalize_phone", 1, normalize_phone, deterministic=True)
+
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "id INTEGER PRIMARY KEY, first_name TEXT NOT NULL, last_name TEXT NOT NULL, "
+                "phone TEXT NOT NULL, email TEXT NOT NULL, phone_key TEXT NOT NULL DEFAULT '', "
+                "UNIQUE (first_name, last_name, phone, email))"
+            )
+
+            # Databases created before phone numbers had a canonical key are given one
+            if "phone_key" not in {row[1] for row in self._connection.execute("PRAGMA table_info(records)")}:
+                self._connection.execute("ALTER TABLE records ADD COLUMN phone_key TEXT NOT NULL DEFAULT ''")
+                self._connection.execute("UPDATE records SET phone_key = normalize_phone(phone)")
+
+            for field in INDEXED_FIELDS + ("phone_key",):
+                self._connection.execute(f"CREATE INDEX IF NOT EXISTS records_{field} ON records ({field})")
+
+    def data_version(self) -> int:
+        with self._lock:
+            external_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+
+            if external_version != self._external_version:
+                # Changes committed by other connections are not in the change log
+                if self._external_version is not None:
+                    self.change_log.reset()
+
+                self._external_version = external_version
+                self._version += 1
+
+            return self._version
+
+    def search(self, offset: int = 0, limit: int | None = None, mode: SearchMode = SearchMode.EXACT,
+               **fields: str) -> list[AddressBookRecord]:
+        with self._lock:
+            rows = self._select(offset, limit, mode, fields)
+
+        RECORDS_RETURNED.inc(len(rows), mode=mode.value)
+        return [AddressBookRecord(*row) for row in rows]
+
+    def search_many(self, queries: list[SearchQuery]) -> list[list[AddressBookRecord]]:
+        # The queries are run in one read transaction, which sees a single snapshot of the database
+        with self._lock:
+            self._connection.execute("BEGIN")
+
+            try:
+                results = [self._select(query.offset, query.limit, query.mode, query.fields()) for query in queries]
+            finally:
+                self._connection.execute("COMMIT")
+
+        for query, rows in zip(queries, results):
+            RECORDS_RETURNED.inc(len(rows), mode=query.mode.value)
+
+        return [[AddressBookRecord(*row) for row in rows] for rows in results]
+
+    def search_phone(self, phone: str, match: PhoneMatch = PhoneMatch.NUMBER, offset: int = 0,
+                     limit: int | None = None) -> list[AddressBookRecord]:
+        # Canonical keys only hold digits and +, so GLOB (which can use the index) matches area codes literally.
+        # There is no index on the end of the keys, so suffixes are matched by comparing every row
+        match match:
+            case PhoneMatch.NUMBER:
+                condition, parameters = "phone_key = ?", [normalize_phone(phone)]
+            case PhoneMatch.SUFFIX:
+                digits = phone_digits(phone)
+                condition, parameters = "substr(phone_key, -?) = ?", [len(digits), digits]
+            case PhoneMatch.AREA_CODE:
+                condition, parameters = "phone_key GLOB ?", [normalize_phone(phone) + "*"]
+
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT first_name, last_name, phone, email FROM records WHERE {condition} "
+                "ORDER BY id LIMIT ? OFFSET ?", parameters + [-1 if limit is None else limit, offset]
+            ).fetchall()
+
+        return [AddressBookRecord(*row) for row in rows]
+
+    def iter_search(self, **fields: str) -> Iterator[AddressBookRecord]:
+        """
+        Fetches the matching records a page at a time.
+        Each page continues from the id of the last record fetched,
+        so the lock is not held between pages and records are not skipped if earlier records are deleted
+        """
+        conditions, parameters = self._conditions(fields)
+        where = self._where(conditions + ["id > ?"])
+        last_id = -1
+
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT id, first_name, last_name, phone, email FROM records{where} ORDER BY id LIMIT ?",
+                    parameters + [last_id, ITER_PAGE_SIZE]
+                ).fetchall()
+
+            for _, *fields_of_row in rows:
+                yield AddressBookRecord(*fields_of_row)
+
+            if len(rows) < ITER_PAGE_SIZE:
+                return
+
+            last_id = rows[-1][0]
+
+    def contains(self, record: AddressBookRecord) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM records WHERE first_name = ? AND last_name = ? AND phone = ? AND email = ?",
+                record.key()
+            ).fetchone()
+
+        return row is not None
+
+    def add_many(self, records: list[AddressBookRecord]) -> list[bool]:
+        # Changes are recorded once they are committed, but before the lock is released so they are in order
+        with self._lock:
+            with self._connection:
+                self._version += 1
+                added = [self._connection.execute(
+                    "INSERT OR IGNORE INTO records (first_name, last_name, phone, email, phone_key) "
+                    "VALUES (?, ?, ?, ?, ?)", record.key() + (normalize_phone(record.phone),)
+                ).rowcount == 1 for record in records]
+
+            self.change_log.record([(ADD, record) for record, was_added in zip(records, added) if was_added])
+
+        return added
+
+    def replace(self, old_record: AddressBookRecord, new_record: AddressBookRecord) -> bool:
+        with self._lock:
+            try:
+                with self._connection:
+                    self._version += 1
+                    cursor = self._connection.execute(
+                        "UPDATE records SET first_name = ?, last_name = ?, phone = ?, email = ?, phone_key = ? "
+                        "WHERE first_name = ? AND last_name = ? AND phone = ? AND email = ?",
+                        new_record.key() + (normalize_phone(new_record.phone),) + old_record.key()
+                    )
+            except sqlite3.IntegrityError:
+                # new_record is equal to a different stored record
+                return False
+
+            if cursor.rowcount == 1:
+                self.change_log.record([(REPLACE, old_record, new_record)])
+
+        return cursor.rowcount == 1
+
+    def remove_many(self, records_to_remove: list[AddressBookRecord]) -> list[bool]:
+        with self._lock:
+            with self._connection:
+                self._version += 1
+                removed = [self._connection.execute(
+                    "DELETE FROM records WHERE first_name = ? AND last_name = ? AND phone = ? AND email = ?",
+                    record.key()
+                ).rowcount == 1 for record in records_to_remove]
+
+            self.change_log.record([(DELETE, record) for record, was_removed in zip(records_to_remove, removed)
+                                    if was_removed])
+
+        return removed
+
+    def remove_matching(self, **fields: str) -> list[AddressBookRecord]:
+        conditions, parameters = self._conditions(fields)
+        where = self._where(conditions)
+
+        with self._lock:
+            with self._connection:
+                self._version += 1
+                rows = self._connection.execute(
+                    f"SELECT first_name, last_name, phone, email FROM records{where} ORDER BY id", parameters
+                ).fetchall()
+                self._connection.execute(f"DELETE FROM records{where}", parameters)
+
+            removed_records = [AddressBookRecord(*row) for row in rows]
+            self.change_log.record([(DELETE, record) for record in removed_records])
+
+        return removed_records
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _select(self, offset: int, limit: int | None, mode: SearchMode, fields: dict[str, str]) -> list[tuple]:
+        """
+        Selects the fields of the matching records, which must be done while holding the lock
+        """
+        conditions, parameters = self._conditions(fields, mode)
+        order, order_parameters = self._order(fields, mode)
+
+        # A negative limit means no limit to SQLite
+        return self._connection.execute(
+            f"SELECT first_name, last_name, phone, email FROM records{self._where(conditions)} "
+            f"ORDER BY {order} LIMIT ? OFFSET ?",
+            parameters + order_parameters + [-1 if limit is None else limit, offset]
+        ).fetchall()
+
+    def _conditions(self, fields: dict[str, str],
+                    mode: SearchMode = SearchMode.EXACT) -> tuple[list[str], list]:
+        # Only the fixed field names are put into the SQL, the values are always bound as parameters
+        matched_fields = [field for field in INDEXED_FIELDS if fields.get(field)]
+        values = [fields[field] for field in matched_fields]
+
+        # LIKE is case-insensitive for ASCII, which covers every character allowed in a name, phone or email
+        match mode:
+            case SearchMode.EXACT:
+                # A phone with no digits has an empty key and matches no number, comparing with NULL matches nothing
+                return ([f"{'phone_key' if field == 'phone' else field} = ?" for field in matched_fields],
+                        [field_key(field, value) or None for field, value in zip(matched_fields, values)])
+            case SearchMode.IGNORE_CASE:
+                return [f"{field} = ? COLLATE NOCASE" for field in matched_fields], values
+            case SearchMode.PREFIX:
+                return ([f"{field} LIKE ? ESCAPE '\\'" for field in matched_fields],
+                        [self._escape_like(value) + "%" for value in values])
+            case SearchMode.SUBSTRING:
+                return ([f"{field} LIKE ? ESCAPE '\\'" for field in matched_fields],
+                        ["%" + self._escape_like(value) + "%" for value in values])
+            case SearchMode.FUZZY:
+                # There is no index to narrow down fuzzy matches, so every record is compared
+                return ([f"edit_distance(lower({field}), ?, {FUZZY_MAX_DISTANCE}) IS NOT NULL"
+                         for field in matched_fields], [value.casefold() for value in values])
+
+    def _order(self, fields: dict[str, str], mode: SearchMode) -> tuple[str, list]:
+        if mode is not SearchMode.FUZZY or not any(fields.values()):
+            return "id", []
+
+        matched_fields = [field for field in INDEXED_FIELDS if fields.get(field)]
+        distance = " + ".join(f"edit_distance(lower({field}), ?, {FUZZY_MAX_DISTANCE})" for field in matched_fields)
+        return f"{distance}, id", [fields[field].casefold() for field in matched_fields]
+
+    def _escape_like(self, value: str) -> str:
+        return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    def _where(self, conditions: list[str]) -> str:
+        return " WHERE " + " AND ".join(conditions) if conditions else ""
+
+
+def create_storage(database_path: str, backend: StorageBackend = StorageBackend.JSON,
+                   shared: bool = False, pretty: bool = False) -> StorageEngine:
+    """
+    Creates the storage used by AddressBookAPI for the chosen backend.
+    shared must be set if other processes use the same database at the same time,
+    SQLite databases can always be shared so it is not needed for them.
+    pretty indents the JSON file of the JSON and WAL backends
+    """
+    match backend:
+        case StorageBackend.JSON:
+            return JSONFileStorage(database_path, shared=shared, pretty=pretty)
+        case StorageBackend.WAL:
+            return WALStorage(database_path, shared=shared, pretty=pretty)
+        case StorageBackend.SQLITE:
+            return SQLiteStorage(database_path)
+        case StorageBackend.SNAPSHOT:
+            return SnapshotStorage(database_path, shared=shared)
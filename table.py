@@ -0,0 +1,155 @@
+from record import AddressBookRecord
+from collections.abc import Iterator
+import sys
+
+
+class RecordTable:
+    """
+    Compact in-memory table of records, holding each field in its own column (a list indexed by row id)
+    rather than as one object per record. AddressBookRecord objects are only built when a row is read.
+
+    Names are interned, so the many records sharing a name share one string. Emails are kept whole rather than
+    split to intern their domain, as the exact match index already holds a reference to each full email.
+    Row ids increase in the order rows are added, a removed row is left empty so later rows keep their ids.
+    Rows are found by the hash of their key, so no key tuple is kept per record
+    """
+    def __init__(self) -> None:
+        self._first_names: list[str | None] = []
+        self._last_names: list[str | None] = []
+        self._phones: list[str | None] = []
+        self._emails: list[str | None] = []
+
+        # Maps the hash of each row's key to its row, or to a list of rows if keys share a hash
+        self._rows_by_hash: dict[int, int | list[int]] = {}
+        self._live_rows = 0
+
+    def __len__(self) -> int:
+        return self._live_rows
+
+    @property
+    def empty_rows(self) -> int:
+        """
+        The number of rows left empty by removed records
+        """
+        return len(self._phones) - self._live_rows
+
+    def append(self, record: AddressBookRecord) -> int:
+        """
+        Adds the record as a new row, returning its row id
+        """
+        row = len(self._phones)
+        self._first_names.append(None)
+        self._last_names.append(None)
+        self._phones.append(None)
+        self._emails.append(None)
+
+        self.set(row, record)
+        return row
+
+    def set(self, row: int, record: AddressBookRecord) -> None:
+        """
+        Stores the record in the row, replacing any record already there
+        """
+        if self._phones[row] is not None:
+            self._forget(row)
+        else:
+            self._live_rows += 1
+
+        self._first_names[row] = sys.intern(record.first_name)
+        self._last_names[row] = sys.intern(record.last_name)
+        self._phones[row] = record.phone
+        self._emails[row] = record.email
+
+        self._remember(row)
+
+    def get(self, row: int) -> AddressBookRecord:
+        return AddressBookRecord(*self._key(row))
+
+    def remove(self, row: int) -> AddressBookRecord:
+        """
+        Empties the row, returning the record that was in it
+        """
+        record = self.get(row)
+        self._forget(row)
+        self._live_rows -= 1
+
+        self._first_names[row] = self._last_names[row] = self._phones[row] = self._emails[row] = None
+
+        return record
+
+    def find(self, key: tuple[str, str, str, str]) -> int | None:
+        """
+        Returns the row holding the record with the key (see AddressBookRecord.key), or None if there is none
+        """
+        rows = self._rows_by_hash.get(hash(key))
+
+        if rows is None:
+            return None
+
+        for row in rows if isinstance(rows, list) else (rows,):
+            if self._key(row) == key:
+                return row
+
+        return None
+
+    def rows(self) -> Iterator[int]:
+        """
+        Returns an iterator over the ids of the rows holding records, in the order they were added
+        """
+        return (row for row, phone in enumerate(self._phones) if phone is not None)
+
+    def items(self) -> Iterator[tuple[int, AddressBookRecord]]:
+        return ((row, self.get(row)) for row in self.rows())
+
+    def records(self) -> Iterator[AddressBookRecord]:
+        return (self.get(row) for row in self.rows())
+
+    def copy(self) -> "RecordTable":
+        """
+        Returns a copy of the table, copying the columns but not the strings in them.
+        Used to take a consistent view of the records quickly, which can then be read without holding a lock.
+        The copy can only be read by row, find always returns None
+        """
+        table = RecordTable.__new__(RecordTable)
+        table._first_names = self._first_names.copy()
+        table._last_names = self._last_names.copy()
+        table._phones = self._phones.copy()
+        table._emails = self._emails.copy()
+        table._rows_by_hash = {}
+        table._live_rows = self._live_rows
+
+        return table
+
+    def clear(self) -> None:
+        for column in (self._first_names, self._last_names, self._phones, self._emails):
+            column.clear()
+
+        self._rows_by_hash.clear()
+        self._live_rows = 0
+
+    def _key(self, row: int) -> tuple[str, str, str, str]:
+        return (self._first_names[row], self._last_names[row], self._phones[row], self._emails[row])
+
+    def _remember(self, row: int) -> None:
+        key_hash = hash(self._key(row))
+        rows = self._rows_by_hash.get(key_hash)
+
+        if rows is None:
+            self._rows_by_hash[key_hash] = row
+        elif isinstance(rows, list):
+            rows.append(row)
+        else:
+            self._rows_by_hash[key_hash] = [rows, row]
+
+    def _forget(self, row: int) -> None:
+        key_hash = hash(self._key(row))
+        rows = self._rows_by_hash[key_hash]
+
+        if not isinstance(rows, list):
+            del self._rows_by_hash[key_hash]
+            return
+
+        rows.remove(row)
+
+        if len(rows) == 1:
+            self._rows_by_hash[key_hash] = rows[0]
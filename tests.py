@@ -1,10 +1,31 @@
-from api import AddressBookAPI
+from api import AddressBookAPI, ResponseCode
+from async_api import AsyncAddressBookAPI
 from record import AddressBookRecord, AddressBookRecordEncoder, AddressBookRecordDecoder
 from app import FastAPIWrapper, ENDPOINTS
+from storage import RecordTable, SearchQuery, StorageBackend
+from index import SearchMode
+from phone import PhoneMatch, normalize_phone
+from serialization import encode_records, decode_records
+from cache import ResultCache
+from changes import Change
+from metrics import BYTES_READ, Registry, SamplingProfiler
+from snapshot import MappedSnapshot, is_snapshot, json_to_snapshot, snapshot_to_json
+from sharding import Shard, ShardedStorage, reshard, shard_of, shard_paths
+from validation import field_error, record_error, validate_records, validate_rows
+import benchmark
+import shared
 from fastapi.testclient import TestClient
+from pydantic import TypeAdapter, ValidationError
 from dataclasses import asdict, replace
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import asyncio
+import multiprocessing
 import unittest
 import json
+import os
+import threading
+import time
 
 
 class TestAPI(unittest.TestCase):
@@ -83,109 +104,1352 @@ class TestAPI(unittest.TestCase):
         for record in records_to_add:
             self.assertIn(record, database_records)
 
+    def test_add_records(self) -> None:
+        """
+        Tests that a batch of records can be added at once,
+        with records already in the database or repeated in the batch reported as existing
+        """
+        records_to_add = [
+            AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk"),
+            AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk"),
+            AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+        ]
+
+        api_responses = self.api.add_records(records_to_add).data
+        database_records = self.read_records_from_database()
+
+        self.assertListEqual([ResponseCode.OK, ResponseCode.ALREADY_EXISTS, ResponseCode.ALREADY_EXISTS],
+                             [api_response.response_code for api_response in api_responses])
+        self.assertTrue(database_records.count(records_to_add[0]) == 1)
+
+    def test_add_invalid_records(self) -> None:
+        """
+        Tests that records with an invalid field are refused, alone or within a batch, and are not added
+        """
+        valid_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+        invalid_records = [
+            AddressBookRecord("Chesney1", "Brown", "01913606138", "chesney.brown@corrie.co.uk"),
+            AddressBookRecord("Chesney", "Brown", "01913606138\n", "chesney.brown@corrie")
+        ]
+
+        api_response = self.api.add_record(invalid_records[0])
+        api_responses = self.api.add_records([invalid_records[0], valid_record, invalid_records[1]]).data
+        database_records = self.read_records_from_database()
+
+        self.assertEqual(ResponseCode.INVALID_FIELD, api_response.response_code)
+        self.assertListEqual([ResponseCode.INVALID_FIELD, ResponseCode.OK, ResponseCode.INVALID_FIELD],
+                             [api_response.response_code for api_response in api_responses])
+        self.assertEqual("phone: String should match pattern '^\\d+$'; "
+                         "email: String should match pattern '^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\\.[a-zA-Z]{2,}$'",
+                         api_responses[2].data)
+        self.assertIn(valid_record, database_records)
+
+        for record in invalid_records:
+            self.assertNotIn(record, database_records)
+
+    def test_add_records_concurrently(self) -> None:
+        """
+        Tests that no record is lost when records are added from several threads at once
+        """
+        records_to_add = [AddressBookRecord("Chesney", "Brown", f"0191360{number:04}", "chesney.brown@corrie.co.uk")
+                          for number in range(200)]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(self.api.add_record, records_to_add))
+
+        database_records = self.read_records_from_database()
+
+        for record in records_to_add:
+            self.assertIn(record, database_records)
+
+    def test_edit_record(self) -> None:
+        """
+        Tests that an existing record can be edited
+        """
+        new_phone_number = "01913633216"
+        record_to_edit = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+        edited_record = AddressBookRecord("Chesney", "Brown", new_phone_number, "chesney.brown@corrie.co.uk")
+
+        self.add_record_to_database(record_to_edit)
+        self.api.edit_record(record_to_edit, new_phone=new_phone_number)
+
+        records_after_edit = self.read_records_from_database()
+
+        self.assertIn(edited_record, records_after_edit)
+        self.assertNotIn(record_to_edit, records_after_edit)
+
+    def test_edit_non_existing_record(self) -> None:
+        """
+        Tests that trying to edit a non-existing record
+        fails gracefully
+        """
+        non_existing_record = AddressBookRecord("", "", "", "")
+        api_response = self.api.edit_record(non_existing_record, new_phone="01545173738")
+
+        self.assertTrue(api_response)
+
+    def test_edit_record_invalid_field(self) -> None:
+        """
+        Tests that a record can not be edited to hold an invalid field, including one with a trailing newline
+        """
+        records = self.read_records_from_database()
+
+        for new_fields in [{"new_first_name": "David2"}, {"new_last_name": "Platt\n"}, {"new_phone": "0191 347"},
+                           {"new_email": "david.platt@corrie"}]:
+            api_response = self.api.edit_record(records[0], **new_fields)
+
+            self.assertEqual(ResponseCode.INVALID_FIELD, api_response.response_code)
+            self.assertEqual(next(iter(new_fields.values())), api_response.data)
+
+        self.assertListEqual(records, self.read_records_from_database())
+
+    def test_edit_record_into_existing_record(self) -> None:
+        """
+        Tests that a record can not be edited to duplicate another record
+        """
+        records = self.read_records_from_database()
+        api_response = self.api.edit_record(records[0], new_first_name=records[1].first_name,
+                                            new_last_name=records[1].last_name, new_phone=records[1].phone,
+                                            new_email=records[1].email)
+
+        self.assertEqual(ResponseCode.ALREADY_EXISTS, api_response.response_code)
+        self.assertListEqual(records, self.read_records_from_database())
+
+    def test_delete_specific_record(self) -> None:
+        """
+        Tests that a record can be deleted from the database
+        """
+        record_to_delete = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+        self.add_record_to_database(record_to_delete)
+        self.api.delete_specific_record(record_to_delete)
+
+        records_after_delete = self.read_records_from_database()
+
+        self.assertNotIn(record_to_delete, records_after_delete)
+
+    def test_delete_matching_records(self) -> None:
+        """
+        Tests that records with a matching field can be deleted
+        """
+        test_records = [
+            AddressBookRecord("Phil", "Mitchell", "01895521739", "phil.mitchell@ee.co.uk"),
+            AddressBookRecord("Billy", "Mitchell", "01895521732", "billy.mitchell@ee.co.uk")
+        ]
+
+        for record in test_records:
+            self.add_record_to_database(record)
+
+        self.api.delete_matching_records(last_name="Mitchell")
+
+        records_after_delete = self.read_records_from_database()
+
+        for record in test_records:
+            self.assertNotIn(record, records_after_delete)
+
+    def test_delete_matching_phone_without_digits(self) -> None:
+        """
+        Tests that a phone with no digits matches no record, not even one whose number is only a prefix (e.g. 0),
+        so deleting by it deletes nothing
+        """
+        zero_record = AddressBookRecord("Phil", "Mitchell", "0", "phil.mitchell@ee.co.uk")
+        self.add_record_to_database(zero_record)
+
+        self.assertListEqual([], self.api.search_records(phone="x").data)
+        self.assertListEqual([], self.api.delete_matching_records(phone="abc").data)
+        self.assertListEqual([], self.api.search_records(phone="00").data)
+        self.assertListEqual([zero_record], self.api.search_records(phone="0").data)
+        self.assertIn(zero_record, self.read_records_from_database())
+
+    def test_delete_most_records(self) -> None:
+        """
+        Tests that the remaining records keep their order and can still be found
+        once the rows left by deleted records are reclaimed
+        """
+        records = self.api.list_records().data
+        new_record = AddressBookRecord("Phil", "Mitchell", "01895521739", "phil.mitchell@ee.co.uk")
+
+        with patch("storage.RECLAIM_MIN_EMPTY_ROWS", 1):
+            self.api.delete_specific_records(records[:2])
+            self.api.delete_specific_record(records[2])
+            self.api.add_record(new_record)
+
+        self.assertEqual(0, self.api.storage._table.empty_rows)
+        self.assertListEqual([records[3], new_record], self.api.list_records().data)
+        self.assertListEqual(records[3:], self.api.search_records(last_name="Sullivan").data)
+        self.assertEqual(ResponseCode.ALREADY_EXISTS, self.api.add_record(records[3]).response_code)
+
+    def test_list_records(self) -> None:
+        """
+        Tests that all records can be retrieved
+        """
+        database_records = self.read_records_from_database()
+        api_records = self.api.list_records().data
+
+        self.assertListEqual(database_records, api_records)
+
+    def test_list_records_after_external_change(self) -> None:
+        """
+        Tests that changes made to the database file outside of the API are picked up,
+        even when the file size does not change
+        """
+        self.api.list_records()
+
+        database_records = self.read_records_from_database()
+        database_records[0] = replace(database_records[0], phone="01913000000")
+
+        with open(self.ADDRESS_BOOK_FILE_PATH, "w") as database_file:
+            json.dump(database_records, database_file, indent=4, cls=AddressBookRecordEncoder)
+
+        api_records = self.api.list_records().data
+
+        self.assertListEqual(database_records, api_records)
+
+    def test_search_records(self) -> None:
+        """
+        Tests that the database can be searched
+        """
+        search_first_name = "Billy"
+
+        test_records = [
+            AddressBookRecord("Billy", "Mayhew", "01913763249", "billy.mayhew@corrie.co.uk"),
+            AddressBookRecord("Billy", "Mitchell", "01895521732", "billy.mitchell@ee.co.uk")
+        ]
+
+        for record in test_records:
+            self.add_record_to_database(record)
+        
+        found_records = self.api.search_records(first_name=search_first_name).data
+
+        self.assertListEqual(test_records, found_records)
+
+    def test_search_records_after_edit(self) -> None:
+        """
+        Tests that searches reflect edits and deletes made through the API
+        """
+        old_phone_number = "01913478234"
+        new_phone_number = "01913633216"
+        record_to_edit = self.api.search_records(phone=old_phone_number).data[0]
+
+        edited_record = self.api.edit_record(record_to_edit, new_phone=new_phone_number).data
+
+        self.assertListEqual([], self.api.search_records(phone=old_phone_number).data)
+        self.assertListEqual([edited_record], self.api.search_records(phone=new_phone_number).data)
+
+        self.api.delete_specific_record(edited_record)
+
+        self.assertListEqual([], self.api.search_records(phone=new_phone_number).data)
+
+    def test_search_records_pages(self) -> None:
+        """
+        Tests that pages of the search results follow the order the records were added in
+        """
+        test_records = [
+            AddressBookRecord("Billy", "Mayhew", "01913763249", "billy.mayhew@corrie.co.uk"),
+            AddressBookRecord("Billy", "Mitchell", "01895521732", "billy.mitchell@ee.co.uk"),
+            AddressBookRecord("Billy", "Kennedy", "01913763250", "billy.kennedy@corrie.co.uk")
+        ]
+
+        for record in test_records:
+            self.add_record_to_database(record)
+
+        first_page = self.api.search_records(first_name="Billy", limit=2).data
+        second_page = self.api.search_records(first_name="Billy", offset=2, limit=2).data
+
+        self.assertListEqual(test_records, first_page + second_page)
+
+    def test_search_multiple_records(self) -> None:
+        """
+        Tests that the database can be searched using multiple fields
+        """
+        search_first_name = "Jason"
+        search_last_name = "Smith"
+
+        test_records = [
+            AddressBookRecord("Jason", "Smith", "01354658717", "jason.smith@email.com"),
+            AddressBookRecord("Jason", "Smith", "01354658617", "jason.smith2@email.com")
+        ]
+
+        for record in test_records:
+            self.add_record_to_database(record)
+        
+        found_records = self.api.search_records(first_name=search_first_name, last_name=search_last_name).data
+
+        self.assertListEqual(test_records, found_records)
+
+    def test_search_records_prefix_and_substring(self) -> None:
+        """
+        Tests that prefix and substring searches ignore case, and follow edits made through the API
+        """
+        test_records = [
+            AddressBookRecord("Jonathan", "Smith", "01354658717", "jonathan.smith@email.com"),
+            AddressBookRecord("Joe", "Smithson", "01354658617", "joe.smithson@email.com"),
+            AddressBookRecord("Jack", "Smith", "01354658517", "jack.smith@email.com")
+        ]
+
+        for record in test_records:
+            self.add_record_to_database(record)
+
+        self.assertListEqual(test_records[:2], self.api.search_records(first_name="jo", last_name="SMITH",
+                                                                       mode=SearchMode.PREFIX).data)
+        self.assertListEqual([test_records[1]], self.api.search_records(email="thso",
+                                                                        mode=SearchMode.SUBSTRING).data)
+        self.assertListEqual(test_records[:1], self.api.search_records(first_name="jonathan", last_name="smith",
+                                                                       mode=SearchMode.IGNORE_CASE).data)
+
+        edited_record = self.api.edit_record(test_records[2], new_first_name="Johnny").data
+
+        self.assertListEqual(test_records[:2] + [edited_record],
+                             self.api.search_records(first_name="Jo", last_name="Smith",
+                                                     mode=SearchMode.PREFIX).data)
+
+    def test_search_records_prefix_pages(self) -> None:
+        """
+        Tests that a page of a prefix or substring search holds the same records as the same slice of every match,
+        including after records are edited and deleted
+        """
+        names = [("Jo", "Smith"), ("Joe", "Smyth"), ("Jack", "Smithson"), ("John", "Smith"), ("Joan", "Smithers"),
+                 ("Josh", "Jones")]
+        test_records = [AddressBookRecord(first_name, last_name, f"0135465{number:04d}",
+                                          f"{first_name.lower()}@email.com")
+                        for number, (first_name, last_name) in enumerate(names)]
+
+        for record in test_records:
+            self.add_record_to_database(record)
+
+        self.api.edit_record(test_records[0], new_last_name="Smithy")
+        self.api.delete_specific_record(test_records[3])
+
+        for mode, fields in ((SearchMode.PREFIX, {"first_name": "jo", "last_name": "smi"}),
+                             (SearchMode.SUBSTRING, {"first_name": "o", "last_name": "th"}),
+                             (SearchMode.SUBSTRING, {"email": "email"})):
+            all_matches = self.api.search_records(**fields, mode=mode).data
+
+            self.assertGreater(len(all_matches), 1)
+
+            for offset in range(len(all_matches) + 1):
+                self.assertListEqual(all_matches[offset:offset + 2],
+                                     self.api.search_records(**fields, offset=offset, limit=2, mode=mode).data)
+
+    def test_search_records_fuzzy(self) -> None:
+        """
+        Tests that fuzzy searches tolerate typos, return the closest matches first and are capped by the limit
+        """
+        test_records = [
+            AddressBookRecord("Jason", "Smithe", "01354658717", "jason.smithe@email.com"),
+            AddressBookRecord("Jason", "Smith", "01354658617", "jason.smith@email.com"),
+            AddressBookRecord("Jason", "Smythe", "01354658517", "jason.smythe@email.com")
+        ]
+
+        for record in test_records:
+            self.add_record_to_database(record)
+
+        found_records = self.api.search_records(last_name="smyth", mode=SearchMode.FUZZY).data
+
+        self.assertListEqual([test_records[1], test_records[2], test_records[0]], found_records)
+        self.assertListEqual([test_records[1]], self.api.search_records(last_name="smyth", limit=1,
+                                                                        mode=SearchMode.FUZZY).data)
+        self.assertListEqual([], self.api.search_records(last_name="Grimshaw", email="smyth",
+                                                         mode=SearchMode.FUZZY).data)
+
+
+    def test_lookup_phone(self) -> None:
+        """
+        Tests that records can be found by a phone number in a different format, its trailing digits or area code
+        """
+        test_record = AddressBookRecord("Billy", "Mayhew", "01913763249", "billy.mayhew@corrie.co.uk")
+        self.add_record_to_database(test_record)
+
+        self.assertEqual("1913763249", normalize_phone("+44 (0)191 376 3249"))
+        self.assertListEqual([test_record], self.api.lookup_phone("+44 191 376 3249").data)
+        self.assertListEqual([test_record], self.api.lookup_phone("00441913763249").data)
+        self.assertListEqual([test_record], self.api.search_records(phone="441913763249").data)
+        self.assertListEqual([test_record], self.api.lookup_phone("3249", PhoneMatch.SUFFIX).data)
+        self.assertEqual(5, len(self.api.lookup_phone("0191", PhoneMatch.AREA_CODE).data))
+        self.assertEqual(ResponseCode.INVALID_FIELD, self.api.lookup_phone("249", PhoneMatch.SUFFIX).response_code)
+
+        edited_record = self.api.edit_record(test_record, new_phone="01618881234").data
+
+        self.assertListEqual([], self.api.lookup_phone("3249", PhoneMatch.SUFFIX).data)
+        self.assertListEqual([edited_record], self.api.lookup_phone("0161", PhoneMatch.AREA_CODE).data)
+
+    def test_changes(self) -> None:
+        """
+        Tests that each change is returned once after the sequence number it was made after,
+        and that changes made to the file by something else reset the change log
+        """
+        old_record = AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk")
+        new_record = replace(old_record, phone="01913478000")
+        sequence = self.api.changes(0).data.sequence
+
+        self.assertTrue(self.api.changes(0).data.reset)
+        self.assertListEqual([], self.api.changes(sequence).data.changes)
+
+        self.api.edit_record(old_record, new_phone="01913478000")
+        self.api.delete_matching_records(last_name="Platt")
+        self.api.add_record(old_record)
+        api_result = self.api.changes(sequence)
+
+        self.assertFalse(api_result.data.reset)
+        self.assertEqual(sequence + 3, api_result.data.sequence)
+        self.assertListEqual([Change(sequence + 1, "replace", old_record, new_record),
+                              Change(sequence + 2, "delete", new_record),
+                              Change(sequence + 3, "add", old_record)], api_result.data.changes)
+        self.assertListEqual(api_result.data.changes[2:], self.api.changes(sequence + 2).data.changes)
+
+        self.add_record_to_database(AddressBookRecord("Billy", "Platt", "01913763249", "billy.platt@corrie.co.uk"))
+
+        self.assertTrue(self.api.changes(sequence + 3).data.reset)
+
+    def test_search_records_cached(self) -> None:
+        """
+        Tests that repeated searches are answered from the cache, including searches for the same normalised query,
+        and that any change to the records invalidates the cached results
+        """
+        test_record = AddressBookRecord("Billy", "Platt", "01913763249", "billy.platt@corrie.co.uk")
+        # A file modified moments ago is read again on every access in case it is modified again (changing the version)
+        os.utime(self.ADDRESS_BOOK_FILE_PATH, ns=(0, 0))
+        hits = self.api.cache.hits
+
+        first_result = self.api.search_records(last_name="Platt").data
+        first_result.clear()
+
+        self.assertListEqual(self.read_records_from_database()[:1], self.api.search_records(last_name="Platt").data)
+        self.assertListEqual(self.read_records_from_database()[:1], self.api.search_records(phone="+441913478234").data)
+        self.assertListEqual(self.read_records_from_database()[:1],
+                             self.api.search_records(last_name="PLA", mode=SearchMode.PREFIX).data)
+        self.assertListEqual(self.read_records_from_database()[:1],
+                             self.api.search_records(last_name="pla", mode=SearchMode.PREFIX).data)
+        self.assertEqual(hits + 2, self.api.cache.hits)
+
+        self.api.add_record(test_record)
+
+        self.assertEqual(2, len(self.api.search_records(last_name="Platt").data))
+        self.assertEqual(self.api.list_records().data, json.loads(self.api.list_records_json().data.body,
+                                                                  cls=AddressBookRecordDecoder))
+        self.assertEqual(self.api.list_records().data, json.loads(self.api.list_records_json().data.body,
+                                                                  cls=AddressBookRecordDecoder))
+        self.assertEqual(hits + 4, self.api.cache.hits)
+
+        self.api.delete_matching_records(last_name="Platt")
+
+        self.assertListEqual([], self.api.search_records(last_name="Platt").data)
+        self.assertEqual(hits + 4, self.api.cache_stats().data["hits"])
+
+    def test_search_records_cached_phone_without_digits(self) -> None:
+        """
+        Tests that a search for a phone with no digits, which matches nothing, does not share a cache entry
+        with the same search without a phone
+        """
+        os.utime(self.ADDRESS_BOOK_FILE_PATH, ns=(0, 0))
+
+        self.assertListEqual([], self.api.search_records(last_name="Platt", phone="x").data)
+        self.assertListEqual(self.read_records_from_database()[:1], self.api.search_records(last_name="Platt").data)
+
+    def test_search_records_batch(self) -> None:
+        """
+        Tests that a batch of searches gives the same results as searching one at a time, in the order of the queries
+        """
+        queries = [SearchQuery(last_name="Platt"), SearchQuery(first_name="ken", mode=SearchMode.PREFIX), SearchQuery(),
+                   SearchQuery(phone="+44 1913 478234"), SearchQuery(last_name="Platt"),
+                   SearchQuery(email="corrie", mode=SearchMode.SUBSTRING, offset=1, limit=2)]
+
+        batch_results = self.api.search_records_batch(queries).data
+        single_results = [self.api.search_records(query.first_name, query.last_name, query.phone, query.email,
+                                                  query.offset, query.limit, query.mode).data for query in queries]
+
+        self.assertListEqual(single_results, [query_result.data for query_result in batch_results])
+        self.assertListEqual(self.read_records_from_database()[1:3], batch_results[5].data)
+
+        with patch("api.SEARCH_BATCH_MAX_QUERIES", 5):
+            self.assertEqual(ResponseCode.INVALID_FIELD, self.api.search_records_batch(queries).response_code)
+
+    def test_search_records_batch_phone_without_digits(self) -> None:
+        """
+        Tests that a query for a phone with no digits is not answered with the result of the same query without one
+        """
+        queries = [SearchQuery(last_name="Platt"), SearchQuery(last_name="Platt", phone="x")]
+
+        with patch.object(self.api, "cache", ResultCache(max_entries=0)):
+            batch_results = self.api.search_records_batch(queries).data
+
+        self.assertListEqual([self.read_records_from_database()[:1], []],
+                             [query_result.data for query_result in batch_results])
+
+    def test_iter_search_lazy(self) -> None:
+        """
+        Tests that streamed records are only built as they are read, and come from the book as it was when asked for
+        """
+        records = self.read_records_from_database()
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+        built_records = []
+        table_get = RecordTable.get
+
+        def count_get(table: RecordTable, record_id: int) -> AddressBookRecord:
+            built_records.append(record_id)
+            return table_get(table, record_id)
+
+        with patch.object(RecordTable, "get", count_get):
+            matches = self.api.storage.iter_search()
+            self.assertListEqual([], built_records)
+
+        self.api.add_record(new_record)
+
+        with patch.object(RecordTable, "get", count_get):
+            self.assertEqual(records[0], next(matches))
+            self.assertEqual(1, len(built_records))
+            self.assertListEqual(records[1:], list(matches))
+
+
+class TestResultCache(unittest.TestCase):
+    def test_bounds(self) -> None:
+        """
+        Tests that the least recently used results are evicted to stay within both bounds,
+        and that results are dropped once a newer version is seen
+        """
+        cache = ResultCache(max_entries=2, max_bytes=100)
+
+        cache.put("a", 1, "result a", 10)
+        cache.put("b", 1, "result b", 10)
+        cache.get("a", 1)
+        cache.put("c", 1, "result c", 10)
+
+        self.assertEqual("result a", cache.get("a", 1))
+        self.assertIsNone(cache.get("b", 1))
+
+        cache.put("d", 1, "result d", 95)
+        cache.put("e", 1, "result e", 101)
+
+        self.assertEqual({"hits": 2, "misses": 1, "entries": 1, "bytes": 95, "max_entries": 2, "max_bytes": 100},
+                         cache.stats())
+
+        cache.put("f", 0, "result f", 1)
+
+        self.assertIsNone(cache.get("f", 0))
+        self.assertIsNone(cache.get("d", 2))
+        self.assertEqual(0, cache.stats()["entries"])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self) -> None:
+        """
+        Tests that counters and histograms are rendered in the Prometheus text format, with escaped labels
+        """
+        registry = Registry()
+        counter = registry.counter("test_total", "A counter", ("name",))
+        histogram = registry.histogram("test_seconds", "A histogram", ("name",), buckets=(0.1, 1.0))
+
+        counter.inc(name="a\"b")
+        counter.inc(2, name="a\"b")
+        histogram.observe(0.05, name="c")
+        histogram.observe(0.5, name="c")
+        histogram.observe(5, name="c")
+
+        self.assertEqual("# HELP test_total A counter\n"
+                         "# TYPE test_total counter\n"
+                         "test_total{name=\"a\\\"b\"} 3\n"
+                         "# HELP test_seconds A histogram\n"
+                         "# TYPE test_seconds histogram\n"
+                         "test_seconds_bucket{name=\"c\",le=\"0.1\"} 1\n"
+                         "test_seconds_bucket{name=\"c\",le=\"1.0\"} 2\n"
+                         "test_seconds_bucket{name=\"c\",le=\"+Inf\"} 3\n"
+                         "test_seconds_sum{name=\"c\"} 5.55\n"
+                         "test_seconds_count{name=\"c\"} 3\n", registry.render())
+
+    def test_render_merged(self) -> None:
+        """
+        Tests that the metrics of other processes are added to the process's own when rendered
+        """
+        registry = Registry()
+        counter = registry.counter("test_total", "A counter", ("name",))
+        histogram = registry.histogram("test_seconds", "A histogram", buckets=(0.1, 1.0))
+        other_registry = Registry()
+        other_registry.counter("test_total", "A counter", ("name",)).inc(2, name="a")
+        other_registry.counter("other_total", "Not in the registry").inc()
+        other_registry.histogram("test_seconds", "A histogram", buckets=(0.1, 1.0)).observe(0.5)
+
+        counter.inc(name="a")
+        counter.inc(name="b")
+        histogram.observe(0.05)
+        rendered = registry.render([other_registry.state()])
+
+        self.assertIn("test_total{name=\"a\"} 3\n", rendered)
+        self.assertIn("test_total{name=\"b\"} 1\n", rendered)
+        self.assertIn("test_seconds_bucket{le=\"1.0\"} 2\n", rendered)
+        self.assertIn("test_seconds_count 2\n", rendered)
+        self.assertNotIn("other_total", rendered)
+
+    def test_sampling_profiler(self) -> None:
+        """
+        Tests that the profiler samples the stacks of other threads while it is running
+        """
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+
+        def busy_loop() -> None:
+            stop_at = time.monotonic() + 0.1
+
+            while time.monotonic() < stop_at:
+                pass
+
+        busy_loop()
+        profiler.stop()
+
+        self.assertFalse(profiler.running)
+        self.assertIn("tests.py:busy_loop", profiler.collapsed())
+
+
+class TestSerialization(unittest.TestCase):
+    def test_encode_records(self) -> None:
+        """
+        Tests that records are encoded the same as by json.dumps, compact or pretty, and decoded back
+        """
+        records = [
+            AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk"),
+            AddressBookRecord("Zoë", "O\"Brien", "01913478123", "zoe\\obrien@corrie.co.uk")
+        ]
+
+        compact = encode_records(records)
+        pretty = encode_records(records, pretty=True)
+
+        self.assertEqual(json.dumps(records, separators=(",", ":"), cls=AddressBookRecordEncoder).encode(), compact)
+        self.assertEqual(json.dumps(records, indent=4, cls=AddressBookRecordEncoder).encode(), pretty)
+        self.assertListEqual(records, list(decode_records(compact)))
+        self.assertListEqual(records, list(decode_records(pretty)))
+        self.assertListEqual([], list(decode_records(encode_records([]))))
+
+
+class TestValidation(unittest.TestCase):
+    def test_validate_rows(self) -> None:
+        """
+        Tests that rows are validated by the same rules and give the same errors as pydantic, row by row
+        """
+        record_validator = TypeAdapter(AddressBookRecord)
+        rows = [asdict(record) for record in benchmark.generate_records(50)]
+        rows[10:10] = [
+            {"first_name": "David\n", "last_name": "Platt", "phone": "01913478234", "email": "david.platt@corrie.co.uk"},
+            {"first_name": "David", "last_name": "Platt", "phone": "0191\n3478234", "email": "david.platt@corrie"},
+            {"first_name": b"David", "last_name": "Platt", "phone": "01913478234", "email": "david.platt@corrie.co.uk"},
+            {"first_name": "David", "last_name": "Platt"},
+            ["David", "Platt", "01913478234", "david.platt@corrie.co.uk"],
+            None
+        ]
+        rows.append(json.JSONDecodeError("Expecting value", "{", 1))
+
+        records, row_errors = validate_rows(rows)
+        expected_records = []
+        expected_errors = []
+
+        for row in rows[:-1]:
+            try:
+                expected_records.append(record_validator.validate_python(row))
+                expected_errors.append(None)
+            except ValidationError as error:
+                expected_errors.append("; ".join(f"{'.'.join(map(str, detail['loc']))}: {detail['msg']}"
+                                                 for detail in error.errors()))
+
+        self.assertListEqual(expected_records, records)
+        self.assertListEqual(expected_errors + ["Invalid JSON: Expecting value"], row_errors)
+        self.assertEqual(([], []), validate_rows([]))
+
+    def test_validate_records(self) -> None:
+        """
+        Tests that only the invalid records of a batch are given an error, matching the error of each record alone
+        """
+        records = list(benchmark.generate_records(100))
+        records[3] = replace(records[3], first_name="David2")
+        records[97] = replace(records[97], email="david.platt@corrie\nx@corrie.co.uk")
+
+        errors = validate_records(records)
+
+        self.assertListEqual([3, 97], [position for position, error in enumerate(errors) if error is not None])
+        self.assertListEqual([record_error(record) for record in records], errors)
+        self.assertIsNone(field_error("phone", "01913478234"))
+        self.assertIsNotNone(field_error("phone", "01913478234\n"))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self) -> None:
+        """
+        Tests that every operation is benchmarked against a small generated book, and that runs can be compared
+        """
+        results = benchmark.run([50], ["direct", "testclient"], [StorageBackend.JSON, StorageBackend.SNAPSHOT],
+                                iterations=5)
+
+        self.assertEqual(4, len(results["results"]))
+        self.assertEqual(benchmark.generate_record(7), list(benchmark.generate_records(3, start=6))[1])
+
+        for result in results["results"]:
+            self.assertListEqual(list(benchmark.OPERATIONS), list(result["operations"]))
+
+            for timing in result["operations"].values():
+                latencies = timing["latency_ms"]
+                self.assertEqual(5, timing["calls"])
+                self.assertTrue(latencies["p50"] <= latencies["p90"] <= latencies["p99"] <= latencies["max"])
+
+        self.assertEqual(4 * len(benchmark.OPERATIONS), len(benchmark.compare(results, results)))
+
+
+class TestAsyncAPI(unittest.IsolatedAsyncioTestCase):
+    ADDRESS_BOOK_FILE_PATH = "test_address_book.json"
+
+    def setUp(self) -> None:
+        """
+        Starts each test with an example database
+        """
+        self.test_records = [
+            AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk"),
+            AddressBookRecord("Jason", "Grimshaw", "01913478123", "jason.grimshaw@corrie.co.uk")
+        ]
+
+        with open(self.ADDRESS_BOOK_FILE_PATH, "w") as database_file:
+            json.dump(self.test_records, database_file, indent=4, cls=AddressBookRecordEncoder)
+
+        self.api = AsyncAddressBookAPI(AddressBookAPI(self.ADDRESS_BOOK_FILE_PATH))
+
+    def tearDown(self) -> None:
+        self.api.close()
+
+    async def test_add_records_concurrently(self) -> None:
+        """
+        Tests that records added by concurrent coroutines are all stored
+        """
+        records_to_add = [AddressBookRecord("Chesney", "Brown", f"0191360{number:04}", "chesney.brown@corrie.co.uk")
+                          for number in range(50)]
+
+        await asyncio.gather(*(self.api.add_record(record) for record in records_to_add))
+        api_result = await self.api.list_records()
+
+        self.assertCountEqual(self.test_records + records_to_add, api_result.data)
+
+    async def test_stream_records(self) -> None:
+        """
+        Tests that records can be streamed from an async iterator
+        """
+        api_result = await self.api.stream_records()
+
+        self.assertListEqual(self.test_records, [record async for record in api_result.data])
+
+    async def test_wait_for_changes(self) -> None:
+        """
+        Tests that a coroutine waiting for changes is woken by a change made while it waits
+        """
+        sequence = (await self.api.changes(0)).data.sequence
+        record_to_add = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+        waiting = asyncio.create_task(self.api.wait_for_changes(sequence, timeout=5))
+        await asyncio.sleep(0.05)
+        await self.api.add_record(record_to_add)
+        api_result = await asyncio.wait_for(waiting, timeout=1)
+
+        self.assertListEqual([Change(sequence + 1, "add", record_to_add)], api_result.data.changes)
+        self.assertListEqual([], (await self.api.wait_for_changes(sequence + 1, timeout=0.01)).data.changes)
+
+
+class TestWALStorage(unittest.TestCase):
+    ADDRESS_BOOK_FILE_PATH = "test_wal_address_book.json"
+
+    def setUp(self) -> None:
+        """
+        Starts each test with an example database and no log
+        """
+        self.test_records = [
+            AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk"),
+            AddressBookRecord("Jason", "Grimshaw", "01913478123", "jason.grimshaw@corrie.co.uk")
+        ]
+
+        with open(self.ADDRESS_BOOK_FILE_PATH, "w") as database_file:
+            json.dump(self.test_records, database_file, indent=4, cls=AddressBookRecordEncoder)
+
+        if os.path.exists(self.ADDRESS_BOOK_FILE_PATH + ".wal"):
+            os.remove(self.ADDRESS_BOOK_FILE_PATH + ".wal")
+
+        self.api = AddressBookAPI(self.ADDRESS_BOOK_FILE_PATH, StorageBackend.WAL)
+
+    def tearDown(self) -> None:
+        self.api.storage.close()
+
+    def read_records_from_database(self) -> list[AddressBookRecord]:
+        with open(self.ADDRESS_BOOK_FILE_PATH) as database_file:
+            return json.load(database_file, cls=AddressBookRecordDecoder)
+
+    def test_changes_replayed_from_log(self) -> None:
+        """
+        Tests that changes are appended to the log rather than the database file,
+        and that they are replayed when the database is opened again
+        """
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+        self.api.add_record(new_record)
+        self.api.edit_record(self.test_records[0], new_phone="01913633216")
+        self.api.delete_specific_record(self.test_records[1])
+        expected_records = self.api.list_records().data
+        self.api.storage.close()
+
+        self.assertListEqual(self.test_records, self.read_records_from_database())
+
+        reopened_api = AddressBookAPI(self.ADDRESS_BOOK_FILE_PATH, StorageBackend.WAL)
+
+        self.assertListEqual(expected_records, reopened_api.list_records().data)
+        reopened_api.storage.close()
+
+    def test_log_compaction(self) -> None:
+        """
+        Tests that the log is compacted into the database file once it holds enough entries
+        """
+        self.api.storage.compact_after = 2
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+        self.api.add_record(new_record)
+        self.api.delete_specific_record(self.test_records[0])
+
+        self.assertListEqual([self.test_records[1], new_record], self.read_records_from_database())
+
+    def test_log_synced_when_idle(self) -> None:
+        """
+        Tests that entries left unsynced by a commit are synced once sync_interval has passed, without another commit
+        """
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+        synced_files = []
+        # The log is opened by loading the database, and the last sync counted from then
+        self.api.storage.sync_interval = 0.2
+        self.api.list_records()
+
+        with patch("os.fsync", synced_files.append):
+            self.api.add_record(new_record)
+            self.assertListEqual([], synced_files)
+            time.sleep(0.6)
+
+        self.assertListEqual([self.api.storage._log_file.fileno()], synced_files)
+
+    def test_incomplete_log_entry_dropped(self) -> None:
+        """
+        Tests that an entry left incomplete by a crash is dropped when the log is replayed
+        """
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+        self.api.add_record(new_record)
+        self.api.storage.close()
+
+        with open(self.ADDRESS_BOOK_FILE_PATH + ".wal", "ab") as log_file:
+            log_file.write(b'["delete",["Da')
+
+        reopened_api = AddressBookAPI(self.ADDRESS_BOOK_FILE_PATH, StorageBackend.WAL)
+
+        self.assertListEqual(self.test_records + [new_record], reopened_api.list_records().data)
+        reopened_api.storage.close()
+
+
+class TestSnapshotStorage(unittest.TestCase):
+    JSON_FILE_PATH = "test_snapshot_address_book.json"
+    SNAPSHOT_FILE_PATH = "test_address_book.snap"
+
+    def setUp(self) -> None:
+        """
+        Starts each test with an example database converted from JSON, and no log
+        """
+        self.test_records = [
+            AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk"),
+            AddressBookRecord("Jason", "Grimshaw", "01913478123", "jason.grimshaw@corrie.co.uk"),
+            AddressBookRecord("Sarah", "Platt", "01913478555", "sarah.platt@corrie.co.uk")
+        ]
+
+        with open(self.JSON_FILE_PATH, "w") as database_file:
+            json.dump(self.test_records, database_file, indent=4, cls=AddressBookRecordEncoder)
+
+        json_to_snapshot(self.JSON_FILE_PATH, self.SNAPSHOT_FILE_PATH)
+
+        if os.path.exists(self.SNAPSHOT_FILE_PATH + ".wal"):
+            os.remove(self.SNAPSHOT_FILE_PATH + ".wal")
+
+        self.api = AddressBookAPI(self.SNAPSHOT_FILE_PATH, StorageBackend.SNAPSHOT)
+
+    def tearDown(self) -> None:
+        self.api.storage.close()
+
+    def read_records_from_snapshot(self) -> list[AddressBookRecord]:
+        snapshot = MappedSnapshot(self.SNAPSHOT_FILE_PATH)
+        return [snapshot.record(row) for row in range(len(snapshot))]
+
+    def test_delete_matching_phone_without_digits(self) -> None:
+        """
+        Tests that a phone with no digits matches no record in the snapshot's index,
+        not even one whose number is only a prefix
+        """
+        zero_record = AddressBookRecord("Phil", "Mitchell", "0", "phil.mitchell@ee.co.uk")
+
+        with open(self.JSON_FILE_PATH, "w") as database_file:
+            json.dump(self.test_records + [zero_record], database_file, cls=AddressBookRecordEncoder)
+
+        json_to_snapshot(self.JSON_FILE_PATH, self.SNAPSHOT_FILE_PATH)
+
+        self.assertListEqual([], self.api.search_records(phone="x").data)
+        self.assertListEqual([], self.api.delete_matching_records(phone="abc").data)
+        self.assertListEqual([zero_record], self.api.search_records(phone="0").data)
+
+    def test_conversion(self) -> None:
+        """
+        Tests that an address book converted to a snapshot and back holds the same records
+        """
+        snapshot_to_json(self.SNAPSHOT_FILE_PATH, self.JSON_FILE_PATH)
+
+        self.assertTrue(is_snapshot(self.SNAPSHOT_FILE_PATH))
+        self.assertFalse(is_snapshot(self.JSON_FILE_PATH))
+        self.assertListEqual(self.test_records, self.read_records_from_snapshot())
+
+        with open(self.JSON_FILE_PATH, "rb") as database_file:
+            self.assertListEqual(self.test_records, list(decode_records(database_file.read())))
+
+    def test_search(self) -> None:
+        """
+        Tests that searches of the mapped snapshot find the same records as the other backends
+        """
+        self.assertListEqual(self.test_records, self.api.list_records().data)
+        self.assertListEqual([self.test_records[0], self.test_records[2]],
+                             self.api.search_records(last_name="Platt").data)
+        self.assertListEqual([self.test_records[2]],
+                             self.api.search_records(first_name="Sarah", last_name="Platt").data)
+        self.assertListEqual([], self.api.search_records(first_name="Chesney").data)
+        self.assertListEqual([self.test_records[1]], self.api.search_records(first_name="jas",
+                                                                             mode=SearchMode.PREFIX).data)
+        self.assertListEqual([self.test_records[0]], self.api.lookup_phone("+44 1913 478234").data)
+
+    def test_changes_replayed_from_log(self) -> None:
+        """
+        Tests that changes are held on top of the snapshot and appended to the log,
+        and that they are replayed when the database is opened again
+        """
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+        self.api.add_record(new_record)
+        self.api.edit_record(self.test_records[0], new_phone="01913633216")
+        self.api.delete_specific_record(self.test_records[1])
+        expected_records = self.api.list_records().data
+
+        self.assertListEqual([new_record], self.api.search_records(last_name="Brown").data)
+        self.assertListEqual([], self.api.search_records(first_name="Jason").data)
+        self.assertListEqual([], self.api.search_records(phone="01913478234").data)
+        self.assertEqual(ResponseCode.ALREADY_EXISTS, self.api.add_record(self.test_records[2]).response_code)
+        self.api.storage.close()
+
+        self.assertListEqual(self.test_records, self.read_records_from_snapshot())
+
+        reopened_api = AddressBookAPI(self.SNAPSHOT_FILE_PATH, StorageBackend.SNAPSHOT)
+
+        self.assertListEqual(expected_records, reopened_api.list_records().data)
+        self.assertListEqual([expected_records[0]], reopened_api.search_records(phone="01913633216").data)
+        reopened_api.storage.close()
+
+    def test_log_compaction(self) -> None:
+        """
+        Tests that the log is compacted into a new snapshot once it holds enough entries
+        """
+        self.api.storage.compact_after = 2
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+        self.api.add_record(new_record)
+        self.api.delete_specific_record(self.test_records[0])
+        expected_records = self.test_records[1:] + [new_record]
+
+        self.assertListEqual(expected_records, self.read_records_from_snapshot())
+        self.assertListEqual(expected_records, self.api.list_records().data)
+        self.assertListEqual([new_record], self.api.search_records(email="chesney.brown@corrie.co.uk").data)
+
+
+class TestSQLiteStorage(unittest.TestCase):
+    DATABASE_FILE_PATH = "test_address_book.db"
+
+    def setUp(self) -> None:
+        """
+        Starts each test with an SQLite database holding a few example records
+        """
+        self.test_records = [
+            AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk"),
+            AddressBookRecord("Jason", "Grimshaw", "01913478123", "jason.grimshaw@corrie.co.uk"),
+            AddressBookRecord("Jason", "Smith", "01354658717", "jason.smith@email.com")
+        ]
+
+        self.api = AddressBookAPI(self.DATABASE_FILE_PATH, StorageBackend.SQLITE)
+        self.api.delete_matching_records()
+
+        for record in self.test_records:
+            self.api.add_record(record)
+
+    def tearDown(self) -> None:
+        self.api.storage.close()
+
+    def test_delete_matching_phone_without_digits(self) -> None:
+        """
+        Tests that a phone with no digits matches no record, not even one whose number is only a prefix
+        """
+        zero_record = AddressBookRecord("Phil", "Mitchell", "0", "phil.mitchell@ee.co.uk")
+        self.api.add_record(zero_record)
+
+        self.assertListEqual([], self.api.search_records(phone="x").data)
+        self.assertListEqual([], self.api.delete_matching_records(phone="abc").data)
+        self.assertListEqual([zero_record], self.api.search_records(phone="0").data)
+
+    def test_add_existing_record(self) -> None:
+        """
+        Tests that an existing record can not be added again
+        """
+        api_response = self.api.add_record(self.test_records[0])
+
+        self.assertEqual(ResponseCode.ALREADY_EXISTS, api_response.response_code)
+        self.assertListEqual(self.test_records, self.api.list_records().data)
+
     def test_edit_record(self) -> None:
         """
-        Tests that an existing record can be edited
+        Tests that an edited record keeps its position
         """
-        new_phone_number = "01913633216"
-        record_to_edit = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
-        edited_record = AddressBookRecord("Chesney", "Brown", new_phone_number, "chesney.brown@corrie.co.uk")
+        edited_record = self.api.edit_record(self.test_records[1], new_phone="01913633216").data
 
-        self.add_record_to_database(record_to_edit)
-        self.api.edit_record(record_to_edit, new_phone=new_phone_number)
+        self.assertListEqual([self.test_records[0], edited_record, self.test_records[2]],
+                             self.api.list_records().data)
 
-        records_after_edit = self.read_records_from_database()
+    def test_search_and_delete_matching_records(self) -> None:
+        """
+        Tests that records can be searched for and deleted by multiple fields
+        """
+        self.assertListEqual(self.test_records[1:], self.api.search_records(first_name="Jason").data)
+        self.assertListEqual([self.test_records[2]],
+                             self.api.search_records(first_name="Jason", last_name="Smith").data)
 
-        self.assertIn(edited_record, records_after_edit)
-        self.assertNotIn(record_to_edit, records_after_edit)
+        deleted_records = self.api.delete_matching_records(first_name="Jason").data
 
-    def test_edit_non_existing_record(self) -> None:
+        self.assertListEqual(self.test_records[1:], deleted_records)
+        self.assertListEqual(self.test_records[:1], self.api.list_records().data)
+
+    def test_search_modes(self) -> None:
         """
-        Tests that trying to edit a non-existing record
-        fails gracefully
+        Tests that the search modes match the same records as they do for the in-memory storages
         """
-        non_existing_record = AddressBookRecord("", "", "", "")
-        api_response = self.api.edit_record(non_existing_record, new_phone="01545173738")
+        self.assertListEqual(self.test_records[1:], self.api.search_records(first_name="JASON",
+                                                                            mode=SearchMode.IGNORE_CASE).data)
+        self.assertListEqual(self.test_records[1:2], self.api.search_records(last_name="gri",
+                                                                             mode=SearchMode.PREFIX).data)
+        self.assertListEqual(self.test_records[:2], self.api.search_records(phone="01913478",
+                                                                            mode=SearchMode.SUBSTRING).data)
+        self.assertListEqual([], self.api.search_records(email="_", mode=SearchMode.SUBSTRING).data)
+        self.assertListEqual([self.test_records[2], self.test_records[0]],
+                             self.api.search_records(last_name="smitt", mode=SearchMode.FUZZY).data
+                             + self.api.search_records(last_name="plat", mode=SearchMode.FUZZY).data)
+
+    def test_lookup_phone(self) -> None:
+        """
+        Tests that phone numbers are matched by their canonical key
+        """
+        self.assertListEqual(self.test_records[:1], self.api.lookup_phone("+44 1913 478234").data)
+        self.assertListEqual(self.test_records[:1], self.api.search_records(phone="00441913478234").data)
+        self.assertListEqual(self.test_records[1:2], self.api.lookup_phone("8123", PhoneMatch.SUFFIX).data)
+        self.assertListEqual(self.test_records[:2], self.api.lookup_phone("0191", PhoneMatch.AREA_CODE).data)
 
-        self.assertTrue(api_response)
+    def test_search_records_batch(self) -> None:
+        """
+        Tests that a batch of searches is answered in the order of the queries
+        """
+        queries = [SearchQuery(first_name="Jason"), SearchQuery(last_name="SMITH", mode=SearchMode.IGNORE_CASE),
+                   SearchQuery(phone="00441913478234"), SearchQuery(first_name="Chesney")]
 
-    def test_delete_specific_record(self) -> None:
+        self.assertListEqual([self.test_records[1:], self.test_records[2:], self.test_records[:1], []],
+                             [query_result.data for query_result in self.api.search_records_batch(queries).data])
+
+    def test_cache_invalidated_by_other_connection(self) -> None:
         """
-        Tests that a record can be deleted from the database
+        Tests that a change committed through another connection invalidates the cached results
         """
-        record_to_delete = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+        other_api = AddressBookAPI(self.DATABASE_FILE_PATH, StorageBackend.SQLITE)
 
-        self.add_record_to_database(record_to_delete)
-        self.api.delete_specific_record(record_to_delete)
+        self.assertListEqual(self.test_records[1:], self.api.search_records(first_name="Jason").data)
 
-        records_after_delete = self.read_records_from_database()
+        other_api.delete_specific_record(self.test_records[1])
+        other_api.storage.close()
 
-        self.assertNotIn(record_to_delete, records_after_delete)
+        self.assertListEqual(self.test_records[2:], self.api.search_records(first_name="Jason").data)
 
-    def test_delete_matching_records(self) -> None:
+    def test_changes(self) -> None:
         """
-        Tests that records with a matching field can be deleted
+        Tests that changes made through this connection are returned, and that a change committed through
+        another connection resets the change log
         """
-        test_records = [
-            AddressBookRecord("Phil", "Mitchell", "01895521739", "phil.mitchell@ee.co.uk"),
-            AddressBookRecord("Billy", "Mitchell", "01895521732", "billy.mitchell@ee.co.uk")
+        sequence = self.api.changes(0).data.sequence
+
+        self.api.delete_matching_records(first_name="Jason")
+        self.api.delete_specific_record(self.test_records[0])
+
+        self.assertListEqual([Change(sequence + 1, "delete", self.test_records[1]),
+                              Change(sequence + 2, "delete", self.test_records[2]),
+                              Change(sequence + 3, "delete", self.test_records[0])],
+                             self.api.changes(sequence).data.changes)
+
+        other_api = AddressBookAPI(self.DATABASE_FILE_PATH, StorageBackend.SQLITE)
+        other_api.add_record(self.test_records[0])
+        other_api.storage.close()
+
+        self.assertTrue(self.api.changes(sequence + 3).data.reset)
+
+
+class TestShardedStorage(unittest.TestCase):
+    ADDRESS_BOOK_FILE_PATH = "test_sharded_address_book.json"
+
+    def setUp(self) -> None:
+        """
+        Splits an example database into 3 shards, kept in this process
+        """
+        self.test_records = [
+            AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk"),
+            AddressBookRecord("Jason", "Grimshaw", "01913478123", "jason.grimshaw@corrie.co.uk"),
+            AddressBookRecord("Sarah", "Platt", "01913478555", "sarah.platt@corrie.co.uk"),
+            AddressBookRecord("Ken", "Barlow", "019134784929", "ken.barlow@corrie.co.uk"),
+            AddressBookRecord("Rita", "Sullivan", "01913478556", "rita.sullivan@corrie.co.uk"),
+            AddressBookRecord("Bethany", "Platt", "01913478557", "bethany.platt@corrie.co.uk")
         ]
 
-        for record in test_records:
-            self.add_record_to_database(record)
+        with open(self.ADDRESS_BOOK_FILE_PATH, "w") as database_file:
+            json.dump(self.test_records, database_file, indent=4, cls=AddressBookRecordEncoder)
 
-        self.api.delete_matching_records(last_name="Mitchell")
+        reshard(self.ADDRESS_BOOK_FILE_PATH, 3)
+        self.storage = ShardedStorage(self.ADDRESS_BOOK_FILE_PATH, 3, processes=False)
 
-        records_after_delete = self.read_records_from_database()
+    def tearDown(self) -> None:
+        self.storage.close()
 
-        for record in test_records:
-            self.assertNotIn(record, records_after_delete)
+    def in_shard_order(self, records: list[AddressBookRecord]) -> list[AddressBookRecord]:
+        return sorted(records, key=lambda record: shard_of(record, 3))
 
-    def test_list_records(self) -> None:
+    def test_reshard(self) -> None:
         """
-        Tests that all records can be retrieved
+        Tests that each record is moved to the shard of its hash, and that a book can be resharded in place
         """
-        database_records = self.read_records_from_database()
-        api_records = self.api.list_records().data
+        for shard, path in enumerate(shard_paths(self.ADDRESS_BOOK_FILE_PATH, 3)):
+            with open(path, "rb") as shard_file:
+                self.assertListEqual([record for record in self.test_records if shard_of(record, 3) == shard],
+                                     list(decode_records(shard_file.read())))
 
-        self.assertListEqual(database_records, api_records)
+        self.storage.close()
+        reshard(self.ADDRESS_BOOK_FILE_PATH, 2, from_shards=3)
+        self.storage = ShardedStorage(self.ADDRESS_BOOK_FILE_PATH, 2, processes=False)
 
-    def test_search_records(self) -> None:
+        self.assertCountEqual(self.test_records, self.storage.records())
+        self.assertFalse(os.path.exists(shard_paths(self.ADDRESS_BOOK_FILE_PATH, 3)[2]))
+
+    def test_search(self) -> None:
         """
-        Tests that the database can be searched
+        Tests that the matches of every shard are merged, in shard order or closest first, before being paged
         """
-        search_first_name = "Billy"
+        platts = self.in_shard_order([record for record in self.test_records if record.last_name == "Platt"])
+
+        self.assertListEqual(self.in_shard_order(self.test_records), self.storage.records())
+        self.assertListEqual(platts, self.storage.search(last_name="Platt"))
+        self.assertListEqual(platts[1:2], self.storage.search(1, 1, last_name="Platt"))
+        self.assertListEqual([platts[1:], platts[:1]],
+                             self.storage.search_many([SearchQuery(last_name="Platt", offset=1),
+                                                       SearchQuery(last_name="Platt", limit=1)]))
+        self.assertListEqual(self.test_records[:1], self.storage.search_phone("+441913478234"))
+        self.assertListEqual(self.in_shard_order([self.test_records[1], self.test_records[2]]),
+                             self.storage.search(0, 2, SearchMode.FUZZY, first_name="Jasah"))
+        self.assertListEqual([self.test_records[1]], self.storage.search(0, 1, SearchMode.FUZZY, first_name="Jasan"))
+
+    def test_changes(self) -> None:
+        """
+        Tests that changes are made to the shard of each record, including a record moved to another shard
+        by an edit, and are recorded in the change log
+        """
+        sequence = self.storage.changes(0).sequence
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+        # An email whose record hashes to a different shard from the original
+        moved_record = next(moved for moved in (replace(self.test_records[0], email=f"david{number}@corrie.co.uk")
+                                                for number in range(100))
+                            if shard_of(moved, 3) != shard_of(self.test_records[0], 3))
+
+        self.assertListEqual([True, False, False], self.storage.add_many([new_record, new_record,
+                                                                          self.test_records[1]]))
+        self.assertTrue(self.storage.replace(self.test_records[0], moved_record))
+        self.assertFalse(self.storage.replace(self.test_records[0], moved_record))
+        self.assertListEqual([True, False], self.storage.remove_many([self.test_records[1], self.test_records[1]]))
+        self.assertTrue(self.storage.contains(moved_record))
+        self.assertFalse(self.storage.contains(self.test_records[0]))
+        self.assertCountEqual(self.test_records[2:] + [new_record, moved_record], self.storage.records())
+
+        self.assertListEqual([Change(sequence + 1, "add", new_record),
+                              Change(sequence + 2, "replace", self.test_records[0], moved_record),
+                              Change(sequence + 3, "delete", self.test_records[1])],
+                             self.storage.changes(sequence).changes)
+
+        with open(shard_paths(self.ADDRESS_BOOK_FILE_PATH, 3)[0], "w") as shard_file:
+            shard_file.write("[]")
+
+        self.assertTrue(self.storage.changes(sequence + 3).reset)
+
+    def test_replace_across_shards_interrupted(self) -> None:
+        """
+        Tests that a record moved to another shard by an edit is not lost if the edit fails part way,
+        as its replacement is committed before it is removed
+        """
+        old_record = self.test_records[0]
+        moved_record = next(moved for moved in (replace(old_record, email=f"david{number}@corrie.co.uk")
+                                                for number in range(100))
+                            if shard_of(moved, 3) != shard_of(old_record, 3))
+        shard_call = Shard.call
+        changes_made = []
 
-        test_records = [
-            AddressBookRecord("Billy", "Mayhew", "01913763249", "billy.mayhew@corrie.co.uk"),
-            AddressBookRecord("Billy", "Mitchell", "01895521732", "billy.mitchell@ee.co.uk")
-        ]
+        def fail_second_change(shard: Shard, method: str, *args, **kwargs):
+            # The first change goes through, the process is taken to have died before the second
+            if method in ("add", "remove"):
+                if changes_made:
+                    raise OSError("Interrupted")
 
-        for record in test_records:
-            self.add_record_to_database(record)
-        
-        found_records = self.api.search_records(first_name=search_first_name).data
+                changes_made.append(method)
 
-        self.assertListEqual(test_records, found_records)
+            return shard_call(shard, method, *args, **kwargs)
 
-    def test_search_multiple_records(self) -> None:
+        with patch.object(Shard, "call", fail_second_change):
+            with self.assertRaises(OSError):
+                self.storage.replace(old_record, moved_record)
+
+        self.storage.close()
+        self.storage = ShardedStorage(self.ADDRESS_BOOK_FILE_PATH, 3, processes=False)
+
+        self.assertTrue(self.storage.contains(old_record))
+        self.assertTrue(self.storage.contains(moved_record))
+
+    def test_iter_search_pages(self) -> None:
         """
-        Tests that the database can be searched using multiple fields
+        Tests that streaming a sharded book fetches each shard's matches a page at a time
         """
-        search_first_name = "Jason"
-        search_last_name = "Smith"
+        shard_call = Shard.call
+        pages = []
 
-        test_records = [
-            AddressBookRecord("Jason", "Smith", "01354658717", "jason.smith@email.com"),
-            AddressBookRecord("Jason", "Smith", "01354658617", "jason.smith2@email.com")
-        ]
+        def record_page(shard: Shard, method: str, *args, **kwargs):
+            result = shard_call(shard, method, *args, **kwargs)
+            pages.append(len(result[0]))
+            return result
 
-        for record in test_records:
-            self.add_record_to_database(record)
-        
-        found_records = self.api.search_records(first_name=search_first_name, last_name=search_last_name).data
+        with patch("sharding.ITER_PAGE_SIZE", 2), patch.object(Shard, "call", record_page):
+            self.assertListEqual(self.in_shard_order(self.test_records), list(self.storage.iter_search()))
 
-        self.assertListEqual(test_records, found_records)
+        self.assertLessEqual(max(pages), 2)
+        self.assertGreater(len(pages), len(self.storage.shards))
+
+    def test_worker_processes(self) -> None:
+        """
+        Tests that an API can keep its shards in worker processes
+        """
+        api = AddressBookAPI(self.ADDRESS_BOOK_FILE_PATH, shards=3)
+        new_record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+        try:
+            self.assertEqual(ResponseCode.OK, api.add_record(new_record).response_code)
+            self.assertListEqual([new_record], api.search_records(last_name="Brown").data)
+            self.assertEqual(len(self.test_records) + 1, len(api.list_records().data))
+
+            # The shards' files are read by the workers, whose metrics are merged into the API's
+            worker_bytes_read = sum(metrics["address_book_storage_read_bytes_total"].get(("snapshot",), 0)
+                                    for metrics in api.storage.worker_metrics())
+            total_bytes_read = BYTES_READ.value(file="snapshot") + worker_bytes_read
+
+            self.assertGreater(worker_bytes_read, 0)
+            self.assertIn(f'address_book_storage_read_bytes_total{{file="snapshot"}} {total_bytes_read}\n',
+                          api.metrics().data)
+        finally:
+            api.storage.close()
+
+
+def add_records_in_process(database_path: str, backend: StorageBackend, records: list[AddressBookRecord]) -> None:
+    api = AddressBookAPI(database_path, backend, shared=True)
+
+    for record in records:
+        api.add_record(record)
+
+    api.storage.close()
+
+
+@unittest.skipIf(shared.fcntl is None, "Sharing a database between processes requires fcntl")
+class TestSharedStorage(unittest.TestCase):
+    ADDRESS_BOOK_FILE_PATH = "test_shared_address_book.json"
+
+    def setUp(self) -> None:
+        """
+        Starts each test with an empty database and no log
+        """
+        with open(self.ADDRESS_BOOK_FILE_PATH, "w") as database_file:
+            json.dump([], database_file)
+
+        if os.path.exists(self.ADDRESS_BOOK_FILE_PATH + ".wal"):
+            os.remove(self.ADDRESS_BOOK_FILE_PATH + ".wal")
+
+    def test_changes_seen_by_other_worker(self) -> None:
+        """
+        Tests that a change committed through one shared API is seen by another using the same database
+        """
+        for backend in (StorageBackend.JSON, StorageBackend.WAL):
+            with self.subTest(backend=backend):
+                first_api = AddressBookAPI(self.ADDRESS_BOOK_FILE_PATH, backend, shared=True)
+                second_api = AddressBookAPI(self.ADDRESS_BOOK_FILE_PATH, backend, shared=True)
+                record = AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+
+                first_api.add_record(record)
+                self.assertListEqual([record], second_api.search_records(first_name="Chesney").data)
+
+                second_api.delete_specific_record(record)
+                self.assertListEqual([], first_api.list_records().data)
+
+                first_api.storage.close()
+                second_api.storage.close()
+
+    def test_add_records_from_several_processes(self) -> None:
+        """
+        Tests that no record is lost when several processes add records at once
+        """
+        for backend in (StorageBackend.JSON, StorageBackend.WAL):
+            with self.subTest(backend=backend):
+                records_to_add = [[AddressBookRecord("Chesney", "Brown", f"0191{process}{number:04}",
+                                                     "chesney.brown@corrie.co.uk") for number in range(25)]
+                                  for process in range(4)]
+
+                processes = [multiprocessing.Process(target=add_records_in_process,
+                                                     args=(self.ADDRESS_BOOK_FILE_PATH, backend, records))
+                             for records in records_to_add]
+
+                for process in processes:
+                    process.start()
+
+                for process in processes:
+                    process.join()
+
+                api = AddressBookAPI(self.ADDRESS_BOOK_FILE_PATH, backend, shared=True)
+                database_records = api.list_records().data
+                api.storage.close()
+
+                for records in records_to_add:
+                    for record in records:
+                        self.assertIn(record, database_records)
+
+    def test_etag_shared_by_workers(self) -> None:
+        """
+        Tests that a listing's ETag from one worker is still current at another sharing the database,
+        until either changes the records
+        """
+        for backend in (StorageBackend.JSON, StorageBackend.WAL):
+            with self.subTest(backend=backend):
+                first_app = FastAPIWrapper(self.ADDRESS_BOOK_FILE_PATH, backend, shared=True)
+                second_app = FastAPIWrapper(self.ADDRESS_BOOK_FILE_PATH, backend, shared=True)
+                first_client, second_client = TestClient(first_app.app), TestClient(second_app.app)
+                record = AddressBookRecord("Chesney", "Brown", "01913606138", f"chesney.brown@{backend.value}.co.uk")
+
+                etag = first_client.get(ENDPOINTS["list_records"]).headers["etag"]
+
+                self.assertEqual(304, second_client.get(ENDPOINTS["list_records"],
+                                                        headers={"If-None-Match": etag}).status_code)
+
+                second_client.post(ENDPOINTS["add_record"], json=asdict(record))
+
+                self.assertEqual(200, first_client.get(ENDPOINTS["list_records"],
+                                                       headers={"If-None-Match": etag}).status_code)
+
+                for fast_api_app in (first_app, second_app):
+                    fast_api_app.api.close()
+                    fast_api_app.api.api.storage.close()
 
 
 class TestAPIEndpoints(unittest.TestCase):
@@ -238,6 +1502,40 @@ class TestAPIEndpoints(unittest.TestCase):
 
         self.assertEqual(record_to_add, AddressBookRecord(**response.json()))
 
+    def test_bulk_add_endpoint(self) -> None:
+        """
+        Tests that the API can add records from an NDJSON body, reporting the result of each row
+        """
+        records_to_add = [
+            AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk"),
+            AddressBookRecord("David", "Platt", "01913478234", "david.platt@corrie.co.uk")
+        ]
+        body = "\n".join(json.dumps(asdict(record)) for record in records_to_add)
+        body += '\n{"first_name": "Sharon", "last_name": "Watts", "phone": "not a number", "email": "sharon@ee.com"}'
+        body += '\n{"first_name": '
+
+        response = self.test_client.post(ENDPOINTS["bulk_add"], content=body,
+                                         headers={"Content-Type": "application/x-ndjson"})
+        statuses = [result["status"] for result in response.json()["results"]]
+
+        self.assertListEqual(["added", "already_exists", "invalid", "invalid"], statuses)
+        self.assertListEqual(self.test_records + records_to_add[:1], self.read_records_from_database())
+
+    def test_bulk_delete_endpoint(self) -> None:
+        """
+        Tests that the API can delete records from a JSON array body, reporting the result of each row
+        """
+        records_to_delete = [
+            self.test_records[0],
+            AddressBookRecord("Chesney", "Brown", "01913606138", "chesney.brown@corrie.co.uk")
+        ]
+
+        response = self.test_client.post(ENDPOINTS["bulk_delete"],
+                                         json=[asdict(record) for record in records_to_delete])
+
+        self.assertDictEqual({"deleted": 1, "not_found": 1}, response.json()["summary"])
+        self.assertListEqual(self.test_records[1:], self.read_records_from_database())
+
     def test_edit_record_endpoint(self) -> None:
         """
         Tests that the API can edit an existing record
@@ -292,6 +1590,25 @@ class TestAPIEndpoints(unittest.TestCase):
 
         self.assertListEqual(all_records, response_records)
 
+    def test_list_records_endpoint_pages(self) -> None:
+        """
+        Tests that the API can return a page of the records
+        """
+        response = self.test_client.get(ENDPOINTS["list_records"], params={"offset": 1, "limit": 2})
+        response_records = [AddressBookRecord(**record) for record in response.json()]
+
+        self.assertListEqual(self.test_records[1:3], response_records)
+
+    def test_list_records_endpoint_stream(self) -> None:
+        """
+        Tests that the API can stream all records as NDJSON
+        """
+        response = self.test_client.get(ENDPOINTS["list_records"], params={"stream": True})
+        response_records = [AddressBookRecord(**json.loads(line)) for line in response.text.splitlines()]
+
+        self.assertEqual("application/x-ndjson", response.headers["content-type"])
+        self.assertListEqual(self.test_records, response_records)
+
     def test_search_records_endpoint(self) -> None:
         """
         Tests that the API can find matching records
@@ -311,6 +1628,220 @@ class TestAPIEndpoints(unittest.TestCase):
 
         self.assertListEqual(test_records, response_records)
 
+    def test_search_records_batch_endpoint(self) -> None:
+        """
+        Tests that the API returns the results of each query of a batch in order
+        """
+        response = self.test_client.post(ENDPOINTS["search_records_batch"],
+                                         json=[{"last_name": "Barlow"}, {"first_name": "Billy"},
+                                               {"first_name": "rita", "mode": "ignore_case"}])
+
+        self.assertListEqual([[asdict(self.test_records[2])], [], [asdict(self.test_records[3])]], response.json())
+
+    def test_lookup_phone_endpoint(self) -> None:
+        """
+        Tests that the API can find records by phone number, and refuses numbers without enough digits
+        """
+        response = self.test_client.get(ENDPOINTS["lookup_phone"], params={"phone": "+44 1913 478234"})
+        invalid_response = self.test_client.get(ENDPOINTS["lookup_phone"], params={"phone": "34", "match": "suffix"})
+
+        self.assertListEqual([asdict(self.test_records[0])], response.json())
+        self.assertEqual(422, invalid_response.status_code)
+
+    def test_responses_encoded_off_event_loop(self) -> None:
+        """
+        Tests that the records of batch searches, phone lookups and deletions are encoded on the API's threads
+        rather than on the event loop
+        """
+        encoding_threads = []
+
+        def record_thread(records: list[AddressBookRecord]) -> bytes:
+            encoding_threads.append(threading.current_thread().name)
+            return encode_records(records)
+
+        with patch("api.encode_records", record_thread):
+            batch_response = self.test_client.post(ENDPOINTS["search_records_batch"],
+                                                   json=[{"last_name": "Barlow"}, {"first_name": "Billy"}])
+            phone_response = self.test_client.get(ENDPOINTS["lookup_phone"], params={"phone": "01913478234"})
+            delete_response = self.test_client.request("DELETE", ENDPOINTS["delete_matching_records"],
+                                                       json={"last_name": "Sullivan"})
+
+        self.assertListEqual([[asdict(self.test_records[2])], []], batch_response.json())
+        self.assertListEqual([asdict(self.test_records[0])], phone_response.json())
+        self.assertListEqual([asdict(self.test_records[3])], delete_response.json())
+        self.assertEqual(4, len(encoding_threads))
+        self.assertTrue(all(name.startswith("AddressBookAPI") for name in encoding_threads))
+
+    def test_fuzzy_search_records_endpoint(self) -> None:
+        """
+        Tests that the search mode can be chosen with a query parameter
+        """
+        test_record = AddressBookRecord("Billy", "Mayhew", "01913763249", "billy.mayhew@corrie.co.uk")
+        self.add_record_to_database(test_record)
+
+        response = self.test_client.post(ENDPOINTS["search_records"], params={"mode": "fuzzy"},
+                                         json={"last_name": "mayhue"})
+        invalid_response = self.test_client.post(ENDPOINTS["search_records"], params={"mode": "regex"},
+                                                 json={"last_name": "mayhue"})
+
+        self.assertListEqual([asdict(test_record)], response.json())
+        self.assertEqual(422, invalid_response.status_code)
+
+    def test_list_records_endpoint_not_modified(self) -> None:
+        """
+        Tests that a listing is only sent again once the records have changed since its ETag
+        """
+        test_record = AddressBookRecord("Billy", "Mayhew", "01913763249", "billy.mayhew@corrie.co.uk")
+        os.utime(self.ADDRESS_BOOK_FILE_PATH, ns=(0, 0))
+
+        etag = self.test_client.get(ENDPOINTS["list_records"]).headers["etag"]
+        not_modified_response = self.test_client.get(ENDPOINTS["list_records"], headers={"If-None-Match": etag})
+        self.test_client.post(ENDPOINTS["add_record"], json=asdict(test_record))
+        modified_response = self.test_client.get(ENDPOINTS["list_records"], headers={"If-None-Match": etag})
+
+        self.assertEqual(304, not_modified_response.status_code)
+        self.assertEqual(b"", not_modified_response.content)
+        self.assertEqual("Accept-Encoding", not_modified_response.headers["vary"])
+        self.assertEqual(200, modified_response.status_code)
+        self.assertNotEqual(etag, modified_response.headers["etag"])
+        self.assertListEqual(self.test_records + [test_record],
+                             [AddressBookRecord(**record) for record in modified_response.json()])
+
+    def test_list_records_endpoint_gzip(self) -> None:
+        """
+        Tests that a large listing is gzip compressed only when the client accepts it
+        """
+        test_records = [AddressBookRecord("Billy", "Mayhew", f"019137{i:05d}", "billy.mayhew@corrie.co.uk")
+                        for i in range(50)]
+        self.test_client.post(ENDPOINTS["bulk_add"], json=[asdict(record) for record in test_records])
+
+        gzip_response = self.test_client.get(ENDPOINTS["list_records"], headers={"Accept-Encoding": "gzip"})
+        identity_response = self.test_client.get(ENDPOINTS["list_records"], headers={"Accept-Encoding": "identity"})
+
+        self.assertEqual("gzip", gzip_response.headers["content-encoding"])
+        self.assertNotIn("content-encoding", identity_response.headers)
+        self.assertEqual(identity_response.json(), gzip_response.json())
+        self.assertEqual(54, len(gzip_response.json()))
+
+    def test_cache_stats_endpoint(self) -> None:
+        """
+        Tests that the cache's hit and miss counts are returned, and that a repeated listing is a hit
+        """
+        os.utime(self.ADDRESS_BOOK_FILE_PATH, ns=(0, 0))
+        self.test_client.get(ENDPOINTS["list_records"])
+        hits = self.test_client.get(ENDPOINTS["cache_stats"]).json()["hits"]
+        self.test_client.get(ENDPOINTS["list_records"])
+
+        self.assertEqual(hits + 1, self.test_client.get(ENDPOINTS["cache_stats"]).json()["hits"])
+
+    def test_changes_endpoint(self) -> None:
+        """
+        Tests that changes are returned as JSON, and that a stream from a sequence number that is too old
+        sends a reset event and ends
+        """
+        sequence = self.test_client.get(ENDPOINTS["changes"], params={"since": 0}).json()["sequence"]
+        self.test_client.request("DELETE", ENDPOINTS["delete_specific_record"], json=asdict(self.test_records[0]))
+        response = self.test_client.get(ENDPOINTS["changes"], params={"since": sequence})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"sequence": sequence + 1, "reset": False,
+                          "changes": [{"sequence": sequence + 1, "operation": "delete",
+                                       "record": asdict(self.test_records[0]), "new_record": None}]}, response.json())
+
+        response = self.test_client.get(ENDPOINTS["changes"], params={"since": 0, "stream": True})
+
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        self.assertEqual(f'event: reset\ndata: {{"sequence": {sequence + 1}}}\n\n', response.text)
+
+    def test_metrics_endpoint(self) -> None:
+        """
+        Tests that requests are timed by the path of their endpoint, and storage and search counters are exposed
+        """
+        self.test_client.post(ENDPOINTS["search_records"], json={"last_name": "Platt"})
+        self.test_client.get("/not_an_endpoint")
+        response = self.test_client.get(ENDPOINTS["metrics"])
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn('address_book_request_duration_seconds_count{route="/search_records",method="POST",status="200"}',
+                      response.text)
+        self.assertIn('route="other",method="GET",status="404"', response.text)
+        self.assertIn('address_book_storage_read_bytes_total{file="snapshot"}', response.text)
+        self.assertIn('address_book_search_records_returned_total{mode="exact"}', response.text)
+        self.assertIn('address_book_lock_wait_seconds_count{lock="records"}', response.text)
+
+    def test_profile_endpoint(self) -> None:
+        """
+        Tests that the profiler is started and stopped through /profile
+        """
+        self.assertEqual({"running": True}, self.test_client.post(ENDPOINTS["profile"], params={"enabled": True}).json())
+        self.assertTrue(self.fast_api_app.profiler.running)
+        self.assertEqual({"running": False},
+                         self.test_client.post(ENDPOINTS["profile"], params={"enabled": False}).json())
+        self.assertEqual(200, self.test_client.get(ENDPOINTS["profile"]).status_code)
+
+
+    def test_health_endpoints(self) -> None:
+        """
+        Tests that the app is live at once, but only ready once the warm-up started with the app has loaded
+        the records and built their indexes
+        """
+        fast_api_app = FastAPIWrapper(self.ADDRESS_BOOK_FILE_PATH)
+        test_client = TestClient(fast_api_app.app)
+
+        self.assertEqual({"alive": True}, test_client.get(ENDPOINTS["liveness"]).json())
+        self.assertEqual(503, test_client.get(ENDPOINTS["readiness"]).status_code)
+
+        # Entering the client starts the app, and so its warm-up
+        with test_client:
+            for _ in range(100):
+                if fast_api_app.ready:
+                    break
+
+                time.sleep(0.01)
+
+            response = test_client.get(ENDPOINTS["readiness"])
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.json()["ready"])
+        self.assertListEqual(["load", "build_indexes"], list(response.json()["timings"]))
+        self.assertSetEqual({"first_name", "last_name", "phone", "email"},
+                            set(fast_api_app.api.api.storage._text_indexes))
+        self.assertIsNotNone(fast_api_app.api.api.storage._phone_index)
+
+    def test_shutdown_closes_storage(self) -> None:
+        """
+        Tests that stopping the app closes the API's threads and its storage
+        """
+        fast_api_app = FastAPIWrapper(self.ADDRESS_BOOK_FILE_PATH)
+        closed = []
+
+        with patch.object(fast_api_app.api, "close", lambda: closed.append("api")), \
+                patch.object(fast_api_app.api.api.storage, "close", lambda: closed.append("storage")):
+            with TestClient(fast_api_app.app):
+                self.assertListEqual([], closed)
+
+        self.assertListEqual(["api", "storage"], closed)
+        fast_api_app.api.close()
+        fast_api_app.api.api.storage.close()
+
+    def test_readiness_after_failed_warm_up(self) -> None:
+        """
+        Tests that the app is never reported ready if its records could not be loaded
+        """
+        with open(self.ADDRESS_BOOK_FILE_PATH, "w") as database_file:
+            database_file.write("[{")
+
+        fast_api_app = FastAPIWrapper(self.ADDRESS_BOOK_FILE_PATH)
+
+        with self.assertLogs("uvicorn.error", level="ERROR"):
+            asyncio.run(fast_api_app.warm_up())
+
+        response = TestClient(fast_api_app.app).get(ENDPOINTS["readiness"])
+
+        self.assertEqual(503, response.status_code)
+        self.assertFalse(response.json()["ready"])
+        self.assertIn("error", response.json())
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,148 @@
+from record import AddressBookRecord, EMAIL_REGEX, NAME_REGEX, PHONE_REGEX, RECORD_FIELDS
+from functools import cache
+from itertools import compress
+from operator import attrgetter
+from typing import Any
+from pydantic import TypeAdapter, ValidationError
+import json
+import re
+
+# The pattern each field of a record must match, the same patterns AddressBookRecord's constraints hold.
+# Patterns are matched against the whole value, as pydantic does, so a trailing newline does not match $
+FIELD_PATTERNS = {
+    "first_name": re.compile(NAME_REGEX),
+    "last_name": re.compile(NAME_REGEX),
+    "phone": re.compile(PHONE_REGEX),
+    "email": re.compile(EMAIL_REGEX)
+}
+
+# Values of a batch are joined, each followed by the separator, and matched against their field's pattern repeated,
+# so a whole column is checked by a single call into the regex engine. None of the patterns match the separator
+BATCH_SEPARATOR = "\n"
+BATCH_PATTERNS = {
+    field: re.compile(f"(?:{pattern.pattern.removeprefix('^').removesuffix('$')}{BATCH_SEPARATOR})*")
+    for field, pattern in FIELD_PATTERNS.items()
+}
+
+
+@cache
+def record_validator() -> TypeAdapter:
+    """
+    Returns the pydantic validator of records, which rows that are not a dictionary of valid strings are converted
+    and validated by, like FastAPI does. Built on first use, as building it slows down importing the module
+    """
+    return TypeAdapter(AddressBookRecord)
+
+
+def field_error(field: str, value: str) -> str | None:
+    """
+    Returns the error for a value of a field in the form pydantic gives it, or None if the value is valid
+    """
+    pattern = FIELD_PATTERNS[field]
+
+    if pattern.fullmatch(value):
+        return None
+
+    return f"{field}: String should match pattern '{pattern.pattern}'"
+
+
+def record_error(record: AddressBookRecord) -> str | None:
+    """
+    Returns the errors of every invalid field of the record joined by "; ", or None if the record is valid
+    """
+    errors = [error for field, value in zip(RECORD_FIELDS, record.key())
+              if (error := field_error(field, value)) is not None]
+    return "; ".join(errors) if errors else None
+
+
+def validate_records(records: list[AddressBookRecord]) -> list[str | None]:
+    """
+    Returns the error of each record (see record_error), None for each valid record
+    """
+    errors: list[str | None] = [None] * len(records)
+    columns = [list(map(attrgetter(field), records)) for field in RECORD_FIELDS]
+
+    for position in _invalid_rows(columns, 0, len(records)):
+        errors[position] = record_error(records[position])
+
+    return errors
+
+
+def validate_rows(rows: list[Any]) -> tuple[list[AddressBookRecord], list[str | None]]:
+    """
+    Converts the rows of a bulk request (decoded JSON values, or the JSONDecodeError of a line that was not valid)
+    into records. Returns the valid records, along with the error for each row (None if the row is valid).
+    Rows are validated by the same rules as AddressBookRecord, and give the same errors pydantic would
+    """
+    # The values of rows that are dictionaries, the common case, are checked a column at a time
+    dict_positions = [position for position, row in enumerate(rows) if type(row) is dict]
+    dict_rows = rows if len(dict_positions) == len(rows) else [rows[position] for position in dict_positions]
+    columns = [[row.get(field) for row in dict_rows] for field in RECORD_FIELDS]
+    invalid_rows = _invalid_rows(columns, 0, len(dict_positions))
+
+    if invalid_rows:
+        valid = [True] * len(dict_positions)
+
+        for row_number in invalid_rows:
+            valid[row_number] = False
+
+        dict_positions = list(compress(dict_positions, valid))
+        columns = [list(compress(column, valid)) for column in columns]
+
+    records = list(map(AddressBookRecord, *columns))
+
+    if len(records) == len(rows):
+        return records, [None] * len(rows)
+
+    # Every other row is converted by pydantic as FastAPI would, which also gives the error of an invalid row
+    row_errors: list[str | None] = [None] * len(rows)
+    records_of_rows = dict(zip(dict_positions, records))
+    records = []
+
+    for position, row in enumerate(rows):
+        if (record := records_of_rows.get(position)) is not None:
+            records.append(record)
+        elif isinstance(row, json.JSONDecodeError):
+            row_errors[position] = f"Invalid JSON: {row.msg}"
+        else:
+            try:
+                records.append(record_validator().validate_python(row))
+            except ValidationError as error:
+                row_errors[position] = "; ".join(f"{'.'.join(map(str, detail['loc']))}: {detail['msg']}"
+                                                 for detail in error.errors())
+
+    return records, row_errors
+
+
+def _column_valid(field: str, values: list[Any]) -> bool:
+    try:
+        joined = BATCH_SEPARATOR.join(values) + BATCH_SEPARATOR
+    except TypeError:
+        # A value is missing or is not a string
+        return False
+
+    # A value holding the separator would be split into several values, so the count is checked too
+    return joined.count(BATCH_SEPARATOR) == len(values) and BATCH_PATTERNS[field].fullmatch(joined) is not None
+
+
+def _invalid_rows(columns: list[list[Any]], start: int, stop: int) -> list[int]:
+    """
+    Returns the numbers of the rows from start to stop holding an invalid value, given the values of each field.
+    The rows are checked a column at a time, and only a range holding an invalid value is split in half
+    and checked again, so a batch with a few invalid rows takes a few more checks rather than one per row
+    """
+    if start == stop:
+        return []
+
+    # The whole of each column is checked without copying it
+    whole = start == 0 and stop == len(columns[0])
+
+    if all(_column_valid(field, column if whole else column[start:stop])
+           for field, column in zip(RECORD_FIELDS, columns)):
+        return []
+
+    if stop - start == 1:
+        return [start]
+
+    middle = (start + stop) // 2
+    return _invalid_rows(columns, start, middle) + _invalid_rows(columns, middle, stop)
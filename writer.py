@@ -0,0 +1,93 @@
+from collections.abc import Callable
+from concurrent.futures import Future
+import threading
+import time
+
+
+class GroupCommitWriter:
+    """
+    Persists changes from a single dedicated thread.
+    Changes submitted while a commit is being written, or within commit_window seconds of the first
+    change waiting to be written, are coalesced and persisted together by one call to commit.
+    Whenever the thread runs out of changes it calls idle, which returns how many seconds it can wait
+    for more before calling idle again, or None to wait until changes are submitted
+    """
+    def __init__(self, commit: Callable[[list[tuple]], None], commit_window: float = 0.0,
+                 idle: Callable[[], float | None] = lambda: None) -> None:
+        self.commit_window = commit_window
+        self._commit = commit
+        self._idle = idle
+        self._pending: list[tuple[list[tuple], Future]] = []
+        self._closed = False
+        self._woken = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="GroupCommitWriter", daemon=True)
+        self._thread.start()
+
+    def submit(self, changes: list[tuple]) -> Future:
+        """
+        Queues changes to be persisted.
+        Returns a future that completes once the changes have been committed,
+        or raises the error the commit failed with
+        """
+        future = Future()
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The writer has been closed")
+
+            self._pending.append((changes, future))
+            self._condition.notify()
+
+        return future
+
+    def close(self) -> None:
+        """
+        Commits any changes still waiting and stops the writer thread
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        self._thread.join()
+
+    def wake(self) -> None:
+        """
+        Makes the writer thread call idle again, e.g. after work it has to finish was done by another thread
+        """
+        with self._condition:
+            self._woken = True
+            self._condition.notify()
+
+    def _run(self) -> None:
+        idle_timeout = None
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed or self._woken, idle_timeout)
+                self._woken = False
+
+                if not self._pending:
+                    if self._closed:
+                        return
+
+                    # Nothing is waiting to be committed, woken or timed out
+                    idle_timeout = self._idle()
+                    continue
+
+            if self.commit_window:
+                time.sleep(self.commit_window)
+
+            with self._condition:
+                batch, self._pending = self._pending, []
+
+            try:
+                self._commit([change for changes, _ in batch for change in changes])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+
+            idle_timeout = self._idle()